@@ -0,0 +1,83 @@
+"""Benchmark ID claim latency for the id_gen service
+
+For each pool size, preloads that many IDs (half of them already assigned, as
+in a pool that is filling up) and times new-record claims with
+DatabaseAccess.get_id, alongside the previous SELECT/SELECT/UPDATE sequence.
+Repeat triggers for records that already have an ID are timed as well.
+
+Usage: python benchmarks/bench_id_claim.py [--sizes 10000 1000000 10000000]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+tmp = tempfile.mkdtemp()
+os.chdir(tmp)
+os.environ['ID_GEN'] = json.dumps({'db': os.path.join(tmp, 'id_gen.db')})
+
+from redcap_booster.services.id_gen.db import DatabaseAccess
+
+def preload(db, pid, size):
+    """Fill table with size IDs, the first half assigned"""
+    with db.transaction() as cur:
+        db.create_table(pid)
+        cur.execute(f'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                    f'SELECT i+1 FROM n WHERE i<?) '
+                    f'INSERT INTO pid_{pid} (idx, id, record) '
+                    f"SELECT i, printf('ID%09d', i), "
+                    f"CASE WHEN i<=? THEN 'old'||i END FROM n",
+                    (size, size//2))
+    db.cur.execute('ANALYZE')
+
+def legacy_get_id(db, pid, record):
+    cur = db.cur
+    cur.execute('BEGIN')
+    cur.execute(f'SELECT id FROM pid_{pid} WHERE record=?', (record,))
+    id = cur.fetchone()
+    if not id:
+        cur.execute(f'SELECT id FROM pid_{pid} WHERE record IS NULL '
+                    f'ORDER BY idx LIMIT 1')
+        id = cur.fetchone()
+        cur.execute(f'UPDATE pid_{pid} SET record=? WHERE id=?',
+                    (record, id[0]))
+    cur.execute('COMMIT')
+    return id[0]
+
+def time_claims(fn, db, pid, n, tag):
+    times = []
+    for i in range(1, n+1):
+        start = time.perf_counter()
+        fn(db, pid, f'{tag}{i}')
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10_000, 1_000_000, 10_000_000])
+    parser.add_argument('-n', type=int, default=500, help='claims per run')
+    args = parser.parse_args()
+    
+    db = DatabaseAccess('id_gen')
+    print(f'{"IDs":>10}  {"method":<8} {"p50 (ms)":>9} {"p99 (ms)":>9}')
+    for i, size in enumerate(args.sizes):
+        pid = str(i + 1)
+        start = time.perf_counter()
+        preload(db, pid, size)
+        print(f'{size:>10}  (preloaded in {time.perf_counter() - start:.1f}s)')
+        
+        for name, fn, tag in (('legacy', legacy_get_id, 'legacy'),
+                              ('get_id', DatabaseAccess.get_id, 'new'),
+                              ('repeat', DatabaseAccess.get_id, 'old')):
+            p50, p99 = time_claims(fn, db, pid, args.n, tag)
+            print(f'{size:>10}  {name:<8} {p50 * 1000:9.3f} {p99 * 1000:9.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark generated IDs against a preloaded pool for the id_gen service
+
+For each number of IDs, compares the two ways of providing them:
+
+- pool: load that many random IDs in random order (load_ids with
+  random_order, as load-ids --random-order does), then claim IDs with get_id
+- generator: nothing to load; get_id mints IDs from a counter through a
+  keyed permutation (width chosen to cover the number of IDs)
+
+Reports setup time, database size and claim latency (new records, then
+repeat triggers for records that already have an ID), plus the rate at which
+IDs can be formatted.
+
+Usage: python benchmarks/bench_id_generator.py [--sizes 100000 1000000]
+                                               [-n 2000]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+tmp = tempfile.mkdtemp()
+os.chdir(tmp)
+
+from redcap_booster import config
+from redcap_booster.services.id_gen.db import DatabaseAccess
+from redcap_booster.services.id_gen.generator import IdGenerator
+
+def use_db(name, pid, generator=None):
+    """Return a DatabaseAccess on a new file, with pid configured"""
+    config.settings.id_gen = {'db': os.path.join(tmp, f'{name}.db')}
+    p_settings = {'id_field': 'study_id'}
+    if generator:
+        p_settings['generator'] = generator
+    setattr(config.settings, f'id_gen_{pid}', p_settings)
+    return DatabaseAccess('id_gen')
+
+def time_claims(db, pid, n, tag):
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        db.get_id(pid, f'{tag}{i}')
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99)]
+
+def db_size(db):
+    db.cur.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return os.path.getsize(db.db) / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100_000, 1_000_000])
+    parser.add_argument('-n', type=int, default=2000, help='claims per run')
+    args = parser.parse_args()
+    
+    print(f'{"IDs":>9}  {"mode":<9} {"setup (s)":>9} {"MB":>7} '
+          f'{"new p50":>8} {"new p99":>8} {"repeat p50":>10}  (ms)')
+    for i, size in enumerate(args.sizes):
+        # Settings are per project, so each mode has its own
+        pool_pid, generator_pid = f'{i + 1}1', f'{i + 1}2'
+        width = len(str(size - 1))
+        generator = {'prefix': 'G', 'width': width, 'check_digit': 'damm',
+                     'key': 'bench'}
+        
+        # Pool of random IDs, as would be generated and loaded beforehand
+        db = use_db(f'pool_{size}', pool_pid)
+        start = time.perf_counter()
+        ids = (f'P{n:0{width}d}' for n in random.sample(range(10**width),
+                                                        size))
+        db.load_ids(pool_pid, ids, random_order=True)
+        setups = {'pool': (db, pool_pid, time.perf_counter() - start)}
+        
+        db = use_db(f'generator_{size}', generator_pid, generator)
+        start = time.perf_counter()
+        db.get_id(generator_pid, 'first')
+        setups['generator'] = (db, generator_pid,
+                               time.perf_counter() - start)
+        
+        for mode, (db, pid, setup) in setups.items():
+            new = time_claims(db, pid, args.n, 'new')
+            repeat = time_claims(db, pid, args.n, 'new')
+            print(f'{size:>9}  {mode:<9} {setup:9.2f} {db_size(db):7.1f} '
+                  f'{new[0] * 1000:8.3f} {new[1] * 1000:8.3f} '
+                  f'{repeat[0] * 1000:10.3f}')
+    
+    g = IdGenerator(width=9, check_digit='damm', key='bench')
+    n = 100_000
+    start = time.perf_counter()
+    for i in range(n):
+        g(i)
+    elapsed = time.perf_counter() - start
+    print(f'\nFormatting {n} IDs of width 9: {n / elapsed:,.0f} IDs/s')
+
+if __name__ == '__main__':
+    main()
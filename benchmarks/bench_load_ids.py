@@ -0,0 +1,63 @@
+"""Benchmark loading ID pools for the id_gen service
+
+For each size, writes a file of that many random IDs and loads it into an
+empty table with DatabaseAccess.load_ids, streaming from the file as the
+load-ids command does. The same file is then loaded again, so that every ID
+is a duplicate. Time per ID should stay roughly constant as size grows.
+
+Usage: python benchmarks/bench_load_ids.py [--sizes 100000 1000000 10000000]
+
+Connection pragmas may be overridden with e.g. PRAGMAS='{"cache_size":-400000}'.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+tmp = tempfile.mkdtemp()
+os.chdir(tmp)
+os.environ['ID_GEN'] = json.dumps({'db': os.path.join(tmp, 'id_gen.db'),
+                                  'pragmas': json.loads(os.environ.get(
+                                      'PRAGMAS', '{}'))})
+
+from redcap_booster.services.id_gen.db import DatabaseAccess
+
+def write_ids(filename, size):
+    # Random 12-digit IDs, so that inserts land all over the UNIQUE index
+    ids = random.sample(range(10**11, 10**12), size)
+    with open(filename, 'w') as f:
+        f.writelines(f'{id}\n' for id in ids)
+
+def load(db, pid, filename):
+    start = time.perf_counter()
+    with open(filename) as f:
+        loaded, skipped = db.load_ids(pid, (line.strip() for line in f))
+    return loaded, skipped, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100_000, 1_000_000, 10_000_000])
+    args = parser.parse_args()
+    
+    db = DatabaseAccess('id_gen')
+    print(f'{"IDs":>10}  {"run":<10} {"loaded":>10} {"skipped":>10} '
+          f'{"seconds":>8} {"us/ID":>6}')
+    for i, size in enumerate(args.sizes):
+        pid = str(i + 1)
+        filename = os.path.join(tmp, f'ids_{size}.txt')
+        write_ids(filename, size)
+        
+        for run in ('new', 'duplicate'):
+            loaded, skipped, elapsed = load(db, pid, filename)
+            print(f'{size:>10}  {run:<10} {loaded:>10} {skipped:>10} '
+                  f'{elapsed:8.2f} {elapsed / size * 1e6:6.2f}')
+        os.remove(filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark REDCap API throughput for Data Entry Trigger write-backs
+
+Replays N single-record imports (what id_gen does for each trigger) against
+a local stand-in REDCap server with simulated latency, comparing:
+
+- per-call connections, one call at a time (the old requests.post path
+  inside a blocking handler)
+- the pooled client, awaited concurrently from the event loop
+
+Usage: python benchmarks/bench_redcap_api.py [-n 500] [-c 50] [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+
+from mock_redcap import MockRedcap
+from redcap_booster.client import RedcapClient
+
+def payload(i):
+    data = json.dumps([{'record_id': str(i), 'study_id': f'ID{i:06d}'}])
+    return {'content': 'record', 'format': 'json', 'data': data,
+            'token': 'x'}
+
+def bench_unpooled(url, n):
+    for i in range(n):
+        requests.post(f'{url}/api/', payload(i)).raise_for_status()
+
+async def bench_pooled(url, n, concurrency):
+    client = RedcapClient(url, pool_size=concurrency)
+    sem = asyncio.Semaphore(concurrency)
+    
+    async def trigger(i):
+        async with sem:
+            (await client.apost(payload(i))).raise_for_status()
+    
+    await asyncio.gather(*(trigger(i) for i in range(n)))
+    client.close()
+
+def report(name, n, elapsed, mock, before):
+    after = mock.stats()
+    print(f'{name:<28} {n / elapsed:8.1f} triggers/s   '
+          f'{after["connections"] - before["connections"]:5d} connections')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=500, help='triggers')
+    parser.add_argument('-c', type=int, default=50, help='concurrency')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated REDCap latency (s)')
+    args = parser.parse_args()
+    
+    with MockRedcap(latency=args.latency) as mock:
+        print(f'{args.n} triggers, REDCap latency {args.latency * 1000:.0f} ms')
+        
+        before = mock.stats()
+        start = time.perf_counter()
+        bench_unpooled(mock.url, args.n)
+        report('sequential, unpooled', args.n, time.perf_counter() - start,
+               mock, before)
+        
+        before = mock.stats()
+        start = time.perf_counter()
+        asyncio.run(bench_pooled(mock.url, args.n, args.c))
+        report(f'concurrent ({args.c}), pooled', args.n,
+               time.perf_counter() - start, mock, before)
+
+if __name__ == '__main__':
+    main()
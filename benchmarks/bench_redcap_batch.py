@@ -0,0 +1,73 @@
+"""Benchmark batching of REDCap record imports across triggers
+
+Runs N single-record imports (what id_gen does for each trigger) from C
+concurrent threads through redcap_import, against a local stand-in REDCap
+server with simulated latency, once without batching and then with each
+redcap_batch_delay given. Reports API calls made, throughput and per-call
+latency, which batching trades for fewer calls.
+
+Usage: python benchmarks/bench_redcap_batch.py [-n 2000] [-c 50]
+                                               [--delays 0.005 0.02]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+os.environ['PIDS'] = '["1"]'
+os.environ['TOKEN_1'] = 'x'
+
+from mock_redcap import MockRedcap
+from redcap_booster import config, redcap_import
+from redcap_booster.batch import batchers
+
+def run(url, n, concurrency):
+    context = {'project_id': '1', 'redcap_url': url}
+    
+    def trigger(i):
+        rows = [{'record_id': str(i), 'study_id': f'ID{i:06d}'}]
+        start = time.perf_counter()
+        redcap_import('bench', config, context, rows).raise_for_status()
+        return time.perf_counter() - start
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        times = sorted(pool.map(trigger, range(n)))
+    return time.perf_counter() - start, times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=2000, help='triggers')
+    parser.add_argument('-c', type=int, default=50, help='concurrency')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated REDCap latency (s)')
+    parser.add_argument('--delays', type=float, nargs='+',
+                        default=[0.005, 0.02], help='batch delays (s)')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='maximum rows per batch')
+    args = parser.parse_args()
+    
+    config.settings.redcap_pool_size = args.c
+    config.settings.redcap_batch_rows = args.rows
+    print(f'{"batch delay":<12} {"API calls":>9} {"triggers/s":>10} '
+          f'{"p50 (ms)":>9} {"p99 (ms)":>9}')
+    with MockRedcap(latency=args.latency) as mock:
+        for delay in [0.0] + args.delays:
+            config.settings.redcap_batch_delay = delay
+            batchers.clear()
+            before = mock.stats()['imports']
+            elapsed, times = run(mock.url, args.n, args.c)
+            calls = mock.stats()['imports'] - before
+            print(f'{delay if delay else "off":<12} {calls:>9} '
+                  f'{args.n / elapsed:10.1f} '
+                  f'{statistics.median(times) * 1000:9.1f} '
+                  f'{times[int(len(times) * 0.99)] * 1000:9.1f}')
+
+if __name__ == '__main__':
+    main()
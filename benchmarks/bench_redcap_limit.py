@@ -0,0 +1,85 @@
+"""Benchmark adaptive concurrency against a REDCap server that throttles
+
+Runs N single-record imports from C concurrent threads through redcap_api
+against a local stand-in REDCap server that answers 429 (with Retry-After)
+to requests beyond its capacity, with a fixed number of concurrent calls
+(redcap_adaptive off, as before) and then with adaptive concurrency. Reports
+throughput, calls throttled by the server, calls that failed after retries
+and the concurrency the limiter settled on. Finally, checks that redcap_rate
+holds calls with one token to the given rate.
+
+Usage: python benchmarks/bench_redcap_limit.py [-n 1000] [-c 50]
+                                               [--capacity 8]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+os.environ['PIDS'] = '["1"]'
+os.environ['TOKEN_1'] = 'x'
+
+from mock_redcap import MockRedcap
+from redcap_booster import config, redcap_api
+from redcap_booster.client import close_clients, get_client
+
+def run(url, n, concurrency):
+    context = {'project_id': '1', 'redcap_url': url}
+    
+    def call(i):
+        rows = [{'record_id': str(i), 'study_id': f'ID{i:06d}'}]
+        payload = {'content': 'record', 'format': 'json',
+                   'data': json.dumps(rows)}
+        return redcap_api('bench', config, context, payload).ok
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        ok = list(pool.map(call, range(n)))
+    return time.perf_counter() - start, ok.count(False)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=1000, help='calls')
+    parser.add_argument('-c', type=int, default=50, help='concurrency')
+    parser.add_argument('--capacity', type=int, default=8,
+                        help='concurrent calls the server accepts')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated REDCap latency (s)')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After (s) sent with 429 responses')
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='redcap_rate (calls/s) to check')
+    args = parser.parse_args()
+    
+    config.settings.redcap_pool_size = args.c
+    print(f'{"concurrency":<12} {"calls/s":>8} {"throttled":>9} '
+          f'{"failed":>6} {"limit":>5}')
+    with MockRedcap(latency=args.latency, capacity=args.capacity,
+                    retry_after=args.retry_after) as mock:
+        for adaptive in (False, True):
+            config.settings.redcap_adaptive = adaptive
+            close_clients()
+            before = mock.stats()['throttled']
+            elapsed, failed = run(mock.url, args.n, args.c)
+            limit = get_client(mock.url).limiter.concurrency.limit
+            print(f'{"adaptive" if adaptive else "fixed":<12} '
+                  f'{args.n / elapsed:8.1f} '
+                  f'{mock.stats()["throttled"] - before:>9} {failed:>6} '
+                  f'{int(limit):>5}')
+    
+    config.settings.redcap_rate = args.rate
+    config.settings.redcap_burst = 1
+    with MockRedcap() as mock:
+        close_clients()
+        n = int(args.rate * 3)
+        elapsed, failed = run(mock.url, n, args.c)
+        print(f'\nredcap_rate={args.rate}: {n / elapsed:.1f} calls/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark startup time with many projects
+
+For each number of projects, writes a .env configuring every project for the
+id_gen service, with an API key in .env and a REDCap token in .secrets, then
+times fresh interpreters running:
+
+- import: import redcap_booster.config and read one project's settings
+- list-services: rbutils list-services
+- service command: rbutils id-gen --help
+
+Times are the median of several runs. Startup should barely grow with the
+number of projects.
+
+Usage: python benchmarks/bench_startup.py [--projects 10 100 1000] [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'import': ['-c', 'from redcap_booster import config; '
+               'config.settings.id_gen_1, config.settings.token_1'],
+    'list-services': ['-m', 'redcap_booster.cli', 'list-services'],
+    'service command': ['-m', 'redcap_booster.cli', 'id-gen', '--help'],
+}
+
+def write_config(directory, n):
+    pids = [str(i) for i in range(1, n + 1)]
+    os.makedirs(os.path.join(directory, '.secrets'))
+    with open(os.path.join(directory, '.env'), 'w') as f:
+        f.write(f'pids={json.dumps(pids)}\n')
+        f.write(f'id_gen={json.dumps({"db": "id_gen.db"})}\n')
+        for pid in pids:
+            f.write(f'key_{pid}=key{pid}\n')
+            f.write(f'id_gen_{pid}='
+                    f'{json.dumps({"form_triggers": ["reg"]})}\n')
+    for pid in pids:
+        with open(os.path.join(directory, '.secrets', f'token_{pid}'),
+                  'w') as f:
+            f.write(f'token{pid}\n')
+
+def time_command(directory, args, runs):
+    env = dict(os.environ, PYTHONPATH=root)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=directory, env=env,
+                       check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--projects', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    
+    print(f'{"projects":>8}  {"command":<16} {"ms":>7}')
+    for n in args.projects:
+        directory = tempfile.mkdtemp()
+        write_config(directory, n)
+        for name, command in COMMANDS.items():
+            elapsed = time_command(directory, command, args.runs)
+            print(f'{n:>8}  {name:<16} {elapsed * 1000:7.0f}')
+
+if __name__ == '__main__':
+    main()
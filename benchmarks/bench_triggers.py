@@ -0,0 +1,260 @@
+"""Load test of the trigger endpoint, with the id_gen service
+
+Starts the app in-process (uvicorn in a thread) with a temporary id_gen
+database and a local stand-in REDCap server, then replays Data Entry Trigger
+workloads from concurrent clients:
+
+- new: saves of new records, in one project
+- repeat: repeated saves of the same records (--repeat saves each)
+- multi: new records spread over --projects projects
+- slow: new records, with REDCap responding after --slow-latency seconds
+
+For each, reports throughput, p50/p99 latency, response errors and REDCap
+API calls, and checks that every record got exactly one ID, that no ID went
+to two records, and that the ID in REDCap is the one in the database.
+Results are written as JSON (with the commit and options) for comparing
+commits.
+
+Usage: python benchmarks/bench_triggers.py [-n 2000] [-c 50] [--projects 10]
+                                           [--workloads new repeat multi slow]
+                                           [--env redcap_batch_delay=0.01]
+                                           [--output results.json]
+
+Settings given with --env apply as they would in .env.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+tmp = tempfile.mkdtemp()
+os.chdir(tmp)
+
+WORKLOADS = ('new', 'repeat', 'multi', 'slow')
+ID_FIELD = 'study_id'
+
+def configure(args):
+    pids = [str(pid) for pid in range(1, args.projects + 1)]
+    os.environ['PIDS'] = json.dumps(pids)
+    os.environ['ID_GEN'] = json.dumps({'db': os.path.join(tmp, 'id_gen.db')})
+    for pid in pids:
+        os.environ[f'KEY_{pid}'] = f'key{pid}'
+        os.environ[f'TOKEN_{pid}'] = f'token{pid}'
+        os.environ[f'ID_GEN_{pid}'] = json.dumps(
+            {'form_triggers': ['reg'], 'id_field': ID_FIELD})
+    for setting in args.env:
+        name, _, value = setting.partition('=')
+        os.environ[name.upper()] = value
+    return pids
+
+def triggers(workload, args, pids):
+    """Return (project ID, record) for each trigger of a workload"""
+    n = args.n
+    if workload == 'repeat':
+        records = [f'{workload}-{i}' for i in range(n // args.repeat)]
+        saves = [(pids[0], record) for record in records] * args.repeat
+        random.Random(0).shuffle(saves)
+        return saves
+    if workload == 'multi':
+        return [(pids[i % len(pids)], f'{workload}-{i}') for i in range(n)]
+    if workload == 'slow':
+        n = max(n // 4, 1)
+    return [(pids[0], f'{workload}-{i}') for i in range(n)]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class Server:
+    """The app, served by uvicorn in a background thread"""
+    
+    def __init__(self, app):
+        import uvicorn
+        self.port = free_port()
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host='127.0.0.1', port=self.port, log_level='warning'))
+        # Signals can only be handled in the main thread
+        self.server.install_signal_handlers = lambda: None
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+    
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}/'
+    
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError('Server failed to start')
+            time.sleep(0.05)
+        return self
+    
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+def replay(url, redcap_url, saves, concurrency):
+    import requests
+    local = threading.local()
+    
+    def post(save):
+        pid, record = save
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = session.post(url, params={'key': f'key{pid}'}, data={
+                'project_id': pid, 'instrument': 'reg', 'record': record,
+                'redcap_url': redcap_url, 'reg_complete': '2'}).status_code
+        except requests.RequestException:
+            status = None
+        return time.perf_counter() - start, status
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(post, saves))
+    return time.perf_counter() - start, results
+
+def wait_for_jobs(config, jobs, timeout=600):
+    """With the job queue, wait until the workers have run every job"""
+    if not config.settings.job_queue:
+        return
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = jobs.get_queue().counts()
+        if not counts.get(jobs.PENDING) and not counts.get(jobs.RUNNING):
+            return
+        time.sleep(0.1)
+
+def check_ids(db, mock, saves):
+    """Check the ID invariants; return a dict of any violations found"""
+    expected = {}
+    for pid, record in saves:
+        expected.setdefault(pid, set()).add(record)
+    
+    missing, duplicates, mismatched = 0, 0, 0
+    for pid, records in expected.items():
+        assigned = {}
+        for id, record in db.export_map(pid, exclude_unused=True):
+            if record in records:
+                if record in assigned:
+                    duplicates += 1
+                assigned[record] = id
+        duplicates += len(assigned) - len(set(assigned.values()))
+        missing += len(records - set(assigned))
+        for record, id in assigned.items():
+            if mock.records.get(record, {}).get(ID_FIELD) != id:
+                mismatched += 1
+    return {'records': sum(len(r) for r in expected.values()),
+            'missing': missing, 'duplicates': duplicates,
+            'mismatched': mismatched,
+            'ok': missing == duplicates == mismatched == 0}
+
+def percentile(times, p):
+    return times[min(int(len(times) * p), len(times) - 1)]
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=2000,
+                        help='triggers per workload')
+    parser.add_argument('-c', type=int, default=50, help='concurrent clients')
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='saves of each record in the repeat workload')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='simulated REDCap latency (s)')
+    parser.add_argument('--slow-latency', type=float, default=0.25,
+                        help='simulated REDCap latency in the slow workload')
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS,
+                        default=list(WORKLOADS))
+    parser.add_argument('--env', nargs='+', default=[],
+                        metavar='NAME=VALUE', help='settings to override')
+    parser.add_argument('--output', help='file for JSON results '
+                        '(default: standard output)')
+    args = parser.parse_args()
+    
+    pids = configure(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from mock_redcap import MockRedcap
+    from redcap_booster import config, jobs
+    from redcap_booster.main import app
+    from redcap_booster.services.id_gen.db import DatabaseAccess
+    
+    db = DatabaseAccess('id_gen')
+    workloads = {workload: triggers(workload, args, pids)
+                 for workload in args.workloads}
+    for pid in pids:
+        needed = sum(len({r for p, r in saves if p == pid})
+                     for saves in workloads.values())
+        db.load_ids(pid, (f'P{pid}-{i:07d}' for i in range(needed)),
+                    random_order=True)
+    
+    results = {'commit': commit(),
+               'python': platform.python_version(),
+               'args': vars(args),
+               'workloads': {}}
+    print(f'{"workload":<8} {"triggers":>8} {"per s":>8} {"p50 ms":>8} '
+          f'{"p99 ms":>8} {"errors":>6} {"API calls":>9}  IDs',
+          file=sys.stderr)
+    with MockRedcap(latency=args.latency) as mock, Server(app) as server:
+        for workload, saves in workloads.items():
+            mock.latency = (args.slow_latency if workload == 'slow'
+                            else args.latency)
+            before = mock.stats()['requests']
+            start = time.perf_counter()
+            elapsed, responses = replay(server.url, mock.url, saves, args.c)
+            wait_for_jobs(config, jobs)
+            # Including the time for queued jobs to run, if any
+            done = time.perf_counter() - start
+            times = sorted(t for t, status in responses)
+            errors = sum(status != 200 for t, status in responses)
+            ids = check_ids(db, mock, saves)
+            result = results['workloads'][workload] = {
+                'triggers': len(saves),
+                'seconds': round(elapsed, 3),
+                'seconds_until_done': round(done, 3),
+                'throughput': round(len(saves) / elapsed, 1),
+                'p50_ms': round(statistics.median(times) * 1000, 1),
+                'p99_ms': round(percentile(times, 0.99) * 1000, 1),
+                'errors': errors,
+                'redcap_calls': mock.stats()['requests'] - before,
+                'ids': ids}
+            print(f'{workload:<8} {result["triggers"]:>8} '
+                  f'{result["throughput"]:8.1f} {result["p50_ms"]:8.1f} '
+                  f'{result["p99_ms"]:8.1f} {errors:>6} '
+                  f'{result["redcap_calls"]:>9}  '
+                  f'{"ok" if ids["ok"] else "FAILED"}', file=sys.stderr)
+    
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if not all(r['ids']['ok'] for r in results['workloads'].values()):
+        sys.exit('ID invariants violated')
+
+if __name__ == '__main__':
+    main()
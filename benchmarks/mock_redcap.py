@@ -0,0 +1,163 @@
+"""Local stand-in for the REDCap API, for benchmarks
+
+Implements just enough of the API for REDCap Booster: record import and
+export. Latency and error responses can be injected, as can a capacity:
+requests beyond that many at once are answered with 429 (and Retry-After, if
+given), as by a throttling server. Request and connection counts are
+recorded so that benchmarks can report them.
+"""
+
+import csv
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+class MockRedcap:
+    """REDCap API server running in a background thread"""
+    
+    def __init__(self, latency=0.0, error_rate=0.0, record_id='record_id',
+                 capacity=None, retry_after=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.active = 0
+        self.max_active = 0
+        self.throttled = 0
+        self.record_id = record_id
+        self.records = {}
+        self.requests = 0
+        self.connections = 0
+        self.imports = 0
+        self.rows_imported = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+    
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *exc):
+        self.stop()
+    
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'connections': self.connections,
+                    'throttled': self.throttled,
+                    'max_active': self.max_active,
+                    'imports': self.imports,
+                    'rows_imported': self.rows_imported}
+    
+    def handle(self, params):
+        """Return (status, content type, body) for an API call"""
+        
+        content = params.get('content', [''])[0]
+        if content != 'record':
+            return 400, 'application/json', {'error': f'Unsupported: {content}'}
+        
+        if 'data' in params:
+            rows = json.loads(params['data'][0])
+            with self.lock:
+                self.imports += 1
+                self.rows_imported += len(rows)
+                for row in rows:
+                    record = row[self.record_id]
+                    self.records.setdefault(record, {}).update(row)
+            if params.get('returnContent', ['count'])[0] == 'ids':
+                return 200, 'application/json', [r[self.record_id] for r in rows]
+            return 200, 'application/json', {'count': len(rows)}
+        
+        fields = params.get('fields', []) + params.get('fields[]', [])
+        wanted = set(params.get('records', []) + params.get('records[]', []))
+        with self.lock:
+            rows = [{f: values.get(f, '') for f in fields} if fields
+                    else dict(values)
+                    for record, values in self.records.items()
+                    if not wanted or record in wanted]
+        
+        if params.get('format', ['json'])[0] == 'csv':
+            out = io.StringIO()
+            names = fields or sorted({k for row in rows for k in row})
+            writer = csv.DictWriter(out, fieldnames=names,
+                                    extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+            return 200, 'text/csv', out.getvalue()
+        return 200, 'application/json', rows
+    
+    def _handler(self):
+        mock = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def setup(self):
+                super().setup()
+                with mock.lock:
+                    mock.connections += 1
+            
+            def log_message(self, *args):
+                pass
+            
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                params = parse_qs(self.rfile.read(length).decode(),
+                                  keep_blank_values=True)
+                with mock.lock:
+                    mock.requests += 1
+                    mock.active += 1
+                    mock.max_active = max(mock.max_active, mock.active)
+                    throttled = (mock.capacity is not None
+                                 and mock.active > mock.capacity)
+                    if throttled:
+                        mock.throttled += 1
+                
+                try:
+                    if throttled:
+                        status, ctype, body = 429, 'text/plain', 'Too Many'
+                    else:
+                        if mock.latency:
+                            time.sleep(mock.latency)
+                        if (mock.error_rate
+                                and random.random() < mock.error_rate):
+                            status, ctype, body = (503, 'text/plain',
+                                                   'Unavailable')
+                        else:
+                            status, ctype, body = mock.handle(params)
+                finally:
+                    with mock.lock:
+                        mock.active -= 1
+                
+                if not isinstance(body, str):
+                    body = json.dumps(body)
+                body = body.encode()
+                self.send_response(status)
+                if status == 429 and mock.retry_after is not None:
+                    self.send_header('Retry-After', str(mock.retry_after))
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        
+        return Handler
@@ -1,28 +1,120 @@
-import requests
-import logging
-from logging.handlers import RotatingFileHandler
-import pathlib
-from redcap_booster import config
+from redcap_booster import config, logs, metrics
+from redcap_booster.batch import get_batcher
+from redcap_booster.client import get_client
+from redcap_booster.metadata import get_metadata
+from redcap_booster.profiling import profiler
+import json
 
 # Log calls to REDCap API
-logfile = pathlib.Path(config.settings.redcap_log)
-logfile.parent.mkdir(parents=True, exist_ok=True)
-logger = logging.getLogger('redcap')
-logger.setLevel(logging.INFO)
-handler = RotatingFileHandler(logfile, maxBytes=1e7, backupCount=10)
-formatter = logging.Formatter('%(asctime)s: %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+logger = logs.setup('redcap', config.settings.redcap_log)
 
-def redcap_api(service, config, context, payload, loginfo=None, pid=None):
-    """Execute call to REDCap API"""
+def count_response(result):
+    """Count REDCap API response by status code, and any retries"""
+    metrics.redcap_responses.inc(code=result.status_code)
+    retries = getattr(result.raw, 'retries', None)
+    if retries is not None and retries.history:
+        metrics.redcap_retries.inc(len(retries.history))
+
+def redcap_api(service, config, context, payload, loginfo=None, pid=None,
+               **kwargs):
+    """Execute call to REDCap API
+    
+    Uses the pooled client for the REDCap server in the context; any extra
+    keyword arguments are passed on to requests (e.g., stream=True).
+    """
+    
+    if pid is None:
+        pid = context['project_id']
+    
+    logger.info('redcap request', extra=logs.fields(service=service, pid=pid,
+                                                    info=loginfo))
+    payload = dict(payload, token=getattr(config.settings, f'token_{pid}'))
+    with metrics.stage('redcap'), profiler.span('redcap_api'):
+        try:
+            result = get_client(context['redcap_url']).post(payload, **kwargs)
+        except Exception:
+            metrics.redcap_responses.inc(code='error')
+            raise
+    count_response(result)
+    logger.info('redcap response', extra=logs.fields(
+        service=service, pid=pid, status=result.status_code))
+    
+    return result
+
+async def redcap_api_async(service, config, context, payload, loginfo=None,
+                           pid=None, **kwargs):
+    """Execute call to REDCap API without blocking the event loop"""
     
     if pid is None:
         pid = context['project_id']
     
-    logger.info(f'{service}: PID {pid}: {loginfo}')
-    payload['token'] = getattr(config.settings, f'token_{pid}')
-    result = requests.post(f"{context['redcap_url']}/api/", payload)
-    logger.info(f'RESPONSE: {result.status_code}')
+    logger.info('redcap request', extra=logs.fields(service=service, pid=pid,
+                                                    info=loginfo))
+    payload = dict(payload, token=getattr(config.settings, f'token_{pid}'))
+    with metrics.stage('redcap'), profiler.span('redcap_api'):
+        try:
+            result = await get_client(context['redcap_url']).apost(payload,
+                                                                   **kwargs)
+        except Exception:
+            metrics.redcap_responses.inc(code='error')
+            raise
+    count_response(result)
+    logger.info('redcap response', extra=logs.fields(
+        service=service, pid=pid, status=result.status_code))
     
     return result
+
+def redcap_import(service, config, context, rows, record_id='record_id',
+                  loginfo=None, pid=None):
+    """Import records (a list of dicts) into REDCap
+    
+    If redcap_batch_delay is set, rows from concurrent calls for the same
+    project are combined into one import; the result then only covers the
+    rows of this call.
+    """
+    
+    if pid is None:
+        pid = context['project_id']
+    
+    def send(rows, service=service, loginfo=loginfo):
+        payload = {'content':'record',
+                   'format':'json',
+                   'data':json.dumps(rows, separators=(',',':'))}
+        return redcap_api(service, config, context, payload,
+                          loginfo or payload, pid)
+    
+    delay = config.settings.redcap_batch_delay
+    if not delay:
+        return send(rows)
+    
+    logger.info('redcap batch', extra=logs.fields(service=service, pid=pid,
+                                                  info=loginfo or rows))
+    batcher = get_batcher((context['redcap_url'], pid),
+                          lambda rows: send(rows, 'batch',
+                                            f'{len(rows)} rows'))
+    return batcher.submit(rows, {row[record_id] for row in rows}, delay,
+                          config.settings.redcap_batch_rows)
+
+def redcap_export(service, config, context, fields, records=None,
+                  events=None, loginfo=None, pid=None):
+    """Export only the given fields of records (default: all), as dicts
+    
+    Fields are checked against the project's cached data dictionary before
+    anything is sent (raising ValueError), and the record ID field is
+    always included.
+    """
+    
+    if pid is None:
+        pid = context['project_id']
+    
+    metadata = get_metadata(config, context, pid)
+    payload = {'content':'record', 'format':'json', 'type':'flat'}
+    # Lists as REDCap (PHP) expects them: fields[0]=...&fields[1]=...
+    for name, values in (('fields', metadata.export_fields(fields)),
+                         ('records', records or ()), ('events', events or ())):
+        for i, value in enumerate(values):
+            payload[f'{name}[{i}]'] = value
+    result = redcap_api(service, config, context, payload,
+                        loginfo or f'export {len(fields)} fields', pid)
+    result.raise_for_status()
+    return result.json()
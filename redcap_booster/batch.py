@@ -0,0 +1,147 @@
+"""Batching of record imports from concurrent triggers"""
+
+import json
+import threading
+import requests
+
+class ImportResult:
+    """Outcome of one caller's rows in a batched import
+    
+    Has the parts of a requests.Response that plugins and the dispatcher
+    use.
+    """
+    
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.text = json.dumps(data)
+        self.ok = status_code < 400
+    
+    def json(self):
+        return json.loads(self.text)
+    
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f'{self.status_code}: {self.text}',
+                                     response=self)
+
+class Batch:
+    def __init__(self):
+        self.entries = []
+        self.records = set()
+        self.size = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+class ImportBatcher:
+    """Combine record imports for one project into fewer API calls
+    
+    The first caller of a batch waits up to max_delay seconds (or until
+    max_rows rows are pending) for others, then sends all of their rows in
+    one import with send(rows). If that import fails, as REDCap rejects an
+    import as a whole, each caller's rows are sent again on their own, so
+    that every caller gets the outcome for its own rows.
+    
+    A record is only in one batch at a time: rows for a record that is in a
+    pending batch send that batch right away, and wait for it (or for one
+    being sent) to finish, so that REDCap applies writes in order.
+    """
+    
+    def __init__(self, send):
+        self.send = send
+        self.lock = threading.Lock()
+        self.batch = None
+        self.sending = set()
+        self.calls = self.imports = self.rows = self.retried = 0
+    
+    def close(self, batch):
+        # Caller holds the lock
+        if self.batch is batch:
+            self.batch = None
+            self.sending.add(batch)
+    
+    def earlier(self, records):
+        """Return a batch (pending or being sent) with any of records"""
+        # Caller holds the lock
+        for batch in (self.batch, *self.sending):
+            if batch is not None and not batch.records.isdisjoint(records):
+                return batch
+        return None
+    
+    def submit(self, rows, records, max_delay, max_rows):
+        """Import rows (dicts) for a set of records, with other callers'"""
+        with self.lock:
+            self.calls += 1
+        while True:
+            with self.lock:
+                earlier = self.earlier(records)
+                if earlier is None:
+                    batch = self.batch
+                    leader = batch is None
+                    if leader:
+                        batch = self.batch = Batch()
+                    index = len(batch.entries)
+                    batch.entries.append(rows)
+                    batch.records |= records
+                    batch.size += len(rows)
+                    if batch.size >= max_rows:
+                        self.close(batch)
+                        batch.full.set()
+                    break
+                self.close(earlier)
+                earlier.full.set()
+            earlier.done.wait()
+        
+        if leader:
+            batch.full.wait(max_delay)
+            with self.lock:
+                self.close(batch)
+            self.flush(batch)
+        else:
+            batch.done.wait()
+        
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+    
+    def flush(self, batch):
+        rows = [row for entry in batch.entries for row in entry]
+        with self.lock:
+            self.imports += 1
+            self.rows += len(rows)
+        try:
+            result = self.send(rows)
+            if len(batch.entries) == 1:
+                batch.results = [result]
+            elif result.ok:
+                batch.results = [ImportResult(result.status_code,
+                                              {'count': len(entry)})
+                                 for entry in batch.entries]
+            else:
+                with self.lock:
+                    self.imports += len(batch.entries)
+                    self.retried += len(batch.entries)
+                batch.results = [self.send(entry) for entry in batch.entries]
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self.lock:
+                self.sending.discard(batch)
+            batch.done.set()
+    
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'imports': self.imports,
+                    'rows': self.rows, 'retried': self.retried}
+
+batchers = {}
+batchers_lock = threading.Lock()
+
+def get_batcher(key, send):
+    """Return the batcher for key, creating it with send if necessary"""
+    with batchers_lock:
+        batcher = batchers.get(key)
+        if batcher is None:
+            batcher = batchers[key] = ImportBatcher(send)
+        return batcher
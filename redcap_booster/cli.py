@@ -1,11 +1,37 @@
 """CLI tools for REDCap Booster"""
 
+import asyncio
 import click
-from redcap_booster import config
+import datetime
+import json
+import sys
+import time
+from redcap_booster import config, store, jobs as job_queue
 
-plugins = config.plugins
+class LazyGroup(click.Group):
+    """Group that adds the commands of service plugins when they are used
+    
+    Plugins are only loaded to run (or list the help of) their own commands,
+    so that other commands start quickly however many services there are.
+    """
+    
+    def list_commands(self, ctx):
+        # Replace underscores with dashes for consistency with commands
+        services = [service.replace('_', '-')
+                    for service in config.plugins.list_plugins()]
+        return sorted(set(super().list_commands(ctx)) | set(services))
+    
+    def get_command(self, ctx, cmd_name):
+        command = super().get_command(ctx, cmd_name)
+        if command is not None:
+            return command
+        service = cmd_name.replace('-', '_')
+        if service not in config.plugins.list_plugins():
+            return None
+        plugin = config.plugins.load_plugin(service)
+        return getattr(plugin, 'cli', None)
 
-@click.group()
+@click.group(cls=LazyGroup)
 def cli():
     """Command line utilities for managing REDCap Booster"""
     pass
@@ -13,7 +39,7 @@ def cli():
 @click.command()
 def list_services():
     """List available services"""
-    for service in plugins.list_plugins():
+    for service in config.plugins.list_plugins():
         click.echo(f'{service}')
 
 @click.command()
@@ -24,16 +50,280 @@ def list_pids(service):
         if getattr(config.settings, f'{service}_{pid}'):
             click.echo(pid)
 
-cli.add_command(list_services)
-cli.add_command(list_pids)
+@click.group()
+def jobs():
+    """Inspect and replay background jobs"""
+    pass
+
+def _time(t):
+    return datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+@jobs.command(name='list')
+@click.option('--status', type=click.Choice([job_queue.PENDING,
+                                             job_queue.RUNNING,
+                                             job_queue.DONE,
+                                             job_queue.FAILED]),
+              help='Only list jobs with this status')
+@click.option('--pid', help='Only list jobs for this project')
+@click.option('--limit', default=50, show_default=True,
+              help='Maximum number of jobs to list')
+def list_jobs(status, pid, limit):
+    """List most recent jobs"""
+    queue = job_queue.get_queue()
+    for status_, n in sorted(queue.counts().items()):
+        click.echo(f'{status_}: {n}', err=True)
+    for job in queue.list(status, pid, limit):
+        click.echo(f"{job['id']}\t{_time(job['updated'])}\t{job['status']}\t"
+                   f"{job['service']}\t{job['project_id']}\t{job['record']}\t"
+                   f"{job['attempts']}\t{job['error'] or ''}")
+
+@jobs.command()
+@click.argument('id', type=int)
+def show(id):
+    """Show details of a job"""
+    job = job_queue.get_queue().get(id)
+    if job is None:
+        sys.exit(f'Job {id} not found')
+    job = dict(job)
+    job['context'] = json.loads(job['context'])
+    for t in ('run_at', 'created', 'updated'):
+        job[t] = _time(job[t])
+    click.echo(json.dumps(job, indent=2))
+
+@jobs.command()
+@click.argument('ids', type=int, nargs=-1)
+@click.option('--all-failed', is_flag=True, help='Replay all failed jobs')
+def replay(ids, all_failed):
+    """Requeue failed jobs
+    
+    The jobs are run by the server's workers.
+    """
+    if not ids and not all_failed:
+        sys.exit('Specify job IDs or --all-failed')
+    requeued = job_queue.get_queue().replay(ids)
+    skipped = sorted(set(ids) - set(requeued))
+    if skipped:
+        click.echo(f"Not failed, skipped: {' '.join(map(str, skipped))}",
+                   err=True)
+    click.echo(f'{len(requeued)} jobs requeued')
+
+@jobs.command()
+@click.option('--status', default=job_queue.DONE, show_default=True,
+              type=click.Choice([job_queue.DONE, job_queue.FAILED]),
+              help='Status of jobs to delete')
+@click.option('--days', default=7.0, show_default=True,
+              help='Only delete jobs last updated more than this many days ago')
+def purge(status, days):
+    """Delete old jobs"""
+    n = job_queue.get_queue().purge(status, days*86400)
+    click.echo(f'{n} jobs deleted')
+
+@click.group()
+def projects():
+    """Manage project settings in the store (config_db)
+    
+    A running server picks up changes within config_poll_interval seconds.
+    """
+    pass
 
-for service in plugins.list_plugins():
-    plugin = plugins.load_plugin(service)
+def _store():
+    if config.store is None:
+        sys.exit('No project store; set config_db in .env')
+    return config.store
+
+@projects.command(name='list')
+@click.argument('pid', required=False)
+@click.option('--show-secrets', is_flag=True,
+              help='Show API keys and tokens')
+def list_projects(pid, show_secrets):
+    """List settings of projects in the store"""
+    for pid_, name, value in _store().list(pid):
+        if name in (store.KEY, store.TOKEN) and not show_secrets:
+            value = '*' * 8
+        click.echo(f'{pid_}\t{name}\t{value}')
+
+@projects.command(name='set')
+@click.argument('pid')
+@click.argument('name')
+@click.argument('value')
+def set_project(pid, name, value):
+    """Set a setting of a project
+    
+    NAME is "key" (the project's API key), "token" (its REDCap API token),
+    or a service, in which case VALUE is the service's settings for the
+    project, as JSON (e.g., '{"form_triggers":["registration_form"]}').
+    """
+    if not pid.isdecimal():
+        sys.exit(f'Invalid PID: {pid}')
+    if name not in (store.KEY, store.TOKEN):
+        if name not in config.plugins.list_plugins():
+            sys.exit(f'Unknown service: {name}')
+        try:
+            value = json.loads(value)
+        except ValueError as e:
+            sys.exit(f'Invalid JSON for {name}: {e}')
     try:
-        # Replace underscores with dashes for consistency with commands
-        cli.add_command(plugin.cli, name=service.replace("_", "-"))
-    except AttributeError:
-        pass
+        _store().set(pid, name, value)
+    except ValueError as e:
+        sys.exit(str(e))
+
+@projects.command(name='remove')
+@click.argument('pid')
+@click.argument('name', required=False)
+def remove_project(pid, name):
+    """Remove a setting of a project, or the whole project"""
+    n = _store().remove(pid, name)
+    click.echo(f'{n} settings removed')
+
+@click.command(name='replay')
+@click.argument('pid')
+@click.argument('redcap_url')
+@click.argument('source', type=click.File('r'), required=False)
+@click.option('--report', 'report_id',
+              help='ID of a REDCap report of the records, in place of SOURCE')
+@click.option('--csv', 'is_csv', is_flag=True,
+              help='SOURCE is CSV exported from REDCap (the default for '
+                   '*.csv), rather than a list of records')
+@click.option('--record-field',
+              help='Column of records in CSV  [default: the first]')
+@click.option('--instrument', '-i', 'instruments', multiple=True,
+              help='Instrument to trigger (repeatable)  [default: every '
+                   'instrument that triggers services in the project]')
+@click.option('--service', '-s', 'services', multiple=True,
+              help='Only run this service (repeatable)')
+@click.option('--complete', type=click.Choice(['0', '1', '2']),
+              help='Form status to send where the input has none')
+@click.option('--workers', default=8, show_default=True,
+              help='Number of triggers to run at the same time')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File in which to record progress; if it exists, skip '
+                   'triggers replayed by the previous run')
+@click.option('--dry-run', is_flag=True,
+              help='List the triggers and their services without running '
+                   'them')
+def replay_triggers(pid, redcap_url, source, report_id, is_csv, record_field,
+                    instruments, services, complete, workers, checkpoint,
+                    dry_run):
+    """Replay Data Entry Triggers for existing records
+    
+    Runs the services for each record in SOURCE (one per line, or CSV with
+    the event and repeat instance of each row, as exported from REDCap) or
+    in a REDCap report, as if each instrument had been saved. Triggers are
+    run in this process, through the same routes as triggers received by the
+    server; duplicates are skipped.
+    """
+    # Not needed by other commands
+    from redcap_booster import logs, replay
+    from redcap_booster.routing import router
+    
+    if pid not in config.settings.pids:
+        sys.exit(f'Project {pid} is not configured')
+    routed = router.instruments(pid, services or None)
+    if instruments:
+        instruments = [i for i in instruments if i in routed]
+    else:
+        instruments = routed
+    if not instruments:
+        sys.exit(f'No instruments trigger services in project {pid}')
+    
+    if source is None and not report_id:
+        sys.exit('Specify SOURCE or --report')
+    try:
+        if report_id:
+            rows = replay.read_csv(
+                replay.export_report(pid, redcap_url, report_id),
+                record_field)
+        elif is_csv or record_field or source.name.endswith('.csv'):
+            rows = replay.read_csv(source, record_field)
+        else:
+            rows = replay.read_list(source)
+        triggers = list(replay.contexts(pid, redcap_url, rows, instruments,
+                                        complete))
+        done = replay.Checkpoint(checkpoint, pid) if checkpoint else None
+    except ValueError as e:
+        sys.exit(str(e))
+    total = len(triggers)
+    if done and done.done:
+        triggers = [t for t in triggers if t[0] not in done.done]
+        click.echo(f'Skipping {total - len(triggers)} triggers already '
+                   f'replayed', err=True)
+    
+    if dry_run:
+        for (record, instrument, event, instance), context in triggers:
+            matched = [r.service for r in router.match(pid, instrument)
+                       if not services or r.service in services]
+            click.echo(f"{record}\t{instrument}\t{event or ''}\t"
+                       f"{instance or ''}\t{','.join(matched)}")
+        click.echo(f'{len(triggers)} triggers to replay', err=True)
+        return
+    
+    logs.setup('request', config.settings.request_log)
+    start = last = time.monotonic()
+    
+    def progress(counts, every=1.0):
+        nonlocal last
+        if time.monotonic() - last >= every:
+            last = time.monotonic()
+            click.echo(f"{counts['done']} of {len(triggers)} triggers "
+                       f"replayed, {counts['failed']} failed", err=True)
+    
+    try:
+        counts = asyncio.run(replay.replay(triggers, workers,
+                                           services or None, progress, done))
+    finally:
+        if done:
+            done.close()
+    elapsed = time.monotonic() - start
+    
+    if counts['failed']:
+        sys.exit(f"{counts['failed']} triggers failed (see the request log)" +
+                 (f'; rerun to retry them from "{checkpoint}"'
+                  if checkpoint else ''))
+    if done:
+        done.remove()
+    click.echo(f"{counts['done']} triggers replayed in {elapsed:.1f}s")
+
+@click.command()
+@click.argument('pid')
+@click.argument('redcap_url')
+@click.option('--refresh', is_flag=True,
+              help='Fetch from REDCap even if cached metadata is fresh')
+@click.option('--fields', is_flag=True, help='List the data dictionary')
+def metadata(pid, redcap_url, refresh, fields):
+    """Show the cached metadata of a project
+    
+    With --refresh, e.g., after changing the project's data dictionary, the
+    metadata saved for the server (in metadata_dir) is updated; running
+    servers use it once their copy expires (metadata_ttl).
+    """
+    from redcap_booster.metadata import get_cache
+    
+    try:
+        m = get_cache().get(redcap_url, pid, refresh)
+    except Exception as e:
+        sys.exit(f'Fetching metadata failed: {e}')
+    if fields:
+        for field in m.fields:
+            click.echo(f"{field['field_name']}\t{field['form_name']}\t"
+                       f"{field['field_type']}")
+        return
+    click.echo(json.dumps({
+        'title': m.project.get('project_title'),
+        'fetched': _time(m.fetched),
+        'record_id': m.record_id,
+        'fields': len(m.fields),
+        'forms': m.forms,
+        'events': {event: forms for event, forms in m.event_forms.items()},
+        'repeating': [{'event': r.get('event_name') or None,
+                       'form': r.get('form_name') or None}
+                      for r in m.repeating]}, indent=2))
+
+cli.add_command(list_services)
+cli.add_command(list_pids)
+cli.add_command(jobs)
+cli.add_command(projects)
+cli.add_command(replay_triggers)
+cli.add_command(metadata)
 
 if __name__ == '__main__':
     cli()
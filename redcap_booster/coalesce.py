@@ -0,0 +1,67 @@
+"""Coalescing of repeated triggers for the same record"""
+
+import asyncio
+from redcap_booster import config
+
+class Batch:
+    def __init__(self, context):
+        self.context = context
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+
+class Coalescer:
+    """Merge bursts of triggers for the same (project, record, instrument)
+    
+    A trigger's services run debounce_window seconds after it arrives;
+    triggers for the same key that arrive in the meantime replace its context
+    and share its outcome. Triggers that arrive while the services are
+    running are merged into a single follow-up run, with the latest context.
+    """
+    
+    def __init__(self):
+        self.waiting = {}
+        self.running = {}
+        self.triggers = self.runs = self.coalesced = 0
+    
+    async def submit(self, key, context, run):
+        """Run run(context) for key, or join a pending run; return its result"""
+        self.triggers += 1
+        batch = self.waiting.get(key)
+        if batch is None:
+            batch = self.waiting[key] = Batch(context)
+            batch.task = asyncio.ensure_future(self.start(key, batch, run))
+        else:
+            batch.context = context
+            self.coalesced += 1
+        
+        # A disconnected client doesn't cancel the run others are waiting on
+        return await asyncio.shield(batch.future)
+    
+    async def start(self, key, batch, run):
+        await asyncio.sleep(config.settings.debounce_window)
+        
+        # Services don't run twice at once for the same key; triggers keep
+        # joining this batch until the previous run has finished
+        previous = self.running.get(key)
+        if previous is not None:
+            await asyncio.wait([previous.future])
+        
+        del self.waiting[key]
+        self.running[key] = batch
+        self.runs += 1
+        try:
+            batch.future.set_result(await run(batch.context))
+        except Exception as e:
+            batch.future.set_exception(e)
+        finally:
+            if self.running.get(key) is batch:
+                del self.running[key]
+    
+    def stats(self):
+        return {'triggers': self.triggers,
+                'runs': self.runs,
+                'coalesced': self.coalesced,
+                'waiting': len(self.waiting),
+                'running': len(self.running)}
+
+coalescer = Coalescer()
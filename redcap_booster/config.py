@@ -1,6 +1,11 @@
 from typing import List
-from pydantic import BaseSettings, create_model
+from pydantic import BaseSettings
+from pydantic.env_settings import SettingsError
 from pluginbase import PluginBase
+from redcap_booster.store import ConfigStore
+import dotenv
+import io
+import json
 import os
 
 # Global settings (i.e., not service-specific)
@@ -14,40 +19,257 @@ class Settings(BaseSettings):
     redcap_log: str = './log/redcap.log'
     box_log: str = './log/box.log'
     
+    # Logs are written as JSON lines ("json") or as text ("text"), with the
+    # values of these fields redacted wherever they appear
+    log_format: str = 'json'
+    log_redact: list = ['token', 'username', 'password']
+    # Fraction of records to keep for high-volume messages, e.g.,
+    # {"trigger": 0.1, "redcap response": 0.1}
+    log_sampling: dict = {}
+    log_queue_size: int = 10000
+    
+    # REDCap API client (one connection pool per REDCap server)
+    redcap_timeout: float = 30.0
+    redcap_connect_timeout: float = 5.0
+    redcap_retries: int = 3
+    redcap_backoff: float = 0.5
+    redcap_pool_size: int = 10
+    
+    # Calls per second allowed per API token, in bursts of up to
+    # redcap_burst; 0 for no limit. Shared by all processes (gunicorn workers
+    # and rbutils commands) through redcap_rate_db, or if that is empty,
+    # applied in each process separately
+    redcap_rate: float = 0.0
+    redcap_burst: int = 10
+    redcap_rate_db: str = './limits.db'
+    # Adapt the number of concurrent calls to a server (up to
+    # redcap_pool_size) to errors and to latency, taking responses more than
+    # redcap_latency_tolerance times slower than usual (0 to ignore latency)
+    # as a sign of overload
+    redcap_adaptive: bool = True
+    redcap_latency_tolerance: float = 3.0
+    
+    # Combine record imports for the same project made within this many
+    # seconds (up to redcap_batch_rows rows) into one API call; 0 to disable
+    redcap_batch_delay: float = 0.0
+    redcap_batch_rows: int = 100
+    
+    # Project metadata (project info, data dictionary, events) fetched for
+    # plugins is reused for metadata_ttl seconds, and saved in metadata_dir
+    # for other processes ('' to keep it in memory only)
+    metadata_ttl: float = 3600.0
+    metadata_dir: str = './metadata'
+    
+    # Default time limit (seconds) for a service to handle a trigger; plugins
+    # may set their own with a module-level timeout
+    plugin_timeout: float = 60.0
+    
+    # Seconds to wait for further saves of a form before running its
+    # services, so that a burst of saves runs them once; 0 to disable
+    debounce_window: float = 0.0
+    
+    # Background job queue; when enabled, triggers are queued and plugins run
+    # in worker threads after the response has been sent
+    job_queue: bool = False
+    job_db: str = './jobs.db'
+    job_workers: int = 2
+    job_max_attempts: int = 5
+    job_backoff: float = 10.0
+    job_poll_interval: float = 1.0
+    
+    # Key for administrative endpoints (e.g., /reload); disabled if empty
+    admin_key: str = ''
+    
+    # SQLite database of further project settings (see rbutils projects),
+    # which the server checks for changes every config_poll_interval seconds
+    config_db: str = ''
+    config_poll_interval: float = 5.0
+    
     class Config:
         env_file = '.env'
         # For storing REDCap API tokens
         secrets_dir = './.secrets'
+
+class LazySettings:
+    """Global settings, plus project and service settings read on first use
+    
+    Besides the fields of Settings, these are available:
+    
+    - key_[pid]: API key for project pid (e.g., as generated by
+      secrets.token_urlsafe(24))
+    - token_[pid]: REDCap API token for project pid, usually stored in a file
+      in secrets_dir named token_[pid]
+    - [service]: service-specific settings (a dict)
+    - [service]_[pid]: service-specific settings for project pid (a dict)
+    
+    They are looked up as pydantic would (environment, then .env, then
+    secrets_dir), but only when first accessed, so that startup doesn't
+    depend on the number of projects and services. Settings in the project
+    store, if any, take precedence, and its projects are added to pids.
+    """
     
-    @classmethod
-    def with_services(cls, **field_defs):
-        return create_model('FullSettings', __base__=cls, **field_defs)
+    def __init__(self, base, source, env, store=None):
+        object.__setattr__(self, '_base', base)
+        object.__setattr__(self, '_source', source)
+        object.__setattr__(self, '_store', store)
+        object.__setattr__(self, '_values', {})
+        object.__setattr__(self, '_env', env)
+        object.__setattr__(self, '_secrets', None)
+        object.__setattr__(self, '_services', None)
+        object.__setattr__(self, '_pids', None)
+    
+    def __getattr__(self, name):
+        # Only called for names that aren't attributes of this object
+        if name.startswith('_'):
+            raise AttributeError(name)
+        store = self._store
+        if store is not None:
+            if name == 'pids':
+                return self._projects()[0]
+            value = store.snapshot.values.get(name)
+            if value is not None:
+                return value
+        if name in self._base.__fields__:
+            return getattr(self._base, name)
+        values = self._values
+        if name in values:
+            return values[name]
+        if not self._defined(name):
+            raise AttributeError(name)
+        
+        value = self._lookup(name)
+        if name.startswith(('key_', 'token_')):
+            value = '' if value is None else value
+        elif value is None:
+            value = {}
+        else:
+            try:
+                value = json.loads(value)
+            except ValueError as e:
+                raise SettingsError(f'error parsing JSON for "{name}"') from e
+            if not isinstance(value, dict):
+                raise SettingsError(f'"{name}" is not a JSON object')
+        values[name] = value
+        return value
+    
+    def __setattr__(self, name, value):
+        if name in self._base.__fields__:
+            setattr(self._base, name, value)
+        else:
+            self._values[name] = value
+    
+    def __delattr__(self, name):
+        self._values.pop(name, None)
+    
+    def _projects(self):
+        # The list and set of project IDs, rebuilt when either source changes
+        pids = self._base.pids
+        snapshot = self._store.snapshot if self._store is not None else None
+        cached = self._pids
+        if (cached is None or cached[0] is not pids
+                or cached[1] is not snapshot):
+            merged = list(pids)
+            if snapshot is not None:
+                known = set(pids)
+                merged += [pid for pid in snapshot.pids if pid not in known]
+            cached = (pids, snapshot, merged, frozenset(merged))
+            object.__setattr__(self, '_pids', cached)
+        return cached[2], cached[3]
+    
+    def _defined(self, name):
+        pids = self._projects()[1]
+        for prefix in ('key_', 'token_'):
+            if name.startswith(prefix) and name[len(prefix):] in pids:
+                return True
+        services = self.services
+        if name in services:
+            return True
+        service, _, pid = name.rpartition('_')
+        return service in services and pid in pids
+    
+    @property
+    def services(self):
+        """Names of available services (plugins)"""
+        if self._services is None:
+            object.__setattr__(self, '_services',
+                               frozenset(self._source.list_plugins()))
+        return self._services
+    
+    def _lookup(self, name):
+        value = self._env.get(name)
+        if value is not None:
+            return value
+        
+        # Only list secrets_dir here; a file is read when its setting is used
+        if self._secrets is None:
+            secrets_dir = self._base.__config__.secrets_dir
+            try:
+                secrets = {entry.name.lower(): entry.path
+                           for entry in os.scandir(secrets_dir)
+                           if entry.is_file()}
+            except (FileNotFoundError, TypeError):
+                secrets = {}
+            object.__setattr__(self, '_secrets', secrets)
+        path = self._secrets.get(name)
+        if path is not None:
+            with open(path) as f:
+                return f.read().strip()
+        return None
 
-# Available services provided via plugins
-settings = Settings()
 app_path = os.path.abspath(os.path.dirname(__file__))
 plugin_base = PluginBase(package='plugins',
                          searchpath=[os.path.join(app_path,'services')])
-plugins = plugin_base.make_plugin_source(searchpath=settings.plugin_dirs)
 
-# API keys (project specific)
-# E.g., as generated by secrets.token_urlsafe(24)
-field_defs = {}
-for pid in settings.pids:
-    field_defs[f'key_{pid}'] = (str, '')
-
-# REDCap API tokens
-# Create file in secrets_dir named token_[pid] containing API token for project
-for pid in settings.pids:
-    field_defs[f'token_{pid}'] = (str, '')
-
-# Service-specific settings
-for service in plugins.list_plugins():
-    field_defs[f'{service}'] = (dict, {})
-
-# Service-specific settings for each project
-for service in plugins.list_plugins():
-    for pid in settings.pids:
-        field_defs[f'{service}_{pid}'] = (dict, {})
+def load():
+    """Read settings and find available services
+    
+    Called on import, and again to pick up changes to .env, secrets or
+    plugin directories without restarting. Project and service settings are
+    read, and plugins listed, only when first needed.
+    """
+    global settings, plugins, store
+    
+    # .env is parsed once, here, rather than by pydantic too, as it may be
+    # long; environment variables take precedence, and names are
+    # case-insensitive, as in pydantic
+    env, env_file = {}, Settings.__config__.env_file
+    if env_file and os.path.isfile(env_file):
+        with open(env_file) as f:
+            text = f.read()
+        # Interpolation is slow, and only matters for values with ${...}
+        values = dotenv.dotenv_values(stream=io.StringIO(text),
+                                      interpolate='$' in text)
+        env.update((k.lower(), v) for k, v in values.items() if v is not None)
+    environ = {k.lower(): v for k, v in os.environ.items()}
+    from_file = {}
+    for name, field in Settings.__fields__.items():
+        if name in env and name not in environ:
+            value = env[name]
+            try:
+                from_file[name] = (json.loads(value) if field.is_complex()
+                                   else value)
+            except ValueError as e:
+                raise SettingsError(f'error parsing JSON for "{name}"') from e
+    env.update(environ)
+    base = Settings(_env_file=None, **from_file)
+    # Persist, since pluginbase otherwise clears the modules of a replaced
+    # source while requests may still be running them
+    source = plugin_base.make_plugin_source(searchpath=base.plugin_dirs,
+                                            persist=True)
+    
+    # The store is kept across reloads, as the server may be watching it
+    if not base.config_db:
+        store = None
+    elif store is None or store.db != base.config_db:
+        store = ConfigStore(base.config_db)
+    else:
+        store.refresh()
+    
+    plugins = source
+    settings = LazySettings(base, source, env, store)
+    return settings
 
-settings = Settings.with_services(**field_defs)()
+settings = None
+plugins = None
+store = None
+load()
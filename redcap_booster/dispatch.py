@@ -0,0 +1,71 @@
+"""Running the services matched by a trigger"""
+
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from redcap_booster import config, logs, metrics
+
+logger = logging.getLogger('request')
+
+Result = namedtuple('Result', ['service', 'ok', 'elapsed', 'value', 'error'])
+
+async def run_route(route, context):
+    """Run one service, never raising; return its Result"""
+    
+    timeout = route.timeout or config.settings.plugin_timeout or None
+    start = time.perf_counter()
+    try:
+        value = await asyncio.wait_for(route.run(config, context), timeout)
+    except asyncio.TimeoutError:
+        result = Result(route.service, False, time.perf_counter()-start, None,
+                        f'timed out after {timeout}s')
+    except Exception as e:
+        logger.exception(f"{route.service}: PID {context.get('project_id')}: "
+                         f"record {context.get('record')}: failed")
+        result = Result(route.service, False, time.perf_counter()-start, None,
+                        repr(e))
+    else:
+        # Plugins return the REDCap API response (if any) of their write-back
+        ok = getattr(value, 'ok', True) if value is not None else True
+        error = None if ok else f'REDCap API returned {value.status_code}'
+        result = Result(route.service, ok, time.perf_counter()-start, value,
+                        error)
+    
+    metrics.service_seconds.observe(
+        result.elapsed, project=context.get('project_id'),
+        instrument=context.get('instrument'), service=result.service,
+        outcome=outcome(result))
+    logger.info('service', extra=logs.fields(
+        service=result.service, pid=context.get('project_id'),
+        record=context.get('record'), ok=result.ok,
+        elapsed=round(result.elapsed, 3), error=result.error))
+    return result
+
+def outcome(result):
+    if result.ok:
+        return 'ok'
+    return 'timeout' if result.error.startswith('timed out') else 'failed'
+
+async def run_serial(routes, context):
+    return [await run_route(route, context) for route in routes]
+
+async def dispatch(routes, context):
+    """Run all services for a trigger and return their Results
+    
+    Services that are async or declared thread-safe run concurrently with
+    each other; the rest run one at a time, alongside them. A service that
+    fails or times out does not affect the others.
+    """
+    
+    concurrent = [r for r in routes if r.concurrent]
+    serial = [r for r in routes if not r.concurrent]
+    
+    if not serial:
+        return list(await asyncio.gather(*(run_route(r, context)
+                                           for r in concurrent)))
+    
+    *results, serial_results = await asyncio.gather(
+        *(run_route(r, context) for r in concurrent),
+        run_serial(serial, context))
+    return results + serial_results
@@ -0,0 +1,283 @@
+"""Durable background queue for plugin runs
+
+Each Data Entry Trigger is stored as one job per matching service in a SQLite
+database; worker threads claim jobs, run the plugin, and retry failures with
+exponential backoff. Claims are atomic, so several server processes may share
+the same queue.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from redcap_booster import config, metrics, routing
+
+logger = logging.getLogger('request')
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+class JobQueue:
+    """Manage access to the job database"""
+    
+    def __init__(self, db, max_attempts=5, backoff=10.0, max_backoff=3600.0):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.local = threading.local()
+        self.wakeup = threading.Event()
+        self.coalesced = 0
+        self.create_table()
+    
+    @property
+    def con(self):
+        # One connection per thread; transactions are managed explicitly
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.db, timeout=30, isolation_level=None)
+            con.row_factory = sqlite3.Row
+            con.execute('PRAGMA journal_mode=WAL')
+            self.local.con = con
+        return con
+    
+    def create_table(self):
+        self.con.execute('CREATE TABLE IF NOT EXISTS jobs (\n'
+                         '    id INTEGER PRIMARY KEY,\n'
+                         '    service TEXT NOT NULL,\n'
+                         '    project_id TEXT NOT NULL,\n'
+                         '    record TEXT,\n'
+                         '    context TEXT NOT NULL,\n'
+                         '    status TEXT NOT NULL,\n'
+                         '    attempts INTEGER NOT NULL DEFAULT 0,\n'
+                         '    run_at REAL NOT NULL,\n'
+                         '    created REAL NOT NULL,\n'
+                         '    updated REAL NOT NULL,\n'
+                         '    error TEXT\n'
+                         ')')
+        self.con.execute('CREATE INDEX IF NOT EXISTS jobs_status '
+                         'ON jobs (status, run_at)')
+    
+    def enqueue(self, services, context, delay=0.0):
+        """Add one job per service for a trigger; return the job IDs
+        
+        With a delay, jobs wait that long before they run, and a trigger for
+        a record and instrument that already has a job waiting to run for
+        the first time updates that job's context instead of adding another.
+        """
+        
+        now = time.time()
+        context = dict(context)
+        data = json.dumps(context, separators=(',',':'))
+        ids = []
+        
+        con = self.con
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            for service in services:
+                row = None
+                if delay:
+                    row = con.execute(
+                        'UPDATE jobs SET context=?, updated=? '
+                        'WHERE id=(SELECT id FROM jobs WHERE status=? '
+                        '          AND attempts=0 AND service=? '
+                        '          AND project_id=? AND record IS ? '
+                        "          AND json_extract(context, '$.instrument') IS ? "
+                        '          LIMIT 1) '
+                        'RETURNING id',
+                        (data, now, PENDING, service, context['project_id'],
+                         context.get('record'),
+                         context.get('instrument'))).fetchone()
+                if row:
+                    self.coalesced += 1
+                    ids.append(row[0])
+                    continue
+                cur = con.execute(
+                    'INSERT INTO jobs (service, project_id, record, context, '
+                    'status, run_at, created, updated) '
+                    'VALUES (?,?,?,?,?,?,?,?)',
+                    (service, context['project_id'], context.get('record'),
+                     data, PENDING, now + delay, now, now))
+                ids.append(cur.lastrowid)
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        
+        self.wakeup.set()
+        return ids
+    
+    def claim(self):
+        """Mark the next due job as running and return it (or None)"""
+        
+        now = time.time()
+        return self.con.execute(
+            'UPDATE jobs SET status=?, attempts=attempts+1, updated=? '
+            'WHERE id=(SELECT id FROM jobs WHERE status=? AND run_at<=? '
+            '          ORDER BY run_at, id LIMIT 1) '
+            'RETURNING id, service, context, attempts',
+            (RUNNING, now, PENDING, now)).fetchone()
+    
+    def complete(self, id):
+        self.con.execute('UPDATE jobs SET status=?, updated=?, error=NULL '
+                         'WHERE id=?', (DONE, time.time(), id))
+    
+    def fail(self, id, attempts, error):
+        """Reschedule a job with backoff, or mark it failed for good"""
+        
+        now = time.time()
+        if attempts >= self.max_attempts:
+            status, run_at = FAILED, now
+        else:
+            status = PENDING
+            run_at = now + min(self.backoff * 2 ** (attempts-1),
+                               self.max_backoff)
+        self.con.execute('UPDATE jobs SET status=?, run_at=?, updated=?, '
+                         'error=? WHERE id=?',
+                         (status, run_at, now, error, id))
+        return status
+    
+    def recover(self, stale=600.0):
+        """Requeue jobs left running by a worker that died"""
+        cur = self.con.execute('UPDATE jobs SET status=?, run_at=? '
+                               'WHERE status=? AND updated<?',
+                               (PENDING, time.time(), RUNNING,
+                                time.time()-stale))
+        return cur.rowcount
+    
+    def list(self, status=None, pid=None, limit=50):
+        q = 'SELECT * FROM jobs WHERE 1=1'
+        args = []
+        if status:
+            q += ' AND status=?'
+            args.append(status)
+        if pid:
+            q += ' AND project_id=?'
+            args.append(pid)
+        q += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit)
+        return self.con.execute(q, args).fetchall()
+    
+    def get(self, id):
+        return self.con.execute('SELECT * FROM jobs WHERE id=?',
+                                (id,)).fetchone()
+    
+    def counts(self):
+        return dict(self.con.execute('SELECT status, count(*) FROM jobs '
+                                     'GROUP BY status').fetchall())
+    
+    def replay(self, ids=None, status=FAILED):
+        """Requeue jobs with the given status (of ids, if given)
+        
+        Returns the IDs of the jobs requeued; others, such as jobs that are
+        running or done, are left alone.
+        """
+        
+        now = time.time()
+        q = ('UPDATE jobs SET status=?, attempts=0, run_at=?, updated=? '
+             'WHERE status=?')
+        args = [PENDING, now, now, status]
+        if ids:
+            q += f" AND id IN ({','.join('?' * len(ids))})"
+            args.extend(ids)
+        requeued = [row[0] for row in
+                    self.con.execute(q + ' RETURNING id', args).fetchall()]
+        self.wakeup.set()
+        return requeued
+    
+    def purge(self, status=DONE, older_than=0.0):
+        cur = self.con.execute('DELETE FROM jobs WHERE status=? AND updated<?',
+                               (status, time.time()-older_than))
+        return cur.rowcount
+    
+    def close(self):
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            con.close()
+            self.local.con = None
+
+def run_job(service, context):
+    """Run a service for a trigger context; raise if it did not succeed"""
+    
+    result = routing.router.plugin(service).run_sync(config, context)
+    
+    # Plugins return the REDCap API response (if any) of their write-back
+    if result is not None and not getattr(result, 'ok', True):
+        raise RuntimeError(f'REDCap API returned {result.status_code}: '
+                           f'{result.text[:200]}')
+    return result
+
+class Worker(threading.Thread):
+    """Thread that pulls jobs from the queue until stopped"""
+    
+    def __init__(self, queue, stopping, poll_interval=1.0):
+        super().__init__(daemon=True, name='job-worker')
+        self.queue = queue
+        self.stopping = stopping
+        self.poll_interval = poll_interval
+    
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.claim()
+            except sqlite3.OperationalError as e:
+                logger.warning(f'Job queue unavailable: {e}')
+                job = None
+            
+            if job is None:
+                self.queue.wakeup.wait(self.poll_interval)
+                self.queue.wakeup.clear()
+                continue
+            
+            context = json.loads(job['context'])
+            start = time.perf_counter()
+            try:
+                run_job(job['service'], context)
+            except Exception as e:
+                outcome = 'failed'
+                status = self.queue.fail(job['id'], job['attempts'], repr(e))
+                logger.warning(f"Job {job['id']} ({job['service']}, PID "
+                               f"{context.get('project_id')}): {e!r}; "
+                               f"{status}")
+            else:
+                outcome = 'ok'
+                self.queue.complete(job['id'])
+            metrics.service_seconds.observe(
+                time.perf_counter()-start, project=context.get('project_id'),
+                instrument=context.get('instrument'), service=job['service'],
+                outcome=outcome)
+        
+        self.queue.close()
+
+_queue = None
+_lock = threading.Lock()
+
+def get_queue():
+    """Return the job queue configured in settings"""
+    
+    global _queue
+    with _lock:
+        if _queue is None:
+            s = config.settings
+            _queue = JobQueue(s.job_db, max_attempts=s.job_max_attempts,
+                              backoff=s.job_backoff)
+    return _queue
+
+def start_workers():
+    """Start the configured number of worker threads; return a stop function"""
+    
+    queue = get_queue()
+    queue.recover()
+    stopping = threading.Event()
+    workers = [Worker(queue, stopping, config.settings.job_poll_interval)
+               for _ in range(config.settings.job_workers)]
+    for worker in workers:
+        worker.start()
+    
+    def stop(timeout=10.0):
+        stopping.set()
+        queue.wakeup.set()
+        for worker in workers:
+            worker.join(timeout)
+    
+    return stop
@@ -0,0 +1,268 @@
+"""Rate and concurrency limits for calls to a REDCap server
+
+Every call to a server, from any plugin or command in the process, goes
+through its Limiter: first a token bucket for the API token (REDCap limits
+API calls per user), then a limit on concurrent calls to the server, which
+adapts to how the server is coping. It grows by about one call per round of
+fast, successful responses, and halves on errors, throttling (429) or
+responses much slower than usual (additive increase, multiplicative
+decrease). A Retry-After header pauses all calls to the server.
+
+The token buckets may be kept in a SQLite database, so that every process
+using it (gunicorn workers and rbutils commands) shares one rate per token.
+The concurrency limit is always per process.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib3.util.retry import Retry
+from redcap_booster import metrics
+
+# Responses that mean the server is overloaded
+OVERLOAD_STATUS = (429, 500, 502, 503, 504)
+
+def parse_retry_after(value):
+    """Return seconds to wait from a Retry-After header, or None"""
+    if not value:
+        return None
+    try:
+        if value.strip().isdigit():
+            return int(value)
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Allow rate calls per second on average, in bursts of up to burst"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Take a token, waiting for one if necessary; return seconds waited"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative: each caller waits its turn, in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class SharedTokenBucket:
+    """TokenBucket kept in a SQLite database, shared between processes"""
+    
+    def __init__(self, db, key, rate, burst):
+        self.db = db
+        self.key = key
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.local = threading.local()
+    
+    @property
+    def con(self):
+        # One connection per thread; transactions are managed explicitly
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.db, timeout=30, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS buckets (\n'
+                        '    key TEXT PRIMARY KEY,\n'
+                        '    tokens REAL NOT NULL,\n'
+                        '    updated REAL NOT NULL\n'
+                        ')')
+            self.local.con = con
+        return con
+    
+    def acquire(self):
+        """Take a token, waiting for one if necessary; return seconds waited"""
+        con = self.con
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            row = con.execute('SELECT tokens, updated FROM buckets '
+                              'WHERE key=?', (self.key,)).fetchone()
+            now = time.time()
+            if row is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst,
+                             row[0] + max(now - row[1], 0) * self.rate)
+            tokens -= 1
+            con.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) '
+                        'VALUES (?,?,?)', (self.key, tokens, now))
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class AdaptiveLimit:
+    """Limit on concurrent calls, adjusted as responses arrive
+    
+    Latency is compared, for each kind of call, with a baseline that drops
+    to the fastest response seen and moves up a fraction drift of the way
+    to each slower one, so that it follows a server that has become slower
+    overall within a few responses; a response more than tolerance times
+    slower than the baseline counts as a sign of overload. The limit
+    decreases at most once per round trip, as the responses to calls made
+    before a decrease would otherwise decrease it again.
+    """
+    
+    def __init__(self, maximum, minimum=1, tolerance=3.0, decrease=0.5,
+                 adaptive=True, drift=0.1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.adaptive = adaptive
+        self.drift = drift
+        self.limit = float(maximum)
+        self.active = 0
+        self.paused_until = 0.0
+        self.decreased = 0.0
+        self.latency = 0.0
+        self.baselines = {}
+        self.cond = threading.Condition()
+    
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                elif self.active < int(self.limit):
+                    self.active += 1
+                    return
+                else:
+                    self.cond.wait()
+    
+    def release(self, kind=None, latency=None, overload=False):
+        with self.cond:
+            self.active -= 1
+            if self.adaptive:
+                self.adjust(kind, latency, overload)
+            self.cond.notify_all()
+    
+    def adjust(self, kind, latency, overload):
+        # Caller holds the lock
+        if latency is not None:
+            self.latency = latency
+        if latency is not None and not overload:
+            baseline = self.baselines.get(kind)
+            if baseline is None or latency < baseline:
+                baseline = latency
+            else:
+                # Drift up, in case the server has become slower
+                baseline += (latency - baseline) * self.drift
+            self.baselines[kind] = baseline
+            if self.tolerance and latency > baseline * self.tolerance:
+                overload = True
+        
+        now = time.monotonic()
+        if overload:
+            if now - self.decreased > self.latency:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.decreased = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+    
+    def pause(self, seconds):
+        """Hold back new calls for some seconds (e.g., for Retry-After)"""
+        with self.cond:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+            if self.adaptive:
+                self.adjust(None, None, True)
+
+class Limiter:
+    """Limits on calls to one REDCap server, shared within the process
+    
+    With db, the rate per token is shared with other processes using the
+    same database.
+    """
+    
+    def __init__(self, server, max_concurrency, rate=0.0, burst=10,
+                 adaptive=True, tolerance=3.0, db=None):
+        self.server = server
+        self.rate = rate
+        self.burst = burst
+        self.db = db
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.concurrency = AdaptiveLimit(max_concurrency, tolerance=tolerance,
+                                         adaptive=adaptive)
+        metrics.redcap_concurrency.set(max_concurrency, server=server)
+    
+    def bucket(self, token):
+        bucket = self.buckets.get(token)
+        if bucket is None:
+            if self.db:
+                # The token itself isn't stored
+                key = hashlib.sha256(
+                    f'{self.server}|{token}'.encode()).hexdigest()
+                new = SharedTokenBucket(self.db, key, self.rate, self.burst)
+            else:
+                new = TokenBucket(self.rate, self.burst)
+            with self.lock:
+                bucket = self.buckets.setdefault(token, new)
+        return bucket
+    
+    def acquire(self, token=None):
+        """Wait until a call may be made with token"""
+        with metrics.stage('redcap_wait'):
+            if self.rate:
+                self.bucket(token).acquire()
+            self.concurrency.acquire()
+    
+    def release(self, kind=None, response=None):
+        """Record the outcome of a call; response is None if it failed"""
+        if response is None:
+            latency, overload = None, True
+        else:
+            latency = response.elapsed.total_seconds()
+            # Retried responses (see LimitedRetry) were overloaded too
+            retries = getattr(response.raw, 'retries', None)
+            overload = (response.status_code in OVERLOAD_STATUS
+                        or bool(retries is not None and retries.history))
+            # Retries exhausted, or not retried
+            if response.status_code in (429, 503):
+                seconds = parse_retry_after(
+                    response.headers.get('Retry-After'))
+                if seconds:
+                    self.pause(seconds)
+        self.concurrency.release(kind, latency, overload)
+        metrics.redcap_concurrency.set(int(self.concurrency.limit),
+                                       server=self.server)
+    
+    def pause(self, seconds):
+        metrics.redcap_throttled.inc(server=self.server)
+        self.concurrency.pause(seconds)
+
+class LimitedRetry(Retry):
+    """Retry that also holds back other calls to the server for Retry-After"""
+    
+    limiter = None
+    
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.limiter = self.limiter
+        return retry
+    
+    def sleep_for_retry(self, response=None):
+        retry_after = self.get_retry_after(response)
+        if retry_after and self.limiter is not None:
+            self.limiter.pause(retry_after)
+        return super().sleep_for_retry(response)
@@ -0,0 +1,215 @@
+"""Logging to files through a background thread
+
+Log calls only put the record on a queue; formatting (as JSON lines, with
+sensitive fields redacted) and writing happen in a listener thread, so
+that disk I/O doesn't hold up the event loop. Structured fields are passed
+with extra=fields(...).
+"""
+
+import atexit
+import json
+import logging
+import os
+import pathlib
+import queue
+import random
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from redcap_booster import config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+REDACTED = '[redacted]'
+
+def fields(**kwargs):
+    """Structured fields for a log record, e.g., extra=fields(record=r)"""
+    return {'fields': kwargs}
+
+class Redactor:
+    """Replace the values of sensitive keys, at any depth
+    
+    Strings holding JSON (e.g., the data of a REDCap import) are searched
+    too.
+    """
+    
+    def __init__(self, keys):
+        self.keys = {key.lower() for key in keys}
+    
+    def __call__(self, value):
+        if isinstance(value, Mapping):
+            return {key: REDACTED if str(key).lower() in self.keys
+                    else self(item) for key, item in value.items()}
+        elif isinstance(value, (list, tuple)):
+            return [self(item) for item in value]
+        elif isinstance(value, str) and value[:1] in ('[', '{'):
+            try:
+                parsed = json.loads(value)
+            except ValueError:
+                return value
+            return json.dumps(self(parsed), separators=(',',':'))
+        return value
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+    
+    def __init__(self, redact):
+        super().__init__()
+        self.redact = redact
+    
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc)
+                         .isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'process': record.process,
+                 'message': record.getMessage()}
+        entry.update(self.redact(getattr(record, 'fields', {})))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Format records as text, as before, with any fields as JSON"""
+    
+    def __init__(self, redact):
+        super().__init__('%(asctime)s: %(message)s')
+        self.redact = redact
+    
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ': ' + json.dumps(self.redact(fields), default=str)
+        return text
+
+class Sampler(logging.Filter):
+    """Keep only a fraction of records with the given messages
+    
+    Warnings and errors are always kept.
+    """
+    
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+    
+    def filter(self, record):
+        rate = self.rates.get(record.msg)
+        return (rate is None or record.levelno >= logging.WARNING
+                or random.random() < rate)
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that several processes may share
+    
+    Writes and rollovers hold a lock on a companion .lock file, and a process
+    reopens the log if another process has rotated it, so gunicorn workers
+    can share one log.
+    """
+    
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = None
+        self.pid = None
+    
+    def emit(self, record):
+        if fcntl is None:
+            return super().emit(record)
+        
+        # A lock is held by an open file, which a forked process shares
+        if self.pid != os.getpid():
+            self.lockfile = open(f'{self.baseFilename}.lock', 'a')
+            self.pid = os.getpid()
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            if self.stream is not None and self.rotated():
+                self.stream.close()
+                self.stream = None
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+    
+    def rotated(self):
+        try:
+            current = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            return True
+        return current != os.fstat(self.stream.fileno()).st_ino
+    
+    def close(self):
+        super().close()
+        if self.lockfile is not None and self.pid == os.getpid():
+            self.lockfile.close()
+
+class BackgroundHandler(QueueHandler):
+    """Hand records to a listener thread that passes them on to target
+    
+    Records are dropped (and counted) rather than block if the queue is
+    full. After a fork, e.g., of a preloaded gunicorn worker, or after
+    stop(), a new listener is started on the next record.
+    """
+    
+    def __init__(self, target, size=10000):
+        self.target = target
+        self.size = size
+        self.dropped = 0
+        super().__init__(None)
+        self.start()
+    
+    def start(self):
+        self.queue = queue.Queue(self.size)
+        self.listener = QueueListener(self.queue, self.target,
+                                      respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+        self.running = True
+    
+    def prepare(self, record):
+        # Leave formatting to the listener thread
+        return record
+    
+    def enqueue(self, record):
+        if self.pid != os.getpid() or not self.running:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def stop(self):
+        """Write out queued records and stop the listener"""
+        if self.pid == os.getpid() and self.running:
+            self.listener.stop()
+            self.running = False
+
+handlers = []
+
+def setup(name, filename):
+    """Configure logger name to write to filename in the background"""
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    if any(isinstance(h, BackgroundHandler) for h in logger.handlers):
+        return logger
+    
+    settings = config.settings
+    path = pathlib.Path(filename)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    target = SharedRotatingFileHandler(path, maxBytes=1e7, backupCount=10)
+    if settings.log_format == 'json':
+        formatter = JsonFormatter
+    else:
+        formatter = TextFormatter
+    target.setFormatter(formatter(Redactor(settings.log_redact)))
+    
+    handler = BackgroundHandler(target, settings.log_queue_size)
+    handler.addFilter(Sampler(settings.log_sampling))
+    logger.addHandler(handler)
+    handlers.append(handler)
+    return logger
+
+@atexit.register
+def stop():
+    for handler in handlers:
+        handler.stop()
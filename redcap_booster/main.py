@@ -1,53 +1,210 @@
 """API for providing external services to REDCap"""
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from starlette.requests import Request
+from starlette.concurrency import run_in_threadpool
 from starlette.status import HTTP_401_UNAUTHORIZED
 from typing import Optional
-from redcap_booster import config
-import logging
-from logging.handlers import RotatingFileHandler
+from functools import partial
+from redcap_booster import config, jobs, logs, metrics
+from redcap_booster.client import close_clients
+from redcap_booster.coalesce import coalescer
+from redcap_booster.dispatch import dispatch
+from redcap_booster.profiling import profiler
+from redcap_booster.routing import router
+import asyncio
+import signal
+import time
 from secrets import compare_digest
-import pathlib
 
 # Log requests
-logfile = pathlib.Path(config.settings.request_log)
-logfile.parent.mkdir(parents=True, exist_ok=True)
-logger = logging.getLogger('request')
-logger.setLevel(logging.INFO)
-handler = RotatingFileHandler(logfile, maxBytes=1e7, backupCount=10)
-formatter = logging.Formatter('%(asctime)s: %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-plugins = config.plugins
+logger = logs.setup('request', config.settings.request_log)
+
 app = FastAPI(root_path=config.settings.root_path)
 
+stop_workers = None
+stop_watching = None
+
+async def reload():
+    """Reload settings and plugins, keeping current routes on failure"""
+    try:
+        await router.reload()
+    except Exception:
+        logger.exception('Reload failed; keeping previous configuration')
+        return False
+    return True
+
+async def refresh():
+    """Update routes after project settings have changed in the store"""
+    try:
+        await router.refresh()
+    except Exception:
+        logger.exception('Updating routes failed; keeping previous routes')
+
+@app.on_event('startup')
+async def startup():
+    global stop_workers, stop_watching
+    await router.start()
+    
+    # SIGHUP reloads configuration (under gunicorn, send it to the workers;
+    # the master handles SIGHUP by restarting them instead)
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.ensure_future(reload()))
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        pass
+    
+    if config.settings.job_queue:
+        stop_workers = jobs.start_workers()
+    
+    # Pick up projects added or changed in the store while running
+    if config.store is not None:
+        loop = asyncio.get_running_loop()
+        stop_watching = config.store.watch(
+            lambda: loop.call_soon_threadsafe(asyncio.ensure_future,
+                                              refresh()),
+            config.settings.config_poll_interval)
+
+@app.on_event('shutdown')
+async def shutdown():
+    if stop_watching:
+        await run_in_threadpool(stop_watching)
+    if stop_workers:
+        await run_in_threadpool(stop_workers)
+    await router.stop()
+    close_clients()
+    logs.stop()
+
 @app.post('/')
 async def root(request: Request, key: Optional[str] = ''):
     
+    start = time.perf_counter()
+    labels = {'project': 'unknown', 'instrument': 'unknown'}
+    status = 200
+    profile = profiler.begin()
+    try:
+        await handle(request, key, labels)
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    except Exception:
+        status = 500
+        raise
+    finally:
+        metrics.triggers.inc(status=status, **labels)
+        metrics.request_seconds.observe(time.perf_counter()-start, **labels)
+        if profile:
+            profile.finish()
+
+async def handle(request, key, labels):
+    
     # Using Request explicitly here since the name of the [instrument]_complete
     # parameter is unknown ahead of time.
     # See https://www.starlette.io/requests/ for more information.
-    context = await request.form()
-    logger.info(f'{request.client}: {context}')
+    with metrics.stage('parse'), profiler.span('request.form'):
+        context = await request.form()
+    logger.info('trigger', extra=logs.fields(client=request.client,
+                                             context=context))
     
     # Require API key for authentication
-    pid = context.get('project_id', None)
-    if not pid:
-        raise HTTPException(status_code=401, detail='Project ID missing')
-    api_key = getattr(config.settings, f'key_{pid}', '')
-    if not key or not compare_digest(key, api_key):
+    with metrics.stage('auth'):
+        pid = context.get('project_id', None)
+        if not pid:
+            raise HTTPException(status_code=401, detail='Project ID missing')
+        api_key = getattr(config.settings, f'key_{pid}', '')
+        if not key or not compare_digest(key, api_key):
+            raise HTTPException(
+                status_code=HTTP_401_UNAUTHORIZED, detail='API key missing or invalid'
+            )
+    
+    # Only label metrics with values from authenticated requests
+    labels.update(project=pid, instrument=context.get('instrument'))
+    routes = router.match(pid, context.get('instrument'))
+    if not routes:
+        return
+    
+    # Hand off to the background workers and respond right away
+    window = config.settings.debounce_window
+    if config.settings.job_queue:
+        services = [route.service for route in routes]
+        with metrics.stage('enqueue'):
+            await run_in_threadpool(jobs.get_queue().enqueue, services,
+                                    context, window)
+        return
+    
+    with metrics.stage('dispatch'):
+        if window:
+            coalesce_key = (pid, context.get('record'),
+                            context.get('instrument'))
+            await coalescer.submit(coalesce_key, context,
+                                   partial(dispatch, routes))
+        else:
+            await dispatch(routes, context)
+
+def require_admin(key):
+    admin_key = config.settings.admin_key
+    if not admin_key or not key or not compare_digest(key, admin_key):
         raise HTTPException(
-            status_code=HTTP_401_UNAUTHORIZED, detail='API key missing or invalid'
+            status_code=HTTP_401_UNAUTHORIZED, detail='Admin key missing or invalid'
         )
-    
-    for service in plugins.list_plugins():
-        
-        p_settings = getattr(config.settings,
-                             f"{service}_{context['project_id']}", {})
-        
-        if 'form_triggers' in p_settings:
-            if context['instrument'] in p_settings['form_triggers']:
-                plugin = plugins.load_plugin(service)
-                plugin.run(config, context)
+
+@app.post('/reload')
+async def reload_config(key: Optional[str] = ''):
+    """Reload settings and plugins in this worker process"""
+    require_admin(key)
+    if not await reload():
+        raise HTTPException(status_code=500, detail='Reload failed')
+    return {'triggers': len(router.routes), 'services': sorted(router.plugins)}
+
+@app.get('/stats')
+async def stats(key: Optional[str] = ''):
+    """Trigger deduplication statistics for this worker process"""
+    require_admin(key)
+    result = {'coalesce': coalescer.stats()}
+    if config.settings.job_queue:
+        result['jobs'] = {'coalesced': jobs.get_queue().coalesced,
+                          **await run_in_threadpool(jobs.get_queue().counts)}
+    return result
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics(key: Optional[str] = ''):
+    """Metrics for this worker process, in the Prometheus text format"""
+    require_admin(key)
+    return PlainTextResponse(await run_in_threadpool(metrics.registry.render),
+                             media_type='text/plain; version=0.0.4')
+
+@app.post('/profile')
+async def start_profile(key: Optional[str] = '', requests: int = 0,
+                        rate: float = 0.0, seconds: float = 60.0,
+                        interval: float = 0.005, idle: bool = False):
+    """Profile the next requests, or a fraction of them, in this worker"""
+    require_admin(key)
+    if requests <= 0 and not 0 < rate <= 1:
+        raise HTTPException(status_code=400,
+                            detail='Give requests, or a rate from 0 to 1')
+    return profiler.start(requests, rate, seconds, max(interval, 0.001),
+                          idle).stats()
+
+@app.get('/profile')
+async def profile_stats(key: Optional[str] = ''):
+    """Progress of the current (or last) profile, and the time in each span"""
+    require_admin(key)
+    if profiler.session is None:
+        raise HTTPException(status_code=404, detail='No profile')
+    return profiler.session.stats()
+
+@app.get('/profile/stacks', response_class=PlainTextResponse)
+async def profile_stacks(key: Optional[str] = ''):
+    """Sampled stacks of the current (or last) profile, for flamegraph.pl"""
+    require_admin(key)
+    if profiler.session is None:
+        raise HTTPException(status_code=404, detail='No profile')
+    return PlainTextResponse(profiler.session.stacks())
+
+@app.delete('/profile')
+async def stop_profile(key: Optional[str] = ''):
+    """Stop the current profile, keeping its results"""
+    require_admin(key)
+    profiler.stop()
+    return {'stopped': True}
@@ -0,0 +1,302 @@
+"""Cached REDCap project metadata for plugins
+
+Project information, the data dictionary, events and the forms designated
+for each, and repeating instruments and events are fetched once per project
+and kept in memory for metadata_ttl seconds. They are also saved in
+metadata_dir, so that other worker processes, and the server after a
+restart, can use them without fetching them again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from starlette.concurrency import run_in_threadpool
+from redcap_booster import config
+
+logger = logging.getLogger('redcap')
+
+# Fields that REDCap adds to exports of longitudinal or repeating data
+EVENT = 'redcap_event_name'
+REPEAT_INSTRUMENT = 'redcap_repeat_instrument'
+REPEAT_INSTANCE = 'redcap_repeat_instance'
+
+# Seconds to wait before fetching again after a failed fetch
+RETRY_INTERVAL = 60.0
+
+class ProjectMetadata:
+    """Metadata of a REDCap project, as returned by the API"""
+    
+    def __init__(self, project, fields, events=(), form_events=(),
+                 repeating=(), fetched=None):
+        self.project = project
+        self.fields = list(fields)
+        self.events = list(events)
+        self.form_events = list(form_events)
+        self.repeating = list(repeating)
+        self.fetched = time.time() if fetched is None else fetched
+        
+        self.by_name = {f['field_name']: f for f in self.fields}
+        self.forms = list(dict.fromkeys(f['form_name'] for f in self.fields))
+        self.event_forms = {}
+        for mapping in self.form_events:
+            self.event_forms.setdefault(mapping['unique_event_name'],
+                                        []).append(mapping['form'])
+    
+    @property
+    def record_id(self):
+        """Name of the record ID field (the first in the data dictionary)"""
+        return self.fields[0]['field_name']
+    
+    @property
+    def longitudinal(self):
+        return str(self.project.get('is_longitudinal')) == '1'
+    
+    def form(self, field):
+        """Return the form of a field, or None if there is no such field"""
+        if field in self.by_name:
+            return self.by_name[field]['form_name']
+        # Form status fields, and checkbox options (field___code)
+        if field.endswith('_complete') and field[:-9] in self.forms:
+            return field[:-9]
+        name, sep, code = field.partition('___')
+        if sep and self.by_name.get(name, {}).get('field_type') == 'checkbox':
+            return self.by_name[name]['form_name']
+        return None
+    
+    def check(self, fields):
+        """Raise ValueError if any of fields is not in the project"""
+        unknown = [field for field in fields if self.form(field) is None]
+        if unknown:
+            raise ValueError(f"PID {self.project.get('project_id')}: no "
+                             f"field {', '.join(unknown)} in the data "
+                             f"dictionary")
+    
+    def events_for(self, form):
+        """Return the events for which form is designated, in order"""
+        return [event for event, forms in self.event_forms.items()
+                if form in forms]
+    
+    def repeats(self, form, event=None):
+        """Return how form repeats (in event): 'instrument', 'event' or None"""
+        for entry in self.repeating:
+            if (entry.get('event_name') or None) != (event or None):
+                continue
+            if not entry.get('form_name'):
+                return 'event'
+            if entry['form_name'] == form:
+                return 'instrument'
+        return None
+    
+    def export_fields(self, fields):
+        """Return fields to request in an export, with the record ID first"""
+        self.check(fields)
+        return list(dict.fromkeys([self.record_id, *fields]))
+    
+    def row(self, record, values, event=None, instance=None):
+        """Return a row that imports values (field: value) into record
+        
+        In longitudinal projects, the row is for event if the fields' form
+        is designated for it, or else for the first event that it is. For
+        repeating instruments and events, it is for instance (by default, the
+        first). Raises ValueError if the fields are not in the project or
+        don't belong in one place.
+        """
+        self.check(values)
+        forms = {self.form(field) for field in values if field !=
+                 self.record_id}
+        row = {self.record_id: record}
+        
+        if self.longitudinal:
+            events = [e for e in self.event_forms
+                      if forms <= set(self.event_forms[e])]
+            if not events:
+                raise ValueError(f"PID {self.project.get('project_id')}: "
+                                 f"forms {', '.join(sorted(forms))} are not "
+                                 f"designated for any one event")
+            event = event if event in events else events[0]
+            row[EVENT] = event
+        else:
+            event = None
+        
+        repeating = {form: self.repeats(form, event) for form in forms}
+        if 'event' in repeating.values():
+            row[REPEAT_INSTRUMENT] = ''
+            row[REPEAT_INSTANCE] = instance or 1
+        elif 'instrument' in repeating.values():
+            if len(forms) > 1:
+                raise ValueError(f"PID {self.project.get('project_id')}: "
+                                 f"fields of repeating instrument and other "
+                                 f"forms in one row")
+            row[REPEAT_INSTRUMENT] = forms.pop()
+            row[REPEAT_INSTANCE] = instance or 1
+        
+        row.update(values)
+        return row
+    
+    def to_dict(self):
+        return {'project': self.project, 'fields': self.fields,
+                'events': self.events, 'form_events': self.form_events,
+                'repeating': self.repeating, 'fetched': self.fetched}
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+def fetch(redcap_url, pid):
+    """Fetch a project's metadata from the REDCap API"""
+    # Imported here, as redcap_booster imports this module
+    from redcap_booster import redcap_api
+    context = {'redcap_url': redcap_url}
+    
+    def export(content):
+        result = redcap_api('metadata', config, context,
+                            {'content': content, 'format': 'json'},
+                            content, pid=pid)
+        if not result.ok:
+            raise ValueError(f'PID {pid}: exporting {content} failed: REDCap '
+                             f'API returned {result.status_code}')
+        return result.json()
+    
+    project = export('project')
+    fields = export('metadata')
+    events = form_events = repeating = []
+    if str(project.get('is_longitudinal')) == '1':
+        events = export('event')
+        form_events = export('formEventMapping')
+    if str(project.get('has_repeating_instruments_or_events')) == '1':
+        repeating = export('repeatingFormsEvents')
+    return ProjectMetadata(project, fields, events, form_events, repeating)
+
+class MetadataCache:
+    """Metadata of each project, by REDCap server and project ID"""
+    
+    def __init__(self, ttl=3600.0, directory='', fetch=fetch):
+        self.ttl = ttl
+        self.directory = directory
+        self.fetch = fetch
+        self.projects = {}
+        self.retry_at = {}
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.fetches = 0
+    
+    def path(self, redcap_url, pid):
+        digest = hashlib.sha1(redcap_url.encode()).hexdigest()[:8]
+        return os.path.join(self.directory, f'{pid}-{digest}.json')
+    
+    def fresh(self, metadata):
+        return (metadata is not None
+                and time.time() - metadata.fetched < self.ttl)
+    
+    def cached(self, redcap_url, pid):
+        """Return metadata from memory if fresh, without waiting"""
+        metadata = self.projects.get((redcap_url, pid))
+        return metadata if self.fresh(metadata) else None
+    
+    def load(self, redcap_url, pid):
+        try:
+            with open(self.path(redcap_url, pid)) as f:
+                return ProjectMetadata.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError, KeyError):
+            logger.warning(f'PID {pid}: ignoring unreadable metadata file')
+            return None
+    
+    def save(self, redcap_url, pid, metadata):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(redcap_url, pid)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(metadata.to_dict(), f)
+        os.replace(tmp, path)
+    
+    def get(self, redcap_url, pid, refresh=False):
+        """Return a project's metadata, fetching it if necessary
+        
+        If fetching fails, metadata that has expired is used, if there is
+        any, and fetching is tried again after a while.
+        """
+        redcap_url = redcap_url.rstrip('/')
+        key = (redcap_url, pid)
+        metadata = None if refresh else self.cached(redcap_url, pid)
+        if metadata is not None:
+            return metadata
+        
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        # One fetch per project at a time; others wait for its result
+        with lock:
+            metadata = self.projects.get(key)
+            if self.fresh(metadata) and not refresh:
+                return metadata
+            if self.directory and not refresh:
+                saved = self.load(redcap_url, pid)
+                if saved is not None and (
+                        metadata is None or saved.fetched > metadata.fetched):
+                    metadata = self.projects[key] = saved
+                if self.fresh(metadata):
+                    return metadata
+            if (metadata is not None and not refresh
+                    and time.time() < self.retry_at.get(key, 0)):
+                return metadata
+            
+            try:
+                fetched = self.fetch(redcap_url, pid)
+            except Exception:
+                if metadata is None:
+                    raise
+                logger.exception(f'PID {pid}: fetching metadata failed; '
+                                 f'using metadata from '
+                                 f'{time.ctime(metadata.fetched)}')
+                self.retry_at[key] = time.time() + RETRY_INTERVAL
+                return metadata
+            self.fetches += 1
+            self.projects[key] = fetched
+            self.retry_at.pop(key, None)
+            if self.directory:
+                self.save(redcap_url, pid, fetched)
+            return fetched
+    
+    async def aget(self, redcap_url, pid, refresh=False):
+        """Same as get(), without blocking the event loop"""
+        metadata = None if refresh else self.cached(redcap_url.rstrip('/'),
+                                                    pid)
+        if metadata is not None:
+            return metadata
+        return await run_in_threadpool(self.get, redcap_url, pid, refresh)
+    
+    def clear(self, pid=None):
+        """Forget metadata in memory (of one project, or all)"""
+        with self.lock:
+            for key in list(self.projects):
+                if pid is None or key[1] == pid:
+                    del self.projects[key]
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Return the process's metadata cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                s = config.settings
+                _cache = MetadataCache(s.metadata_ttl, s.metadata_dir)
+    return _cache
+
+def get_metadata(config, context, pid=None, refresh=False):
+    """Return the metadata of the project of a trigger (or of pid)"""
+    if pid is None:
+        pid = context['project_id']
+    return get_cache().get(context['redcap_url'], pid, refresh)
+
+async def get_metadata_async(config, context, pid=None, refresh=False):
+    """Same as get_metadata(), without blocking the event loop"""
+    if pid is None:
+        pid = context['project_id']
+    return await get_cache().aget(context['redcap_url'], pid, refresh)
@@ -0,0 +1,175 @@
+"""Metrics, served in the Prometheus text format
+
+Each server process keeps its own metrics; under gunicorn, each worker
+reports those of the requests it handled.
+"""
+
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('request')
+
+# Upper bounds (seconds) of histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+def format_labels(names, values, extra=''):
+    labels = [f'{name}="{escape(value)}"'
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = None
+    
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.metrics.append(self)
+    
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines.extend(self.samples(key, value))
+        return lines
+    
+    def samples(self, key, value):
+        return [f'{self.name}{format_labels(self.labels, key)} '
+                f'{format_value(value)}']
+
+class Counter(Metric):
+    type = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+    
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+    
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+    
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Bucket counts, then sum of values
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+    
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def samples(self, key, counts):
+        lines, total = [], 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            le = f'le="{format_value(bound)}"'
+            lines.append(f'{self.name}_bucket'
+                         f'{format_labels(self.labels, key, le)} {total}')
+        labels = format_labels(self.labels, key)
+        lines.append(f'{self.name}_sum{labels} {format_value(counts[-1])}')
+        lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+class Registry:
+    """All metrics, and functions that update gauges before each scrape"""
+    
+    def __init__(self):
+        self.metrics = []
+        self.collectors = {}
+    
+    def add_collector(self, name, collect):
+        self.collectors[name] = collect
+    
+    def remove_collector(self, name, collect):
+        """Remove a collector, unless it has since been replaced"""
+        if self.collectors.get(name) == collect:
+            del self.collectors[name]
+    
+    def render(self):
+        for name, collect in list(self.collectors.items()):
+            try:
+                collect()
+            except Exception:
+                logger.exception(f'Metrics collector {name} failed')
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+triggers = Counter('redcap_booster_requests_total',
+                  'Data Entry Triggers received, by response status',
+                  ('project', 'instrument', 'status'))
+request_seconds = Histogram('redcap_booster_request_seconds',
+                            'Time to handle a Data Entry Trigger',
+                            ('project', 'instrument'))
+stage_seconds = Histogram('redcap_booster_stage_seconds',
+                          'Time spent in each stage of handling triggers',
+                          ('stage',))
+service_seconds = Histogram('redcap_booster_service_seconds',
+                            'Time for a service to handle a trigger',
+                            ('project', 'instrument', 'service', 'outcome'))
+redcap_responses = Counter('redcap_booster_redcap_responses_total',
+                           'REDCap API calls, by response status code',
+                           ('code',))
+redcap_retries = Counter('redcap_booster_redcap_retries_total',
+                         'REDCap API call attempts that were retried')
+redcap_concurrency = Gauge('redcap_booster_redcap_concurrency',
+                           'Current limit on concurrent calls to a REDCap '
+                           'server', ('server',))
+redcap_throttled = Counter('redcap_booster_redcap_throttled_total',
+                           'Pauses of all calls to a REDCap server for '
+                           'Retry-After', ('server',))
+free_ids = Gauge('redcap_booster_free_ids',
+                 'Unassigned IDs left in the pool of an ID service',
+                 ('service', 'project'))
+
+def stage(name):
+    """Time a block of code as a stage of handling triggers"""
+    return stage_seconds.time(stage=name)
@@ -0,0 +1,107 @@
+"""Interface between the server and service plugins"""
+
+import asyncio
+import logging
+import threading
+import time
+from starlette.concurrency import run_in_threadpool
+from redcap_booster.profiling import profiler
+
+logger = logging.getLogger('request')
+
+# Latest plugin protocol understood by the server
+PROTOCOL = 2
+
+class Plugin:
+    """A loaded service plugin, wrapped in a uniform async interface
+    
+    A plugin is a module with a run(config, context) function, which may be
+    sync (run in a worker thread) or async. Plugins that set protocol = 2
+    may also define:
+    
+    - startup(config) and shutdown(config), sync or async, called as the
+      server starts and stops, or when a reload replaces the plugin
+    - triggers, a list of instruments that trigger the service in projects
+      whose settings don't give form_triggers
+    """
+    
+    def __init__(self, service, module):
+        self.service = service
+        self.module = module
+        self.protocol = getattr(module, 'protocol', 1)
+        if self.protocol > PROTOCOL:
+            raise ValueError(f'{service}: plugin protocol {self.protocol} '
+                             f'not supported (up to {PROTOCOL})')
+        
+        self.is_async = asyncio.iscoroutinefunction(module.run)
+        # Async plugins, and plugins that declare thread_safe = True, may run
+        # at the same time as other services for a trigger
+        self.concurrent = self.is_async or getattr(module, 'thread_safe',
+                                                   False)
+        # Other sync plugins run one at a time, across triggers and job
+        # workers, as they may keep state that isn't safe to share
+        self.lock = None if self.concurrent else threading.Lock()
+        self.timeout = getattr(module, 'timeout', None)
+        self.span = f'plugin.run:{service}'
+        self.triggers = tuple(self.declared('triggers', ()))
+        self.active = 0
+    
+    def declared(self, name, default=None):
+        """Return an attribute defined by the current protocol"""
+        if self.protocol < 2:
+            return default
+        return getattr(self.module, name, default)
+    
+    async def call(self, fn, *args):
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(*args)
+        # A timed-out thread can't be stopped; it is only abandoned
+        return await run_in_threadpool(fn, *args)
+    
+    def run_module(self, config, context):
+        """Call a sync plugin's run(), holding its lock if it has one"""
+        if self.lock is None:
+            return self.module.run(config, context)
+        with self.lock:
+            return self.module.run(config, context)
+    
+    async def run(self, config, context):
+        self.active += 1
+        try:
+            with profiler.span(self.span):
+                if self.is_async:
+                    return await self.module.run(config, context)
+                return await self.call(self.run_module, config, context)
+        finally:
+            self.active -= 1
+    
+    def run_sync(self, config, context):
+        """Run from a thread without an event loop, e.g., a job worker"""
+        with profiler.span(self.span):
+            if self.is_async:
+                return asyncio.run(self.module.run(config, context))
+            return self.run_module(config, context)
+    
+    async def startup(self, config):
+        hook = self.declared('startup')
+        if hook:
+            await self.call(hook, config)
+            logger.info(f'{self.service}: started')
+    
+    async def shutdown(self, config, drain=None):
+        """Wait up to drain seconds for runs in flight, then shut down"""
+        deadline = time.monotonic() + (drain or 0)
+        while self.active and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.active:
+            logger.warning(f'{self.service}: shutting down with '
+                           f'{self.active} runs in flight')
+        
+        hook = self.declared('shutdown')
+        if hook:
+            try:
+                await self.call(hook, config)
+            except Exception:
+                logger.exception(f'{self.service}: shutdown failed')
+            else:
+                logger.info(f'{self.service}: stopped')
@@ -0,0 +1,211 @@
+"""On-demand profiling of the request path
+
+A profile runs for the next N requests, or for a fraction of requests, in
+one server process. While a profiled request is in flight, a background
+thread samples the stack of every thread, and spans (named blocks of code,
+such as calls to the REDCap API) are timed within it, including in the
+worker threads it runs code in. Stacks are served in the collapsed format
+read by flamegraph.pl, speedscope and similar tools.
+
+Outside a profiled request, a span costs a context variable lookup.
+"""
+
+import contextlib
+import contextvars
+import functools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+# Leaf frames of threads waiting for work (or the event loop for I/O),
+# which are left out of stacks unless idle threads are asked for. An event
+# loop implemented in C (uvloop) waits in asyncio.run().
+IDLE = {('threading.py', 'wait'), ('selectors.py', 'select'),
+        ('queue.py', 'get'), ('thread.py', '_worker'), ('runners.py', 'run')}
+
+NULL = contextlib.nullcontext()
+
+# Session of the profiled request being handled, if any; copied to the
+# threads that run_in_threadpool runs code in
+current = contextvars.ContextVar('profile', default=None)
+
+class Session:
+    """One profile: its limits, and the samples and spans collected"""
+    
+    def __init__(self, requests=0, rate=0.0, seconds=60.0, interval=0.005,
+                 idle=False):
+        self.remaining = requests
+        self.rate = rate
+        self.deadline = time.monotonic() + seconds
+        self.interval = interval
+        self.idle = idle
+        self.started = time.time()
+        self.requests = 0
+        self.inflight = 0
+        self.samples = Counter()
+        self.spans = {}
+        self.lock = threading.Lock()
+        self.active = True
+        self.stopped = threading.Event()
+        self.frames = {}
+        self.thread = threading.Thread(target=self.sample, daemon=True,
+                                       name='profiler')
+    
+    def select(self):
+        """Return whether to profile a request that is starting"""
+        with self.lock:
+            if time.monotonic() >= self.deadline:
+                self.stop()
+            if not self.active:
+                return False
+            if self.remaining > 0:
+                self.remaining -= 1
+            elif not self.rate or random.random() >= self.rate:
+                return False
+            self.requests += 1
+            self.inflight += 1
+            return True
+    
+    def finish(self):
+        """Note that a profiled request has finished"""
+        with self.lock:
+            self.inflight -= 1
+            # After the last of the next N requests
+            if not self.inflight and not self.remaining and not self.rate:
+                self.stop()
+    
+    def stop(self):
+        self.active = False
+        self.stopped.set()
+    
+    def add_span(self, name, elapsed):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = [0, 0.0, 0.0]
+            span[0] += 1
+            span[1] += elapsed
+            span[2] = max(span[2], elapsed)
+    
+    def frame(self, code):
+        name = self.frames.get(code)
+        if name is None:
+            path = code.co_filename.split(os.sep)
+            name = self.frames[code] = (
+                f'{code.co_name} ({"/".join(path[-2:])}:'
+                f'{code.co_firstlineno})')
+        return name
+    
+    def sample(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            if time.monotonic() >= self.deadline:
+                self.stop()
+            if not self.inflight:
+                continue
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                leaf = (os.path.basename(code.co_filename), code.co_name)
+                if not self.idle and leaf in IDLE:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.frame(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                stacks.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.samples.update(stacks)
+    
+    def stats(self):
+        with self.lock:
+            spans = {name: {'count': count, 'total': round(total, 6),
+                            'max': round(longest, 6)}
+                     for name, (count, total, longest) in self.spans.items()}
+            return {'active': self.active,
+                    'started': self.started,
+                    'requests': self.requests,
+                    'remaining': self.remaining,
+                    'rate': self.rate,
+                    'samples': sum(self.samples.values()),
+                    'interval': self.interval,
+                    'spans': spans}
+    
+    def stacks(self):
+        """Samples in the collapsed format: one stack per line, and count"""
+        with self.lock:
+            samples = self.samples.copy()
+        return ''.join(f'{stack} {n}\n'
+                       for stack, n in sorted(samples.items()))
+
+class Profiler:
+    """The current (or last) profile of this process"""
+    
+    def __init__(self):
+        self.session = None
+    
+    def start(self, requests=0, rate=0.0, seconds=60.0, interval=0.005,
+              idle=False):
+        """Start a new profile, replacing any other
+        
+        Profiles the next requests requests, or a fraction rate of requests,
+        for up to seconds, sampling stacks every interval seconds.
+        """
+        self.stop()
+        session = Session(requests, rate, seconds, interval, idle)
+        session.thread.start()
+        self.session = session
+        return session
+    
+    def stop(self):
+        if self.session is not None:
+            self.session.stop()
+    
+    def begin(self):
+        """Return the session if a request that is starting is profiled
+        
+        Spans are then timed for the rest of the request (in the current
+        context).
+        """
+        session = self.session
+        if session is None or not session.active or not session.select():
+            return None
+        current.set(session)
+        return session
+    
+    def span(self, name):
+        """Time a block of code as a span, if in a profiled request"""
+        session = current.get()
+        if session is None or not session.active:
+            return NULL
+        return timer(session, name)
+
+@contextlib.contextmanager
+def timer(session, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        session.add_span(name, time.perf_counter() - start)
+
+profiler = Profiler()
+
+def span(name):
+    return profiler.span(name)
+
+def timed(name):
+    """Decorate a function to be timed as a span"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profiler.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
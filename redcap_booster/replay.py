@@ -0,0 +1,181 @@
+"""Replaying Data Entry Triggers for existing records
+
+Builds the context REDCap would send when each record's instrument is saved,
+and runs it through the same routes and dispatch as a trigger received by
+the server, several at a time.
+"""
+
+import asyncio
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from redcap_booster import config, redcap_api
+from redcap_booster.dispatch import dispatch
+from redcap_booster.routing import router
+
+# Columns of REDCap exports that locate a row of a record's data
+EVENT = 'redcap_event_name'
+REPEAT_INSTRUMENT = 'redcap_repeat_instrument'
+REPEAT_INSTANCE = 'redcap_repeat_instance'
+
+def read_list(lines):
+    """Yield a row for each record in a list, one per line"""
+    for line in lines:
+        record = line.strip()
+        if record:
+            yield {'record': record}
+
+def read_csv(lines, record_field=None):
+    """Yield a row for each record in CSV, as exported from REDCap
+    
+    The record is taken from record_field (by default, the first column),
+    and the event, repeat instance and completion status of each instrument
+    from the usual columns, where present.
+    """
+    reader = csv.DictReader(lines)
+    if not reader.fieldnames:
+        return
+    record_field = record_field or reader.fieldnames[0]
+    if record_field not in reader.fieldnames:
+        raise ValueError(f'No column "{record_field}" in input')
+    for row in reader:
+        if row[record_field]:
+            yield dict(row, record=row[record_field])
+
+def export_report(pid, redcap_url, report_id):
+    """Stream the lines of a REDCap report, as CSV"""
+    payload = {'content':'report', 'format':'csv', 'report_id':report_id,
+               'rawOrLabel':'raw'}
+    result = redcap_api('replay', config, {'redcap_url':redcap_url},
+                        payload, f'report {report_id}', pid=pid, stream=True)
+    if not result.ok:
+        raise ValueError(f'Report export failed: REDCap API returned '
+                         f'{result.status_code}')
+    result.encoding = result.encoding or 'utf-8'
+    return result.iter_lines(decode_unicode=True)
+
+def contexts(pid, redcap_url, rows, instruments, complete=None):
+    """Yield (key, context) for each trigger to replay, without duplicates
+    
+    Rows for a repeating instrument only trigger that instrument; other rows
+    trigger each of instruments. The key identifies the trigger (record,
+    instrument, event and repeat instance). Contexts are marked as replayed,
+    so that services write their results even if they normally skip
+    records they have seen before.
+    """
+    seen = set()
+    for row in rows:
+        repeating = row.get(REPEAT_INSTRUMENT)
+        for instrument in ([repeating] if repeating else instruments):
+            if instrument not in instruments:
+                continue
+            key = (row['record'], instrument, row.get(EVENT) or None,
+                   row.get(REPEAT_INSTANCE) or None)
+            if key in seen:
+                continue
+            seen.add(key)
+            
+            context = {'project_id':pid, 'instrument':instrument,
+                       'record':row['record'], 'redcap_url':redcap_url,
+                       'replay':'1'}
+            if key[2]:
+                context[EVENT] = key[2]
+            if key[3]:
+                context[REPEAT_INSTANCE] = key[3]
+            status = row.get(f'{instrument}_complete') or complete
+            if status is not None:
+                context[f'{instrument}_complete'] = str(status)
+            yield key, context
+
+class Checkpoint:
+    """Triggers replayed so far, as JSON lines, with the project first"""
+    
+    def __init__(self, filename, pid):
+        self.filename = filename
+        self.pid = pid
+        self.file = None
+        lines = []
+        try:
+            with open(filename) as f:
+                header = json.loads(next(f))
+                if header['pid'] != pid:
+                    raise ValueError(f'Checkpoint "{filename}" is for '
+                                     f'project {header["pid"]}')
+                lines = list(f)
+        except FileNotFoundError:
+            pass
+        # A line cut short by an interruption is left out, and ended
+        self.cut = bool(lines) and not lines[-1].endswith('\n')
+        self.done = set()
+        for line in lines:
+            try:
+                self.done.add(tuple(json.loads(line)))
+            except ValueError:
+                pass
+    
+    def add(self, key):
+        if self.file is None:
+            new = not os.path.exists(self.filename)
+            self.file = open(self.filename, 'a')
+            if new:
+                self.file.write(json.dumps({'pid':self.pid}) + '\n')
+            elif self.cut:
+                self.file.write('\n')
+        self.file.write(json.dumps(key) + '\n')
+        self.file.flush()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+    
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+async def replay(triggers, workers=8, services=None, progress=None,
+                 checkpoint=None):
+    """Dispatch triggers (key, context), up to workers at a time
+    
+    Only services (if given) are run. A trigger counts as done if all of its
+    services succeed; done triggers are added to checkpoint. progress is
+    called with the counts (done, failed) as triggers finish. Returns the
+    counts.
+    """
+    counts = {'done':0, 'failed':0}
+    slots = asyncio.Semaphore(workers)
+    
+    async def run(key, context):
+        try:
+            routes = router.match(context['project_id'],
+                                  context['instrument'])
+            if services is not None:
+                routes = [r for r in routes if r.service in services]
+            results = await dispatch(routes, context)
+        finally:
+            slots.release()
+        if all(result.ok for result in results):
+            counts['done'] += 1
+            if checkpoint:
+                checkpoint.add(key)
+        else:
+            counts['failed'] += 1
+        if progress:
+            progress(counts)
+    
+    # Sync services run in the loop's default executor, which would
+    # otherwise limit them to a few threads
+    executor = ThreadPoolExecutor(workers)
+    asyncio.get_running_loop().set_default_executor(executor)
+    
+    await router.start()
+    try:
+        tasks = []
+        for key, context in triggers:
+            await slots.acquire()
+            tasks.append(asyncio.ensure_future(run(key, context)))
+        await asyncio.gather(*tasks)
+    finally:
+        await router.stop()
+    return counts
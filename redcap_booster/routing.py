@@ -0,0 +1,158 @@
+"""Routing of Data Entry Triggers to services"""
+
+import asyncio
+import logging
+import threading
+from collections import namedtuple
+from starlette.concurrency import run_in_threadpool
+from redcap_booster import config
+from redcap_booster.plugin import Plugin
+
+logger = logging.getLogger('request')
+
+Route = namedtuple('Route', ['service', 'run', 'concurrent', 'timeout'])
+
+def make_route(plugin):
+    return Route(plugin.service, plugin.run, plugin.concurrent, plugin.timeout)
+
+class Router:
+    """Index of (project ID, instrument) to the services it triggers
+    
+    The index is built once from settings, loading each configured plugin a
+    single time, so that dispatching a trigger is a dict lookup. It is only
+    replaced as a whole, so requests in flight keep the routes they started
+    with.
+    """
+    
+    def __init__(self):
+        self.routes = None
+        self.plugins = {}
+        self.lock = threading.Lock()
+        self.reloading = None
+    
+    def index(self, running=None):
+        """Load configured plugins; return the index and the plugins
+        
+        Plugins in running (by service) are used rather than loaded again.
+        """
+        settings = config.settings
+        source = config.plugins
+        running = running or {}
+        
+        routes, plugins, loaded = {}, {}, {}
+        for service in source.list_plugins():
+            for pid in settings.pids:
+                p_settings = getattr(settings, f'{service}_{pid}', {})
+                if not p_settings:
+                    continue
+                if service not in plugins:
+                    plugins[service] = running.get(service) or Plugin(
+                        service, source.load_plugin(service))
+                    loaded[service] = make_route(plugins[service])
+                forms = p_settings.get('form_triggers',
+                                       plugins[service].triggers)
+                for form in forms:
+                    routes.setdefault((pid, form), []).append(loaded[service])
+        
+        return {k: tuple(v) for k, v in routes.items()}, plugins
+    
+    def swap(self, routes, plugins):
+        self.plugins = plugins
+        self.routes = routes
+        logger.info(f'Routes built: {len(self.routes)} triggers, services '
+                    f'{sorted(plugins)}')
+    
+    def build(self):
+        """Build the index, without running plugin startup hooks"""
+        self.swap(*self.index())
+    
+    async def start(self):
+        """Build the index and start its plugins"""
+        routes, plugins = await run_in_threadpool(self.index)
+        await startup(plugins.values())
+        self.swap(routes, plugins)
+    
+    async def stop(self):
+        """Shut down plugins, letting runs in flight finish first"""
+        await shutdown(self.plugins.values())
+    
+    async def reload(self):
+        """Re-read settings and plugins, then replace the index
+        
+        New plugins are started before they receive triggers, and those they
+        replace are shut down after. On failure, the previous index is kept.
+        """
+        if self.reloading is None:
+            self.reloading = asyncio.Lock()
+        async with self.reloading:
+            def load():
+                with self.lock:
+                    config.load()
+                    return self.index()
+            routes, plugins = await run_in_threadpool(load)
+            await startup(plugins.values())
+            
+            old = [plugin for service, plugin in self.plugins.items()
+                   if getattr(plugins.get(service), 'module', None)
+                   is not plugin.module]
+            self.swap(routes, plugins)
+            await shutdown(old)
+    
+    async def refresh(self):
+        """Rebuild the index after project settings have changed
+        
+        Plugins already running are kept; only those newly configured are
+        started, and those no longer configured shut down.
+        """
+        if self.reloading is None:
+            self.reloading = asyncio.Lock()
+        async with self.reloading:
+            running = self.plugins
+            routes, plugins = await run_in_threadpool(self.index, running)
+            await startup(plugin for service, plugin in plugins.items()
+                          if service not in running)
+            old = [plugin for service, plugin in running.items()
+                   if service not in plugins]
+            self.swap(routes, plugins)
+            await shutdown(old)
+    
+    def match(self, pid, instrument):
+        """Return the routes for a trigger"""
+        if self.routes is None:
+            with self.lock:
+                if self.routes is None:
+                    self.build()
+        return self.routes.get((pid, instrument), ())
+    
+    def instruments(self, pid, services=None):
+        """Return the instruments that trigger services in a project"""
+        self.match(pid, None)
+        return sorted(form for (pid_, form), routes in self.routes.items()
+                      if pid_ == pid and any(services is None
+                                             or r.service in services
+                                             for r in routes))
+    
+    def plugin(self, service):
+        """Return a loaded plugin by name"""
+        plugin = self.plugins.get(service)
+        if plugin is None:
+            plugin = Plugin(service, config.plugins.load_plugin(service))
+        return plugin
+
+async def startup(plugins):
+    """Start plugins; if any fails, shut down those already started"""
+    started = []
+    try:
+        for plugin in plugins:
+            await plugin.startup(config)
+            started.append(plugin)
+    except Exception:
+        await shutdown(started)
+        raise
+
+async def shutdown(plugins):
+    drain = config.settings.plugin_timeout
+    await asyncio.gather(*(plugin.shutdown(config, drain)
+                           for plugin in plugins))
+
+router = Router()
@@ -1,43 +1,102 @@
 from .db import DatabaseAccess
 from .cli import commands
-from redcap_booster import redcap_api
+from redcap_booster import get_metadata, metrics, redcap_import
 import click
-import json
 
 service = 'id_gen'
-db = DatabaseAccess(service)
+protocol = 2
+
+# Opened on startup, or on first use outside the server
+db = None
+
+# May run concurrently with other services for the same trigger
+thread_safe = True
+
+def get_db():
+    global db
+    if db is None:
+        db = DatabaseAccess(service)
+    return db
+
+def startup(config, service=service, db=None):
+    """Open database and cache the IDs of projects with skip_existing
+    
+    Only IDs known to have been written to REDCap are cached.
+    """
+    db = db or get_db()
+    for pid in config.settings.pids:
+        p_settings = getattr(config.settings, f'{service}_{pid}', None)
+        if p_settings and p_settings.get('skip_existing'):
+            db.fill_cache(pid)
+    metrics.registry.add_collector(service, db.collect_metrics)
+
+def shutdown(config, service=service, db=None):
+    db = db or get_db()
+    metrics.registry.remove_collector(service, db.collect_metrics)
+    db.close()
 
 def generate_cli(db, commands):
+    """Return CLI group; db may be a function that returns the database"""
     @click.group()
     @click.pass_context
     def cli(ctx):
         """Utilities for ID generation service"""
-        ctx.obj = db
+        ctx.obj = db() if callable(db) else db
     
     for cmd in commands:
         cli.add_command(cmd)
     
     return cli
 
-cli = generate_cli(db, commands)
+cli = generate_cli(get_db, commands)
 
-def run(config, context, service=service, db=db):
+def run(config, context, service=service, db=None):
     
+    db = db or get_db()
     pid = context['project_id']
-    id = db.get_id(pid, context['record'])
+    record = context['record']
+    p_settings = getattr(config.settings, f'{service}_{pid}')
     
-    # Don't go any further if an ID is not available
-    if not id:
-        return
+    # With skip_existing, cached IDs are taken to be in REDCap already
+    # (written back by this server, or assigned before it started), so later
+    # saves of the form don't write them again. The cache only decides
+    # whether to skip; the ID written is always read from the database.
+    # Replayed triggers (rbutils replay) always write the ID.
+    skip_existing = p_settings.get('skip_existing')
+    if skip_existing:
+        with metrics.stage('sqlite'):
+            generation = db.generation(pid)
+            if (db.cache.get(pid, record, generation)
+                    and not context.get('replay')):
+                return
     
-    p_settings = getattr(config.settings, f'{service}_{pid}')
-    record_id = p_settings.get('record_id', 'record_id')
+    # With metadata, check the configuration against the data dictionary
+    # before claiming an ID
     id_field = p_settings['id_field']
+    metadata = None
+    if p_settings.get('metadata'):
+        metadata = get_metadata(config, context)
+        metadata.check([id_field])
+    
+    with metrics.stage('sqlite'):
+        id = db.get_id(pid, record)
     
-    data = json.dumps([{record_id:context['record'], id_field:id}],
-                      separators=(',',':'))
-    payload = {'content':'record',
-               'format':'json',
-               'data':data}
+    # Don't go any further if an ID is not available
+    if not id:
+        return
     
-    return redcap_api(service, config, context, payload, payload)
+    if metadata is not None:
+        # For the event and repeat instance where the ID field belongs
+        record_id = metadata.record_id
+        rows = [metadata.row(record, {id_field:id},
+                             context.get('redcap_event_name'),
+                             context.get('redcap_repeat_instance'))]
+    else:
+        record_id = p_settings.get('record_id', 'record_id')
+        rows = [{record_id:record, id_field:id}]
+    result = redcap_import(service, config, context, rows, record_id)
+    if result.ok and skip_existing:
+        with metrics.stage('sqlite'):
+            db.mark_written(pid, [(record, id)])
+        db.cache.put(pid, record, id, generation)
+    return result
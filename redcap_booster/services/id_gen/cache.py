@@ -0,0 +1,63 @@
+"""Cache of record to ID mappings for ID generation service"""
+
+import threading
+from collections import OrderedDict
+
+class IdCache:
+    """Bounded LRU cache of record to ID for each project
+    
+    Entries are tagged with the project's generation in the database, which
+    changes when IDs are remapped (import-map, correct-ids), so a project's
+    entries are dropped as soon as a lookup sees a newer generation.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.projects = {}
+        self.hits = self.misses = 0
+    
+    def ids(self, pid, generation):
+        # Caller holds the lock
+        current = self.projects.get(pid)
+        if current is None or current[0] != generation:
+            current = self.projects[pid] = (generation, OrderedDict())
+        return current[1]
+    
+    def get(self, pid, record, generation):
+        with self.lock:
+            ids = self.ids(pid, generation)
+            id = ids.get(record)
+            if id is None:
+                self.misses += 1
+                return None
+            ids.move_to_end(record)
+            self.hits += 1
+            return id
+    
+    def put(self, pid, record, id, generation):
+        if not self.size:
+            return
+        with self.lock:
+            ids = self.ids(pid, generation)
+            ids[record] = id
+            ids.move_to_end(record)
+            if len(ids) > self.size:
+                ids.popitem(last=False)
+    
+    def fill(self, pid, map, generation):
+        """Add (id, record) pairs, least recently used first"""
+        for id, record in map:
+            self.put(pid, record, id, generation)
+    
+    def clear(self, pid=None):
+        with self.lock:
+            if pid is None:
+                self.projects.clear()
+            else:
+                self.projects.pop(pid, None)
+    
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': sum(len(ids) for _, ids in self.projects.values())}
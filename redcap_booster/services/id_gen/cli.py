@@ -2,7 +2,12 @@
 
 import click
 import csv
+import gzip
+import io
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 from redcap_booster import config, redcap_api
 from redcap_booster.services import id_gen
 import json
@@ -11,14 +16,19 @@ import json
 @click.argument('pid')
 @click.argument('filename', type=click.File('r'))
 @click.option('--random-order/--no-random-order', default=False,
-              show_default=True, help='Randomize order of IDs')
+              show_default=True,
+              help='Randomize order of IDs (reads whole file into memory)')
 @click.pass_obj
 def load_ids(db, pid, filename, random_order):
-    """Load IDs from file"""
-    ids = filename.read().splitlines()
-    if len(ids)!=len(set(ids)):
-        sys.exit(f'"{filename.name}" contains duplicate IDs')
-    db.load_ids(pid, ids, random_order)
+    """Load IDs from file
+    
+    FILENAME should contain one ID per line. IDs that are already loaded, or
+    repeated in the file, are skipped.
+    """
+    ids = (line.strip() for line in filename)
+    loaded, skipped = db.load_ids(pid, (id for id in ids if id), random_order)
+    print(f'{loaded} new IDs loaded for project {pid}; {skipped} skipped as '
+          f'duplicates')
 
 @click.command()
 @click.argument('pid')
@@ -55,51 +65,311 @@ def import_map(db, pid, filename):
 
 @click.command()
 @click.argument('pid')
-@click.argument('filename', type=click.File('w'))
+@click.argument('filename', type=click.File('wb'))
 @click.option('--exclude-unused/--no-exclude-unused', default=True,
               show_default=True, help='Exclude unused IDs')
+@click.option('--since-idx', type=int,
+              help='Only export IDs loaded after the one with this idx')
+@click.option('--since', type=click.DateTime(),
+              help='Only export IDs assigned or changed at or after this '
+                   'time (UTC)')
+@click.option('--gzip/--no-gzip', 'compress', default=None,
+              help='Compress output  [default: if FILENAME ends in .gz]')
 @click.pass_obj
-def export_map(db, pid, filename, exclude_unused):
+def export_map(db, pid, filename, exclude_unused, since_idx, since, compress):
     """Export CSV file mapping IDs to REDCap records"""
-    map = db.export_map(pid)
+    if since is not None:
+        since = since.strftime('%Y-%m-%d %H:%M:%S')
+    map = db.export_map(pid, exclude_unused, since_idx, since)
     
-    if exclude_unused:
-        map = [row for row in map if row[1]]
+    if compress is None:
+        compress = getattr(filename, 'name', '').endswith('.gz')
+    out = gzip.open(filename, 'wb') if compress else filename
     
-    csv_file = csv.writer(filename)
+    # Rows are written as they are read, so memory use doesn't depend on
+    # the size of the table
+    f = io.TextIOWrapper(out, newline='')
+    csv_file = csv.writer(f)
     csv_file.writerow(('id','record'))
     csv_file.writerows(map)
+    
+    # Leave FILENAME itself to be closed by click (it may be stdout)
+    f.flush()
+    f.detach()
+    if compress:
+        out.close()
+
+def export_records(context, record_id):
+    """Stream unique record names from a REDCap project"""
+    
+    # CSV can be parsed line by line as it arrives, unlike a JSON array
+    payload = {'content':'record', 'format':'csv', 'fields':[record_id]}
+    result = redcap_api(id_gen.service, config, context, payload, payload,
+                        stream=True)
+    if not result.ok:
+        sys.exit(f'Export failed: REDCap API returned {result.status_code}')
+    result.encoding = result.encoding or 'utf-8'
+    
+    # Records repeat for each event in longitudinal projects
+    seen = set()
+    for row in csv.DictReader(result.iter_lines(decode_unicode=True)):
+        record = row[record_id]
+        if record not in seen:
+            seen.add(record)
+            yield record
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def read_checkpoint(filename, pid):
+    """Return (records done, last record done) from a checkpoint file"""
+    try:
+        with open(filename) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0, None
+    if checkpoint['pid'] != pid:
+        sys.exit(f'Checkpoint "{filename}" is for project {checkpoint["pid"]}')
+    return checkpoint['done'], checkpoint['last']
+
+def write_checkpoint(filename, pid, done, last):
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump({'pid':pid, 'done':done, 'last':last}, f)
+    os.replace(f'{filename}.tmp', filename)
 
 @click.command()
 @click.argument('pid')
 @click.argument('redcap_url')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Number of records per import')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of imports to run at the same time')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File in which to record progress; if it exists, resume '
+                   'from where the previous run stopped')
 @click.pass_obj
-def refresh_ids(db, pid, redcap_url):
+def refresh_ids(db, pid, redcap_url, chunk_size, workers, checkpoint):
     """Refresh all IDs for a given project
     
     May be used to assign IDs for existing records that do not yet have them.
+    Records are exported and their IDs imported back into REDCap in chunks.
     """
     p_settings = getattr(config.settings, f'{id_gen.service}_{pid}')
     record_id = p_settings.get('record_id', 'record_id')
     id_field = p_settings['id_field']
     
     context = dict(project_id=pid, redcap_url=redcap_url)
-    payload = {'content':'record', 'format':'json', 'fields':[record_id]}
-    records = redcap_api(id_gen.service, config, context, payload, payload).json()
-    
-    data = []
-    done = []
-    for record in records:
-        if record[record_id] not in done:
-            data.append({record_id:record[record_id],
-                         id_field:db.get_id(pid, record[record_id])})
-            done.append(record[record_id])
-    
-    payload = {'content':'record',
-               'format':'json',
-               'data':json.dumps(data, separators=(',',':'))}
-    
-    result = redcap_api(id_gen.service, config, context, payload, payload)
-    print(f'{result.json()["count"]} records refreshed')
+    records = export_records(context, record_id)
+    
+    # Skip records already refreshed by a previous run, provided the project
+    # still lists them in the same order
+    done, last = read_checkpoint(checkpoint, pid) if checkpoint else (0, None)
+    if done:
+        skipped = list(islice(records, done))
+        if len(skipped) < done or skipped[-1] != last:
+            sys.exit(f'Records have changed since checkpoint "{checkpoint}" '
+                     f'was written; remove it to start over')
+        click.echo(f'Resuming after {done} records', err=True)
+    
+    def refresh(chunk, ids):
+        data = [{record_id:record, id_field:id}
+                for record, id in ids.items() if id]
+        payload = {'content':'record',
+                   'format':'json',
+                   'data':json.dumps(data, separators=(',',':'))}
+        result = redcap_api(id_gen.service, config, context, payload,
+                            f'refresh {len(data)} records from {chunk[0]}')
+        result.raise_for_status()
+        db.mark_written(pid, [(record, id) for record, id in ids.items()
+                              if id])
+        return len(chunk), result.json()['count'], len(chunk)-len(data)
+    
+    # Chunks may finish out of order; the checkpoint only advances over the
+    # leading run of finished chunks
+    refreshed = missing = 0
+    finished, pending, failed = {}, {}, None
+    n = 0
+    with ThreadPoolExecutor(workers) as pool:
+        chunks = enumerate(chunked(records, chunk_size))
+        while True:
+            # Keep a bounded number of chunks in memory. IDs are claimed
+            # here, so that they are assigned in the order of the records.
+            for i, chunk in islice(chunks, 2*workers - len(pending)):
+                ids = db.assign_ids(pid, chunk)
+                pending[pool.submit(refresh, chunk, ids)] = (i, chunk[-1])
+            if not pending:
+                break
+            
+            complete, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in complete:
+                i, last_record = pending.pop(future)
+                try:
+                    size, count, no_id = future.result()
+                except Exception as e:
+                    failed = e
+                    continue
+                finished[i] = (size, last_record)
+                refreshed += count
+                missing += no_id
+            
+            while n in finished:
+                size, last = finished.pop(n)
+                done += size
+                n += 1
+            if checkpoint and n:
+                write_checkpoint(checkpoint, pid, done, last)
+            click.echo(f'{done} records done, {refreshed} refreshed', err=True)
+            
+            if failed:
+                # Let running imports finish, but don't start any more
+                chunks = iter(())
+    
+    if missing:
+        print(f'No IDs left for {missing} records')
+    if failed:
+        sys.exit(f'Import failed: {failed!r}' +
+                 (f'; rerun to resume from "{checkpoint}"' if checkpoint else ''))
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    print(f'{refreshed} records refreshed')
+
+@click.command()
+@click.argument('pid')
+@click.argument('filename', type=click.File('r'))
+@click.argument('output', type=click.File('w'), default='-')
+@click.pass_obj
+def assign_ids(db, pid, filename, output):
+    """Assign IDs to a list of records
+    
+    FILENAME should contain one REDCap record per line. Records that do not
+    yet have an ID are assigned one, and the IDs of all of the records are
+    written as CSV with header "id,record" to OUTPUT (default: stdout).
+    """
+    records = [record for record in filename.read().splitlines() if record]
+    ids = db.assign_ids(pid, records)
+    
+    csv_file = csv.writer(output)
+    csv_file.writerow(('id','record'))
+    csv_file.writerows((id, record) for record, id in ids.items())
+    
+    missing = sum(1 for id in ids.values() if not id)
+    if missing:
+        sys.exit(f'No IDs left for {missing} records')
+
+def count_cycles(corrections):
+    """Count corrections that exchange IDs among themselves, e.g., swaps"""
+    # Corrections to the same ID change nothing (and aren't made)
+    moves = {current: new for current, new in corrections if current != new}
+    seen, cycles = set(), 0
+    for start in moves:
+        id = start
+        path = set()
+        while id in moves and id not in seen and id not in path:
+            path.add(id)
+            id = moves[id]
+        # Stopping on this path (not an earlier one) means a new cycle
+        cycles += id in path
+        seen |= path
+    return cycles
+
+def push_ids(context, record_id, id_field, rows, chunk_size, phase):
+    """Import IDs for (record, ID) pairs into REDCap, in chunks"""
+    done = 0
+    for chunk in chunked(rows, chunk_size):
+        data = [{record_id:record, id_field:id} for record, id in chunk]
+        payload = {'content':'record',
+                   'format':'json',
+                   'data':json.dumps(data, separators=(',',':'))}
+        result = redcap_api(id_gen.service, config, context, payload,
+                            f'{phase}: {len(data)} records from {chunk[0][0]}')
+        if not result.ok:
+            sys.exit(f'{phase} failed after {done} records: '
+                     f'{result.status_code} {result.text}')
+        done += len(data)
+        click.echo(f'{phase}: {done} of {len(rows)} records', err=True)
+
+@click.command()
+@click.argument('pid')
+@click.argument('filename', type=click.File('r'))
+@click.argument('redcap_url', required=False)
+@click.option('--plan', type=click.File('w'),
+              help='File in which to save the corrections made, including '
+                   'intermediate IDs, as CSV')
+@click.option('--redcap-only', is_flag=True,
+              help='Update REDCap only, from a plan saved by a previous run')
+@click.option('--dry-run', is_flag=True,
+              help='Check corrections and show plan without making changes')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Number of records per import')
+@click.pass_obj
+def correct_ids(db, pid, filename, redcap_url, plan, redcap_only, dry_run,
+                chunk_size):
+    """Correct IDs in database and REDCap
+    
+    FILENAME should be a CSV file with header "current_id,corrected_id".
+    Corrections may swap IDs or move them around in cycles, in which case
+    IDs are changed to unique intermediate IDs first. All changes to the
+    database are made in one transaction; then, if REDCAP_URL is given, the
+    IDs of affected records are imported into REDCap (to intermediate IDs,
+    and then to corrected IDs).
+    
+    With --redcap-only, FILENAME should instead be a plan saved with --plan,
+    e.g., to finish updating REDCap after a failed import.
+    """
+    reader = csv.reader(filename)
+    header = next(reader, [])
+    
+    if redcap_only:
+        if header != ['record','current_id','intermediate_id','corrected_id']:
+            sys.exit('First row invalid; expected header '
+                     '"record,current_id,intermediate_id,corrected_id"')
+        elif not redcap_url:
+            sys.exit('REDCAP_URL is required with --redcap-only')
+        rows = [(row[0], row[1], row[2] or None, row[3]) for row in reader]
+    else:
+        if header != ['current_id','corrected_id']:
+            sys.exit('First row invalid; expected header '
+                     '"current_id,corrected_id"')
+        
+        corrections = []
+        for lineno, row in enumerate(reader, 2):
+            if len(row) < 2 or not row[0] or not row[1]:
+                sys.exit(f'Current and/or corrected ID missing on line '
+                         f'{lineno}')
+            corrections.append((row[0], row[1]))
+        
+        rows = db.correct_ids(pid, corrections, dry_run)
+        cycles = count_cycles(corrections)
+        print(f'{len(rows)} IDs {"to be " if dry_run else ""}corrected for '
+              f'project {pid}; {cycles} swaps or cycles')
+    
+    if plan or dry_run:
+        csv_file = csv.writer(plan or sys.stdout)
+        csv_file.writerow(('record','current_id','intermediate_id',
+                           'corrected_id'))
+        csv_file.writerows(rows)
+        if plan:
+            plan.close()
+    if dry_run or not redcap_url:
+        return
+    
+    p_settings = getattr(config.settings, f'{id_gen.service}_{pid}')
+    record_id = p_settings.get('record_id', 'record_id')
+    id_field = p_settings['id_field']
+    context = dict(project_id=pid, redcap_url=redcap_url)
+    
+    # Unassigned IDs only need correcting in the database
+    rows = [row for row in rows if row[0]]
+    phase1 = [(record, id) for record, _, id, _ in rows if id]
+    if phase1:
+        push_ids(context, record_id, id_field, phase1, chunk_size,
+                 'intermediate IDs')
+    push_ids(context, record_id, id_field,
+             [(record, id) for record, _, _, id in rows], chunk_size,
+             'corrected IDs')
+    print(f'{len(rows)} records updated in REDCap')
 
-commands = [load_ids, import_map, export_map, refresh_ids]
+commands = [load_ids, import_map, export_map, refresh_ids, assign_ids,
+            correct_ids]
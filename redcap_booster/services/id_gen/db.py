@@ -1,78 +1,517 @@
 import sqlite3
-from redcap_booster import config
+from contextlib import contextmanager
+from itertools import islice
+from redcap_booster import config, metrics
+from redcap_booster.profiling import profiler, timed
+from .cache import IdCache
+from .generator import IdGenerator
+import os
 import random
+import string
 import sys
+import threading
+
+# Connection settings; may be overridden with "pragmas" in service settings,
+# e.g., id_gen = '{"db":"id_gen.db", "pragmas":{"synchronous":"FULL"}}'
+PRAGMAS = {'journal_mode': 'WAL',
+           'synchronous': 'NORMAL',
+           'busy_timeout': 30000,
+           'cache_size': -16000,
+           'mmap_size': 268435456}
+
+class DryRun(Exception):
+    """Raised to roll back a transaction that was only a trial"""
+
+# Time (UTC) at which a record was assigned to an ID, or the mapping changed
+NOW = "strftime('%Y-%m-%d %H:%M:%S','now')"
 
 class DatabaseAccess:
-    """Manage access to database for ID generation service"""
+    """Manage access to database for ID generation service
+    
+    Each thread (and process) opens its own connection on first use, so one
+    instance may be shared by concurrent requests. Writes take the database
+    lock when they begin, which also makes it safe for several server
+    processes to use the same database file.
+    
+    IDs come from a pool loaded with load_ids, unless the project's settings
+    include a "generator", in which case they are minted on demand.
+    """
     
     def __init__(self, service):
-        db = getattr(config.settings, f'{service}')['db']
-        self.con = sqlite3.connect(db)
-        self.cur = self.con.cursor()
+        s_settings = getattr(config.settings, f'{service}')
+        self.service = service
+        self.db = s_settings['db']
+        self.pragmas = {**PRAGMAS, **s_settings.get('pragmas', {})}
+        self.local = threading.local()
+        self.migrated = set()
+        self.cache = IdCache(s_settings.get('record_cache_size', 100000))
+        self.generators = {}
+    
+    @property
+    def con(self):
+        # Don't reuse a connection inherited from a parent process
+        if getattr(self.local, 'pid', None) != os.getpid():
+            con = sqlite3.connect(self.db, isolation_level=None,
+                                  timeout=self.pragmas['busy_timeout']/1000)
+            for name, value in self.pragmas.items():
+                assert name.isidentifier()
+                con.execute(f'PRAGMA {name}={value}')
+            con.execute('CREATE TABLE IF NOT EXISTS generations (\n'
+                        '    pid TEXT PRIMARY KEY,\n'
+                        '    n INTEGER NOT NULL\n'
+                        ')')
+            # Next counter value of projects with generated IDs
+            con.execute('CREATE TABLE IF NOT EXISTS counters (\n'
+                        '    pid TEXT PRIMARY KEY,\n'
+                        '    n INTEGER NOT NULL\n'
+                        ')')
+            self.local.con = con
+            self.local.cur = con.cursor()
+            self.local.pid = os.getpid()
+        return self.local.con
+    
+    @property
+    def cur(self):
+        self.con
+        return self.local.cur
+    
+    @contextmanager
+    def transaction(self):
+        """Run statements in a write transaction on this thread's connection"""
+        cur = self.cur
+        # Waits for other writers, in this and other processes
+        with profiler.span('db.begin'):
+            cur.execute('BEGIN IMMEDIATE')
+        try:
+            yield cur
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+    
+    def close(self):
+        """Close this thread's connection"""
+        if getattr(self.local, 'pid', None) == os.getpid():
+            self.local.con.close()
+        self.local.pid = None
     
     def create_table(self, pid):
         assert pid.isdecimal()
         self.cur.execute(f'CREATE TABLE IF NOT EXISTS pid_{pid} (\n'
                           '    idx INTEGER PRIMARY KEY,\n'
                           '    id TEXT UNIQUE NOT NULL,\n'
-                          '    record TEXT UNIQUE\n'
+                          '    record TEXT UNIQUE,\n'
+                          '    updated TEXT,\n'
+                          '    written INTEGER\n'
                           ')')
+        self.migrate(pid)
     
-    def import_map(self, pid, map):
+    def migrate(self, pid):
+        """Add columns missing from tables created by earlier versions"""
         assert pid.isdecimal()
-        self.create_table(pid)
+        if pid in self.migrated:
+            return
         
-        self.cur.execute(f'SELECT * from pid_{pid} LIMIT 1')
-        if self.cur.fetchone():
-            sys.exit(f'Table pid_{pid} is not empty')
+        self.cur.execute(f'PRAGMA table_info(pid_{pid})')
+        columns = [row[1] for row in self.cur.fetchall()]
+        if not columns:
+            return
+        if 'updated' not in columns:
+            self.cur.execute(f'ALTER TABLE pid_{pid} ADD COLUMN updated TEXT')
+        # Set once the record's ID is known to be in REDCap
+        if 'written' not in columns:
+            self.cur.execute(f'ALTER TABLE pid_{pid} ADD COLUMN written '
+                             f'INTEGER')
+        self.migrated.add(pid)
+    
+    @timed('db.generation')
+    def generation(self, pid):
+        """Return counter of changes to existing record to ID mappings"""
+        self.cur.execute('SELECT n FROM generations WHERE pid=?', (pid,))
+        n = self.cur.fetchone()
+        return n[0] if n else 0
+    
+    def remapped(self, pid):
+        """Record (in a transaction) that existing mappings have changed"""
+        self.cur.execute('INSERT INTO generations (pid, n) VALUES (?,1) '
+                         'ON CONFLICT (pid) DO UPDATE SET n=n+1', (pid,))
+        self.cache.clear(pid)
+    
+    def generator(self, pid):
+        """Return the project's IdGenerator, or None if it uses a pool"""
+        p_settings = getattr(config.settings, f'{self.service}_{pid}', {})
+        g_settings = p_settings.get('generator')
+        if not g_settings:
+            return None
+        cached = self.generators.get(pid)
+        if cached is None or cached[0] != g_settings:
+            cached = self.generators[pid] = (g_settings,
+                                             IdGenerator(**g_settings))
+        return cached[1]
+    
+    def mint(self, pid, records, generator):
+        """Assign new IDs to records without one (in a transaction)
+        
+        Each ID takes the next value of the project's counter. IDs already in
+        the table (e.g., imported) are skipped. Returns a dict of record to
+        ID, without the records left over if the IDs run out.
+        """
+        cur = self.cur
+        if pid not in self.migrated:
+            self.create_table(pid)
         
-        self.cur.executemany(f'INSERT INTO pid_{pid} VALUES (NULL,?,?)', map)
-        self.con.commit()
+        ids = {}
+        for record in records:
+            while True:
+                cur.execute('INSERT INTO counters (pid, n) VALUES (?,1) '
+                            'ON CONFLICT (pid) DO UPDATE SET n=n+1 '
+                            'RETURNING n-1', (pid,))
+                n = cur.fetchone()[0]
+                if n >= generator.size:
+                    return ids
+                id = generator(n)
+                cur.execute(f'INSERT OR IGNORE INTO pid_{pid} '
+                            f'(id, record, updated) VALUES (?,?,{NOW})',
+                            (id, record))
+                if cur.rowcount:
+                    ids[record] = id
+                    break
+        return ids
     
-    def load_ids(self, pid, ids, random_order=False):
+    def fill_cache(self, pid):
+        """Cache the most recently assigned IDs written to REDCap"""
+        assert pid.isdecimal()
+        self.migrate(pid)
+        generation = self.generation(pid)
+        cur = self.con.cursor()
+        try:
+            cur.execute(f'SELECT id, record FROM pid_{pid} '
+                        f'WHERE record IS NOT NULL AND written '
+                        f'ORDER BY idx DESC LIMIT ?', (self.cache.size,))
+        except sqlite3.OperationalError:
+            # No IDs loaded yet
+            return 0
+        rows = cur.fetchall()
+        self.cache.fill(pid, reversed(rows), generation)
+        return len(rows)
+    
+    @timed('db.mark_written')
+    def mark_written(self, pid, ids):
+        """Record that IDs ((record, ID) pairs) have been written to REDCap"""
+        assert pid.isdecimal()
+        self.migrate(pid)
+        with self.transaction() as cur:
+            cur.executemany(f'UPDATE pid_{pid} SET written=1 '
+                            f'WHERE record=? AND id=?', ids)
+    
+    @timed('db.free_ids')
+    def free_ids(self, pid):
+        """Return number of unassigned IDs, or None if none were loaded"""
+        assert pid.isdecimal()
+        cur = self.con.cursor()
+        generator = self.generator(pid)
+        if generator is not None:
+            cur.execute('SELECT n FROM counters WHERE pid=?', (pid,))
+            row = cur.fetchone()
+            return max(generator.size - (row[0] if row else 0), 0)
+        try:
+            # Counted through the UNIQUE index on record, where NULLs are
+            # stored together
+            cur.execute(f'SELECT count(*) FROM pid_{pid} WHERE record IS NULL')
+        except sqlite3.OperationalError:
+            return None
+        return cur.fetchone()[0]
+    
+    def collect_metrics(self):
+        """Update free ID counts of the projects using this service"""
+        for pid in config.settings.pids:
+            if getattr(config.settings, f'{self.service}_{pid}', None):
+                free = self.free_ids(pid)
+                if free is not None:
+                    metrics.free_ids.set(free, service=self.service,
+                                         project=pid)
+    
+    def import_map(self, pid, map):
         assert pid.isdecimal()
-        self.create_table(pid)
         
-        self.cur.execute(f'SELECT id from pid_{pid}')
-        old_ids = self.cur.fetchall()
-        new_ids = [(id,) for id in ids if (id,) not in old_ids]
-        if len(new_ids) < len(ids):
-            print(f'{len(ids)-len(new_ids)} of {len(ids)} IDs already loaded;',
-                  end=' ')
+        with self.transaction() as cur:
+            self.create_table(pid)
+            
+            cur.execute(f'SELECT * from pid_{pid} LIMIT 1')
+            if cur.fetchone():
+                sys.exit(f'Table pid_{pid} is not empty')
+            
+            cur.executemany(f'INSERT INTO pid_{pid} (id, record, updated) '
+                            f'VALUES (?,?,{NOW})', map)
+            self.remapped(pid)
+    
+    def load_ids(self, pid, ids, random_order=False, chunk_size=100000):
+        """Add IDs to the pool, skipping any that are already loaded
+        
+        IDs may be any iterable and are inserted in chunks, each committed
+        separately, so loading can be safely repeated if interrupted.
+        Returns the numbers of IDs loaded and skipped.
+        """
+        assert pid.isdecimal()
         
+        # Shuffling requires all of the IDs at once
         if random_order:
-            random.shuffle(new_ids)
+            ids = list(ids)
+            random.shuffle(ids)
         
-        self.cur.executemany(f'INSERT INTO pid_{pid} VALUES (NULL,?,NULL)',
-                             new_ids)
-        self.con.commit()
-        print(f'{len(new_ids)} new IDs loaded for project {pid}')
+        with self.transaction():
+            self.create_table(pid)
+        
+        loaded = skipped = 0
+        iterator = iter(ids)
+        while chunk := list(islice(iterator, chunk_size)):
+            with self.transaction() as cur:
+                # The UNIQUE constraint on id does the deduplication
+                cur.executemany(f'INSERT OR IGNORE INTO pid_{pid} (id) '
+                                f'VALUES (?)', ((id,) for id in chunk))
+                loaded += cur.rowcount
+                skipped += len(chunk) - cur.rowcount
+        
+        return loaded, skipped
     
+    @timed('db.get_id')
     def get_id(self, pid, record):
         assert pid.isdecimal()
         
+        generator = self.generator(pid)
+        if generator is not None and pid not in self.migrated:
+            with self.transaction():
+                self.create_table(pid)
+        
+        # Most triggers are for records that already have an ID, which
+        # doesn't require a write lock
         self.cur.execute(f'SELECT id FROM pid_{pid} WHERE record=?', (record,))
         id = self.cur.fetchone()
         if id:
             return id[0]
         
-        else:
-            q = f'SELECT id FROM pid_{pid} WHERE record IS NULL ORDER BY idx LIMIT 1'
-            self.cur.execute(q)
-            id = self.cur.fetchone()
+        with self.transaction() as cur:
+            
+            # Check again now that the lock is held, then mint an ID or
+            # claim the first free ID in a single statement. Unassigned IDs
+            # are found through the UNIQUE index on record, where NULLs are
+            # stored in idx order, so this doesn't scan the assigned part of
+            # the table.
+            cur.execute(f'SELECT id FROM pid_{pid} WHERE record=?', (record,))
+            id = cur.fetchone()
+            if not id and generator is not None:
+                return self.mint(pid, [record], generator).get(record)
+            elif not id:
+                self.migrate(pid)
+                cur.execute(f'UPDATE pid_{pid} SET record=?, updated={NOW} '
+                            f'WHERE idx=('
+                            f'    SELECT idx FROM pid_{pid} WHERE record IS NULL'
+                            f'    ORDER BY idx LIMIT 1'
+                            f') RETURNING id', (record,))
+                id = cur.fetchone()
             if id:
-                self.cur.execute(f'UPDATE pid_{pid} SET record=? WHERE id=?',
-                                 (record, id[0]))
-                self.con.commit()
                 return id[0]
     
-    def export_map(self, pid):
+    @timed('db.assign_ids')
+    def assign_ids(self, pid, records):
+        """Return IDs for many records at once, claiming IDs as necessary
+        
+        Returns a dict mapping each record to its ID (None if no IDs are
+        left). Free IDs are claimed in the order the records are given, as
+        with repeated calls to get_id(), but in a single transaction.
+        """
+        assert pid.isdecimal()
+        generator = self.generator(pid)
+        
+        with self.transaction() as cur:
+            if generator is not None and pid not in self.migrated:
+                self.create_table(pid)
+            cur.execute('CREATE TEMP TABLE IF NOT EXISTS assign (\n'
+                        '    pos INTEGER PRIMARY KEY,\n'
+                        '    record TEXT UNIQUE\n'
+                        ')')
+            cur.execute('CREATE TEMP TABLE IF NOT EXISTS assign_new (\n'
+                        '    n INTEGER PRIMARY KEY,\n'
+                        '    record TEXT\n'
+                        ')')
+            cur.execute('CREATE TEMP TABLE IF NOT EXISTS assign_free (\n'
+                        '    n INTEGER PRIMARY KEY,\n'
+                        '    idx INTEGER\n'
+                        ')')
+            cur.executemany('INSERT OR IGNORE INTO temp.assign (record) '
+                            'VALUES (?)', ((record,) for record in records))
+            
+            # Number the records without an ID and the free IDs, both in
+            # order, and pair them up
+            cur.execute(f'INSERT INTO temp.assign_new (record) '
+                        f'SELECT record FROM temp.assign a WHERE NOT EXISTS '
+                        f'(SELECT 1 FROM pid_{pid} p WHERE p.record=a.record) '
+                        f'ORDER BY pos')
+            n = cur.rowcount
+            if n and generator is not None:
+                cur.execute('SELECT record FROM temp.assign_new ORDER BY n')
+                self.mint(pid, [row[0] for row in cur.fetchall()], generator)
+            elif n:
+                self.migrate(pid)
+                cur.execute(f'INSERT INTO temp.assign_free (idx) '
+                            f'SELECT idx FROM pid_{pid} WHERE record IS NULL '
+                            f'ORDER BY idx LIMIT ?', (n,))
+                cur.execute(f'UPDATE pid_{pid} SET record=new.record, '
+                            f'updated={NOW} '
+                            f'FROM temp.assign_free free '
+                            f'JOIN temp.assign_new new USING (n) '
+                            f'WHERE pid_{pid}.idx=free.idx')
+            
+            cur.execute(f'SELECT a.record, p.id FROM temp.assign a '
+                        f'LEFT JOIN pid_{pid} p ON p.record=a.record '
+                        f'ORDER BY a.pos')
+            ids = dict(cur.fetchall())
+            for table in ('assign', 'assign_new', 'assign_free'):
+                cur.execute(f'DELETE FROM temp.{table}')
+        
+        return ids
+    
+    def correct_ids(self, pid, corrections, dry_run=False):
+        """Replace IDs, given pairs of (current ID, corrected ID)
+        
+        Corrections may exchange IDs among themselves (e.g., swaps or
+        cycles). In that case, IDs are first changed to unique intermediate
+        values and then to their corrected values, so that no two rows ever
+        share an ID; either way, all changes are made in one transaction.
+        Returns a list of (record, current ID, intermediate ID, corrected ID),
+        where the intermediate ID is None if one wasn't needed.
+        """
         assert pid.isdecimal()
         
-        map = []
-        self.cur.execute(f'SELECT id,record FROM pid_{pid} ORDER BY idx')
-        for row in self.cur:
-            map.append(row)
+        corrections = [(c, n) for c, n in corrections if c != n]
+        current = [c for c, n in corrections]
+        corrected = [n for c, n in corrections]
+        if len(current) != len(set(current)):
+            sys.exit('Duplicate current IDs found')
+        elif len(corrected) != len(set(corrected)):
+            sys.exit('Duplicate corrected IDs found')
+        two_phase = not set(current).isdisjoint(corrected)
+        
+        plan = []
+        try:
+            with self.transaction() as cur:
+                self.migrate(pid)
+                cur.execute('CREATE TEMP TABLE IF NOT EXISTS correct (\n'
+                            '    current TEXT PRIMARY KEY,\n'
+                            '    corrected TEXT UNIQUE NOT NULL,\n'
+                            '    intermediate TEXT UNIQUE\n'
+                            ')')
+                cur.execute('DELETE FROM temp.correct')
+                cur.executemany('INSERT INTO temp.correct (current, corrected) '
+                                'VALUES (?,?)', corrections)
+                
+                cur.execute(f'SELECT current FROM temp.correct c '
+                            f'WHERE NOT EXISTS '
+                            f'(SELECT 1 FROM pid_{pid} p WHERE p.id=c.current)')
+                missing = [row[0] for row in cur.fetchall()]
+                if missing:
+                    sys.exit(f'{len(missing)} current IDs not found: '
+                             f'{", ".join(missing[:10])}')
+                
+                # A corrected ID may only be in use if it is also corrected
+                cur.execute(f'SELECT corrected FROM temp.correct c '
+                            f'WHERE EXISTS '
+                            f'(SELECT 1 FROM pid_{pid} p WHERE p.id=c.corrected) '
+                            f'AND NOT EXISTS '
+                            f'(SELECT 1 FROM temp.correct o '
+                            f'WHERE o.current=c.corrected)')
+                taken = [row[0] for row in cur.fetchall()]
+                if taken:
+                    sys.exit(f'{len(taken)} corrected IDs already in use: '
+                             f'{", ".join(taken[:10])}')
+                
+                if two_phase:
+                    self.intermediate_ids(pid)
+                    cur.execute(f'UPDATE pid_{pid} SET id=c.intermediate '
+                                f'FROM temp.correct c '
+                                f'WHERE pid_{pid}.id=c.current')
+                    cur.execute(f'UPDATE pid_{pid} SET id=c.corrected, '
+                                f'updated={NOW}, written=NULL '
+                                f'FROM temp.correct c '
+                                f'WHERE pid_{pid}.id=c.intermediate')
+                else:
+                    cur.execute(f'UPDATE pid_{pid} SET id=c.corrected, '
+                                f'updated={NOW}, written=NULL '
+                                f'FROM temp.correct c '
+                                f'WHERE pid_{pid}.id=c.current')
+                
+                cur.execute(f'SELECT p.record, c.current, c.intermediate, '
+                            f'c.corrected FROM temp.correct c '
+                            f'JOIN pid_{pid} p ON p.id=c.corrected '
+                            f'ORDER BY p.idx')
+                plan = cur.fetchall()
+                cur.execute('DELETE FROM temp.correct')
+                self.remapped(pid)
+                
+                if dry_run:
+                    raise DryRun
+        except DryRun:
+            pass
+        
+        return plan
+    
+    def intermediate_ids(self, pid):
+        """Assign random, unused intermediate IDs to pending corrections
+        
+        Intermediate IDs have the same length and characters as those
+        produced by generate_intermediate_ids.py, but are checked against
+        all IDs in the table and in the corrections.
+        """
+        chars = string.ascii_uppercase + string.digits
+        cur = self.cur
+        
+        attempt = 0
+        while True:
+            cur.execute('SELECT current FROM temp.correct '
+                        'WHERE intermediate IS NULL')
+            todo = [row[0] for row in cur.fetchall()]
+            if not todo:
+                break
+            
+            # Lengthen IDs if short ones keep colliding
+            extra = attempt // 10
+            attempt += 1
+            rows = [(''.join(random.choices(chars, k=len(id)+extra)), id)
+                    for id in todo]
+            cur.executemany('UPDATE OR IGNORE temp.correct SET intermediate=? '
+                            'WHERE current=?', rows)
+            cur.execute(f'UPDATE temp.correct SET intermediate=NULL '
+                        f'WHERE intermediate IN (SELECT id FROM pid_{pid}) '
+                        f'OR intermediate IN (SELECT corrected FROM temp.correct)')
+    
+    def export_map(self, pid, exclude_unused=False, since_idx=None,
+                   since=None):
+        """Generate (id, record) rows in order
+        
+        Optionally only rows with a record, rows added after idx since_idx,
+        and rows assigned or changed at or after since ('YYYY-MM-DD HH:MM:SS'
+        in UTC).
+        """
+        assert pid.isdecimal()
+        
+        if since is not None and pid not in self.migrated:
+            with self.transaction():
+                self.migrate(pid)
+        
+        q = f'SELECT id,record FROM pid_{pid} WHERE 1=1'
+        args = []
+        if exclude_unused:
+            q += ' AND record IS NOT NULL'
+        if since_idx is not None:
+            q += ' AND idx>?'
+            args.append(since_idx)
+        if since is not None:
+            q += ' AND updated>=?'
+            args.append(since)
+        q += ' ORDER BY idx'
         
-        return map
+        # Own cursor, since other queries may run while rows are consumed
+        cur = self.con.cursor()
+        cur.execute(q, args)
+        while rows := cur.fetchmany(10000):
+            yield from rows
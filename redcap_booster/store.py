@@ -0,0 +1,146 @@
+"""Project settings stored in a SQLite database, changeable while running
+
+Each row sets, for one project, its API key ("key"), its REDCap API token
+("token"), or the settings of one service (named after the service, as a
+JSON object), just as key_[pid], token_[pid] and [service]_[pid] do in .env.
+Settings are read through an in-memory snapshot, which a watcher thread
+replaces as a whole whenever another connection (e.g., rbutils projects)
+commits a change, so lookups are dict reads and triggers in flight are
+unaffected.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger('request')
+
+# Names of settings other than those of services
+KEY, TOKEN = 'key', 'token'
+
+Snapshot = namedtuple('Snapshot', ['pids', 'values'])
+
+class ConfigStore:
+    """Manage access to the project settings database"""
+    
+    def __init__(self, db):
+        self.db = db
+        self.local = threading.local()
+        self.create_table()
+        self.snapshot = self.read()
+    
+    @property
+    def con(self):
+        # One connection per thread; transactions are managed explicitly
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.db, timeout=30, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            self.local.con = con
+        return con
+    
+    def create_table(self):
+        self.con.execute('CREATE TABLE IF NOT EXISTS project_settings (\n'
+                         '    project_id TEXT NOT NULL,\n'
+                         '    name TEXT NOT NULL,\n'
+                         '    value TEXT NOT NULL,\n'
+                         '    PRIMARY KEY (project_id, name)\n'
+                         ')')
+    
+    def read(self):
+        """Return a new snapshot of all settings"""
+        pids, values = {}, {}
+        for pid, name, value in self.con.execute(
+                'SELECT project_id, name, value FROM project_settings '
+                'ORDER BY rowid'):
+            pids[pid] = None
+            if name not in (KEY, TOKEN):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    logger.warning(f'Ignoring invalid settings of {name} '
+                                   f'for PID {pid}')
+                    continue
+            values[f'{name}_{pid}'] = value
+        return Snapshot(tuple(pids), values)
+    
+    def refresh(self):
+        """Replace the snapshot; return whether settings have changed"""
+        snapshot = self.read()
+        if snapshot == self.snapshot:
+            return False
+        self.snapshot = snapshot
+        return True
+    
+    def set(self, pid, name, value):
+        """Set a project's key, token, or settings of a service (a dict)"""
+        if name not in (KEY, TOKEN):
+            if not isinstance(value, dict):
+                raise ValueError(f'Settings of {name} must be a JSON object')
+            value = json.dumps(value)
+        self.con.execute('INSERT INTO project_settings VALUES (?, ?, ?) '
+                         'ON CONFLICT (project_id, name) '
+                         'DO UPDATE SET value = excluded.value',
+                         (pid, name, value))
+    
+    def remove(self, pid, name=None):
+        """Remove one setting of a project, or all; return the number"""
+        if name is None:
+            cur = self.con.execute('DELETE FROM project_settings '
+                                   'WHERE project_id = ?', (pid,))
+        else:
+            cur = self.con.execute('DELETE FROM project_settings '
+                                   'WHERE project_id = ? AND name = ?',
+                                   (pid, name))
+        return cur.rowcount
+    
+    def list(self, pid=None):
+        """Return (project ID, name, value) of settings"""
+        if pid is None:
+            return self.con.execute('SELECT * FROM project_settings '
+                                    'ORDER BY project_id, name').fetchall()
+        return self.con.execute('SELECT * FROM project_settings '
+                                'WHERE project_id = ? ORDER BY name',
+                                (pid,)).fetchall()
+    
+    def watch(self, on_change, interval=5.0):
+        """Refresh the snapshot when the database changes; call on_change
+        
+        Checks every interval seconds in a thread; returns a stop function.
+        """
+        stopping = threading.Event()
+        
+        def run():
+            # data_version changes when other connections commit, so this
+            # thread reads with a connection of its own
+            version = None
+            while True:
+                try:
+                    current = self.con.execute(
+                        'PRAGMA data_version').fetchone()[0]
+                    if current != version:
+                        version = current
+                        if self.refresh():
+                            logger.info(f'Project settings changed: '
+                                        f'{len(self.snapshot.pids)} projects '
+                                        f'in {self.db}')
+                            on_change()
+                except Exception:
+                    logger.exception('Reading project settings failed')
+                if stopping.wait(interval):
+                    break
+            con = getattr(self.local, 'con', None)
+            if con is not None:
+                con.close()
+        
+        thread = threading.Thread(target=run, daemon=True,
+                                  name='config-watcher')
+        thread.start()
+        
+        def stop(timeout=10.0):
+            stopping.set()
+            thread.join(timeout)
+        
+        return stop
@@ -0,0 +1,13 @@
+"""Point settings at a scratch directory before redcap_booster is imported"""
+
+import json
+import os
+import tempfile
+
+scratch = tempfile.mkdtemp(prefix='redcap-booster-')
+os.environ.setdefault('REQUEST_LOG', os.path.join(scratch, 'request.log'))
+os.environ.setdefault('REDCAP_LOG', os.path.join(scratch, 'redcap.log'))
+os.environ.setdefault('JOB_DB', os.path.join(scratch, 'jobs.db'))
+os.environ.setdefault('REDCAP_RATE_DB', os.path.join(scratch, 'limits.db'))
+os.environ.setdefault('ID_GEN',
+                      json.dumps({'db': os.path.join(scratch, 'id_gen.db')}))
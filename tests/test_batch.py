@@ -0,0 +1,108 @@
+"""Tests for batching of record imports"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from redcap_booster.batch import ImportBatcher, ImportResult
+
+class Server:
+    """Records the imports sent; fails those with a row for a bad record"""
+    
+    def __init__(self, latency=0.0, error=None):
+        self.latency = latency
+        self.error = error
+        self.imports = []
+        self.log = []
+        self.lock = threading.Lock()
+    
+    def send(self, rows):
+        values = [row['value'] for row in rows]
+        with self.lock:
+            self.imports.append(values)
+            self.log.append(('send', values))
+        time.sleep(self.latency)
+        with self.lock:
+            self.log.append(('done', values))
+        if self.error:
+            raise self.error
+        if any(row['record'] == 'bad' for row in rows):
+            return ImportResult(400, {'error': 'bad record'})
+        return ImportResult(200, {'count': len(rows)})
+
+def submit(batcher, record, value, max_delay=0.05, max_rows=100):
+    rows = [{'record': record, 'value': value}]
+    return batcher.submit(rows, {record}, max_delay, max_rows)
+
+def concurrently(*calls, stagger=0.005):
+    with ThreadPoolExecutor(len(calls)) as pool:
+        futures = []
+        for call in calls:
+            futures.append(pool.submit(*call))
+            time.sleep(stagger)
+        return [future.result() for future in futures]
+
+def test_leader_and_followers():
+    server = Server()
+    batcher = ImportBatcher(server.send)
+    results = concurrently(*((submit, batcher, f'r{i}', i) for i in range(5)))
+    
+    # One import, and each caller gets the count of its own rows
+    assert server.imports == [[0, 1, 2, 3, 4]]
+    assert [r.json() for r in results] == [{'count': 1}] * 5
+    assert batcher.stats() == {'calls': 5, 'imports': 1, 'rows': 5,
+                               'retried': 0}
+
+def test_max_rows():
+    server = Server()
+    batcher = ImportBatcher(server.send)
+    start = time.monotonic()
+    concurrently(*((submit, batcher, f'r{i}', i, 10, 2) for i in range(4)),
+                 stagger=0.001)
+    
+    # Full batches are sent without waiting for the delay
+    assert time.monotonic() - start < 1
+    assert sorted(map(sorted, server.imports)) == [[0, 1], [2, 3]]
+
+def test_failed_import():
+    server = Server()
+    batcher = ImportBatcher(server.send)
+    results = concurrently((submit, batcher, 'r1', 1),
+                           (submit, batcher, 'bad', 2),
+                           (submit, batcher, 'r3', 3))
+    
+    # Each caller's rows are sent again on their own, for its own outcome
+    assert server.imports == [[1, 2, 3], [1], [2], [3]]
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[1].json() == {'error': 'bad record'}
+    assert batcher.stats()['retried'] == 3
+
+def test_errors():
+    server = Server(error=ConnectionError('down'))
+    batcher = ImportBatcher(server.send)
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(submit, batcher, f'r{i}', i) for i in range(2)]
+        for future in futures:
+            with pytest.raises(ConnectionError):
+                future.result()
+    assert server.imports == [[0, 1]]
+
+def test_same_record_in_order():
+    server = Server()
+    batcher = ImportBatcher(server.send)
+    
+    # The pending batch with the record is sent first
+    concurrently((submit, batcher, 'r1', 'old'),
+                 (submit, batcher, 'r2', 'other'),
+                 (submit, batcher, 'r1', 'new'))
+    assert server.imports == [['old', 'other'], ['new']]
+
+def test_same_record_while_sending():
+    server = Server(latency=0.1)
+    batcher = ImportBatcher(server.send)
+    
+    # Rows for a record in an import in flight wait for it to finish
+    concurrently((submit, batcher, 'r1', 'old'),
+                 (submit, batcher, 'r1', 'new'), stagger=0.07)
+    assert server.log == [('send', ['old']), ('done', ['old']),
+                          ('send', ['new']), ('done', ['new'])]
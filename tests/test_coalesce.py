@@ -0,0 +1,79 @@
+"""Tests for coalescing of repeated triggers"""
+
+import asyncio
+import pytest
+from redcap_booster import config
+from redcap_booster.coalesce import Coalescer
+
+WINDOW = 0.05
+
+@pytest.fixture(autouse=True)
+def window(monkeypatch):
+    monkeypatch.setattr(config.settings, 'debounce_window', WINDOW)
+
+class Service:
+    """Records the contexts it runs with; each run takes delay seconds"""
+    
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.contexts = []
+    
+    async def __call__(self, context):
+        self.contexts.append(context)
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return len(self.contexts)
+
+def test_debounce():
+    coalescer = Coalescer()
+    service = Service()
+    
+    async def burst():
+        first = asyncio.ensure_future(coalescer.submit('k', 1, service))
+        await asyncio.sleep(WINDOW / 5)
+        second = asyncio.ensure_future(coalescer.submit('k', 2, service))
+        other = asyncio.ensure_future(coalescer.submit('other', 3, service))
+        return await asyncio.gather(first, second, other)
+    
+    # One run per key, with the latest context, whose outcome all share
+    assert asyncio.run(burst()) == [1, 1, 2]
+    assert service.contexts == [2, 3]
+    assert coalescer.stats() == {'triggers': 3, 'runs': 2, 'coalesced': 1,
+                                 'waiting': 0, 'running': 0}
+
+def test_follow_up_run():
+    coalescer = Coalescer()
+    service = Service(delay=WINDOW * 3)
+    
+    async def during_run():
+        first = asyncio.ensure_future(coalescer.submit('k', 1, service))
+        await asyncio.sleep(WINDOW * 1.5)
+        assert coalescer.stats()['running'] == 1
+        # Triggers during the run are merged into one run after it
+        later = [asyncio.ensure_future(coalescer.submit('k', i, service))
+                 for i in (2, 3, 4)]
+        await asyncio.sleep(WINDOW * 1.2)
+        assert service.contexts == [1]
+        assert coalescer.stats()['waiting'] == 1
+        return await asyncio.gather(first, *later)
+    
+    assert asyncio.run(during_run()) == [1, 2, 2, 2]
+    assert service.contexts == [1, 4]
+    assert coalescer.stats() == {'triggers': 4, 'runs': 2, 'coalesced': 2,
+                                 'waiting': 0, 'running': 0}
+
+def test_errors():
+    coalescer = Coalescer()
+    service = Service(error=ValueError('failed'))
+    
+    async def burst():
+        return await asyncio.gather(
+            *(coalescer.submit('k', i, service) for i in range(2)),
+            return_exceptions=True)
+    
+    # Everyone waiting on the run gets its exception
+    errors = asyncio.run(burst())
+    assert [type(e) for e in errors] == [ValueError, ValueError]
+    assert coalescer.stats()['running'] == 0
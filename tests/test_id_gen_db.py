@@ -0,0 +1,185 @@
+"""Concurrency tests for the ID generation database"""
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import pytest
+from redcap_booster import config
+from redcap_booster.services import id_gen
+from redcap_booster.services.id_gen.cli import count_cycles
+from redcap_booster.services.id_gen.db import DatabaseAccess
+
+PID = '123'
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, 'id_gen',
+                        {'db': str(tmp_path / 'id_gen.db')})
+    db = DatabaseAccess('id_gen')
+    db.load_ids(PID, [f'ID{i:05d}' for i in range(2000)])
+    return db
+
+def claim(db, records, threads):
+    with ThreadPoolExecutor(threads) as pool:
+        ids = list(pool.map(lambda r: db.get_id(PID, r), records))
+    return dict(zip(records, ids))
+
+def claim_in_process(db, records, threads, results):
+    results.put(claim(db, records, threads))
+
+def check(db, assigned, records):
+    assert set(assigned) == set(records)
+    assert None not in assigned.values()
+    assert len(set(assigned.values())) == len(records)
+    
+    # Database agrees with what the callers were given
+    rows = [row for row in db.export_map(PID) if row[1]]
+    assert dict((record, id) for id, record in rows) == assigned
+
+def test_threads(db):
+    # Every record appears several times, as with repeated form saves
+    records = [f'r{i}' for i in range(500)]
+    assigned = claim(db, records * 4, threads=32)
+    check(db, assigned, records)
+
+def test_processes(db):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    records = [f'r{i}' for i in range(800)]
+    
+    # Overlapping record sets, so processes race for the same records too
+    procs = [ctx.Process(target=claim_in_process,
+                         args=(db, records[i*100:i*100+300], 8, results))
+             for i in range(6)]
+    for p in procs:
+        p.start()
+    assigned = {}
+    for p in procs:
+        for record, id in results.get(timeout=120).items():
+            assert assigned.setdefault(record, id) == id
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    
+    check(db, assigned, records)
+
+def test_assign_ids(db):
+    assert db.get_id(PID, 'r5') == 'ID00000'
+    records = ['r1', 'r2', 'r5', 'r2', 'r3']
+    assert db.assign_ids(PID, records) == {'r1': 'ID00001', 'r2': 'ID00002',
+                                           'r5': 'ID00000', 'r3': 'ID00003'}
+    assert db.get_id(PID, 'r4') == 'ID00004'
+    
+    # Pool runs out part way through
+    ids = db.assign_ids(PID, [f'x{i}' for i in range(2000)])
+    assert sum(1 for id in ids.values() if id) == 1995
+    assert ids['x1994'] == 'ID01999' and ids['x1995'] is None
+
+def test_correct_ids(db):
+    for i in range(3):
+        db.get_id(PID, f'r{i}')
+    
+    # A swap, a cycle through an unused ID, and a move to a new ID
+    corrections = [('ID00000', 'ID00001'), ('ID00001', 'ID00000'),
+                   ('ID00002', 'ID00003'), ('ID00003', 'ID00002'),
+                   ('ID00004', 'NEW')]
+    plan = db.correct_ids(PID, corrections, dry_run=True)
+    assert len(plan) == 5 and all(row[2] for row in plan)
+    assert count_cycles(corrections) == 2
+    assert count_cycles([*corrections, ('ID00005', 'ID00005')]) == 2
+    assert db.get_id(PID, 'r0') == 'ID00000'
+    
+    db.correct_ids(PID, corrections)
+    rows = dict((id, record) for id, record in db.export_map(PID))
+    assert rows['ID00000'] == 'r1' and rows['ID00001'] == 'r0'
+    assert rows['ID00002'] is None and rows['ID00003'] == 'r2'
+    assert rows['NEW'] is None and 'ID00004' not in rows
+    assert len(rows) == 2000
+    
+    # No intermediate IDs are needed without overlap
+    assert db.correct_ids(PID, [('ID00001', 'X')]) == [('r0', 'ID00001',
+                                                        None, 'X')]
+
+def test_cache(db):
+    db.get_id(PID, 'r0')
+    db.get_id(PID, 'r1')
+    db.get_id(PID, 'r9')
+    
+    # Only IDs written to REDCap
+    db.mark_written(PID, [('r0', 'ID00000'), ('r1', 'ID00001')])
+    assert db.fill_cache(PID) == 2
+    generation = db.generation(PID)
+    assert db.cache.get(PID, 'r1', generation) == 'ID00001'
+    
+    # Least recently used entries are dropped once full
+    db.cache.size = 2
+    db.cache.get(PID, 'r0', generation)
+    db.cache.put(PID, 'r2', db.get_id(PID, 'r2'), generation)
+    assert db.cache.get(PID, 'r1', generation) is None
+    assert db.cache.get(PID, 'r0', generation) == 'ID00000'
+    
+    # Corrections made through another connection invalidate the cache
+    other = DatabaseAccess('id_gen')
+    other.correct_ids(PID, [('ID00000', 'ID00001'), ('ID00001', 'ID00000')])
+    assert db.generation(PID) != generation
+    assert db.cache.get(PID, 'r0', db.generation(PID)) is None
+
+def test_run_after_changes(db, monkeypatch):
+    imported = []
+    monkeypatch.setattr(id_gen, 'redcap_import',
+                        lambda service, config, context, rows, record_id:
+                        imported.append(rows[0]['cid'])
+                        or SimpleNamespace(ok=True))
+    p_settings = {'id_field': 'cid'}
+    monkeypatch.setattr(config.settings, f'id_gen_{PID}', p_settings,
+                        raising=False)
+    context = {'project_id': PID, 'record': 'r1'}
+    
+    # The ID written is read from the database, even if changed elsewhere
+    id_gen.run(config, context, db=db)
+    db.con.execute(f"UPDATE pid_{PID} SET id='Z' WHERE record='r1'")
+    id_gen.run(config, context, db=db)
+    assert imported == ['ID00000', 'Z']
+    
+    # With skip_existing, IDs written already are skipped until remapped
+    p_settings['skip_existing'] = True
+    id_gen.run(config, context, db=db)
+    id_gen.run(config, context, db=db)
+    assert imported == ['ID00000', 'Z', 'Z']
+    other = DatabaseAccess('id_gen')
+    other.correct_ids(PID, [('Z', 'Y')])
+    id_gen.run(config, context, db=db)
+    assert imported == ['ID00000', 'Z', 'Z', 'Y']
+    
+    # Replayed triggers write the ID regardless
+    id_gen.run(config, dict(context, replay='1'), db=db)
+    assert imported == ['ID00000', 'Z', 'Z', 'Y', 'Y']
+
+def test_failed_write_after_restart(db, monkeypatch):
+    ok = False
+    imported = []
+    monkeypatch.setattr(id_gen, 'redcap_import',
+                        lambda service, config, context, rows, record_id:
+                        imported.append(rows[0]['cid'])
+                        or SimpleNamespace(ok=ok))
+    monkeypatch.setattr(config.settings, 'pids', [PID])
+    monkeypatch.setattr(config.settings, f'id_gen_{PID}',
+                        {'id_field': 'cid', 'skip_existing': True},
+                        raising=False)
+    context = {'project_id': PID, 'record': 'r1'}
+    id_gen.run(config, context, db=db)
+    
+    # IDs whose write failed aren't cached on startup, so are retried
+    restarted = DatabaseAccess('id_gen')
+    id_gen.startup(config, db=restarted)
+    ok = True
+    assert id_gen.run(config, context, db=restarted).ok
+    assert imported == ['ID00000', 'ID00000']
+    id_gen.shutdown(config, db=restarted)
+    
+    # and once written, they are skipped, after a restart too
+    restarted = DatabaseAccess('id_gen')
+    id_gen.startup(config, db=restarted)
+    assert id_gen.run(config, context, db=restarted) is None
+    assert len(imported) == 2
+    id_gen.shutdown(config, db=restarted)
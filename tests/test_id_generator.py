@@ -0,0 +1,85 @@
+"""Tests for IDs generated on demand by the ID generation service"""
+
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from redcap_booster import config
+from redcap_booster.services.id_gen.db import DatabaseAccess
+from redcap_booster.services.id_gen.generator import (IdGenerator,
+                                                       Permutation, damm, luhn)
+
+PID = '123'
+
+@pytest.mark.parametrize('size', [2, 10, 100, 1000, 10**4, 12345])
+def test_permutation_full_space(size):
+    # Every value in range, exactly once
+    for key in ('a', 'another key'):
+        permutation = Permutation(key, size)
+        assert sorted(permutation(n) for n in range(size)) == list(range(size))
+
+def test_permutation_keyed():
+    first = [Permutation('a', 10**6)(n) for n in range(100)]
+    second = [Permutation('b', 10**6)(n) for n in range(100)]
+    assert first != second
+    # Not simply counting
+    assert first != sorted(first)
+
+def test_check_digits():
+    assert luhn('7992739871') == '3'
+    assert damm('572') == '4'
+    
+    # Both catch every single-digit error
+    generator = {check: IdGenerator('k', 5, 'C', check)
+                 for check in ('luhn', 'damm')}
+    for check, g in generator.items():
+        id = g(7)
+        assert g.valid(id)
+        for i in range(1, len(id)):
+            for digit in '0123456789':
+                if digit != id[i]:
+                    assert not g.valid(id[:i] + digit + id[i+1:])
+    assert not generator['luhn'].valid('X' + id[1:])
+
+@pytest.mark.parametrize('check_digit', [None, 'luhn', 'damm'])
+def test_generator_full_space(check_digit):
+    g = IdGenerator('k', 4, 'P', check_digit)
+    ids = [g(n) for n in range(g.size)]
+    assert len(set(ids)) == g.size
+    assert all(g.valid(id) for id in ids)
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, 'id_gen',
+                        {'db': str(tmp_path / 'id_gen.db')})
+    monkeypatch.setattr(config.settings, f'id_gen_{PID}', {
+        'id_field': 'id',
+        'generator': {'prefix': 'G', 'width': 3, 'check_digit': 'damm',
+                      'key': 'test'}}, raising=False)
+    return DatabaseAccess('id_gen')
+
+def test_get_id(db):
+    # Every record appears several times, as with repeated form saves
+    records = [f'r{i}' for i in range(1100)]
+    with ThreadPoolExecutor(16) as pool:
+        ids = list(pool.map(lambda r: db.get_id(PID, r), records * 2))
+    assigned = dict(zip(records * 2, ids))
+    
+    # The whole space is used once, then IDs run out
+    given = [id for id in assigned.values() if id]
+    assert len(given) == 1000 == len(set(given))
+    assert list(assigned.values()).count(None) == 100
+    assert db.free_ids(PID) == 0
+    assert dict((r, id) for id, r in db.export_map(PID)) == {
+        r: id for r, id in assigned.items() if id}
+
+def test_imported_ids_skipped(db):
+    g = db.generator(PID)
+    db.import_map(PID, [(g(0), 'old'), (g(1), 'older')])
+    assert db.get_id(PID, 'new') == g(2)
+    assert db.get_id(PID, 'old') == g(0)
+
+def test_assign_ids(db):
+    g = db.generator(PID)
+    first = db.get_id(PID, 'r0')
+    ids = db.assign_ids(PID, ['r0', 'r1', 'r2'])
+    assert ids == {'r0': first, 'r1': g(1), 'r2': g(2)}
+    assert db.free_ids(PID) == 997
@@ -0,0 +1,113 @@
+"""Tests for the background job queue"""
+
+import json
+import threading
+import time
+import pytest
+from redcap_booster import jobs
+from redcap_booster.jobs import DONE, FAILED, PENDING, RUNNING, JobQueue
+
+CONTEXT = {'project_id': '9', 'record': 'r1', 'instrument': 'reg'}
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.db'), max_attempts=3, backoff=10.0)
+
+def test_enqueue_and_claim(queue):
+    ids = queue.enqueue(['a', 'b'], CONTEXT)
+    assert len(ids) == 2
+    assert queue.counts() == {PENDING: 2}
+    
+    job = queue.claim()
+    assert (job['id'], job['service'], job['attempts']) == (ids[0], 'a', 1)
+    assert json.loads(job['context']) == CONTEXT
+    assert queue.get(ids[0])['status'] == RUNNING
+    queue.complete(job['id'])
+    assert queue.claim()['id'] == ids[1]
+    assert queue.claim() is None
+    assert queue.counts() == {DONE: 1, RUNNING: 1}
+
+def test_delay(queue):
+    first = queue.enqueue(['a'], CONTEXT, delay=60)
+    
+    # A later save replaces the context of the job that is waiting
+    context = dict(CONTEXT, reg_complete='2')
+    assert queue.enqueue(['a'], context, delay=60) == first
+    assert queue.coalesced == 1
+    assert json.loads(queue.get(first[0])['context']) == context
+    assert queue.claim() is None
+
+def test_fail_and_backoff(queue):
+    id, = queue.enqueue(['a'], CONTEXT)
+    for attempt in (1, 2):
+        job = queue.claim()
+        assert job['attempts'] == attempt
+        start = time.time()
+        assert queue.fail(id, job['attempts'], 'error') == PENDING
+        # Not due until the backoff (doubled after each attempt) has passed
+        assert queue.get(id)['run_at'] - start == pytest.approx(
+            10 * 2 ** (attempt-1), abs=1)
+        assert queue.claim() is None
+        queue.con.execute('UPDATE jobs SET run_at=0')
+    
+    job = queue.claim()
+    assert queue.fail(id, job['attempts'], 'error') == FAILED
+    assert queue.get(id)['error'] == 'error'
+    assert queue.claim() is None
+
+def test_replay(queue):
+    failed, done, running = queue.enqueue(['a', 'b', 'c'], CONTEXT)
+    queue.con.execute('UPDATE jobs SET status=?, attempts=3 WHERE id=?',
+                      (FAILED, failed))
+    queue.con.execute('UPDATE jobs SET status=? WHERE id=?', (DONE, done))
+    queue.con.execute('UPDATE jobs SET status=? WHERE id=?',
+                      (RUNNING, running))
+    
+    # Only failed jobs are requeued, even if others are asked for
+    assert queue.replay([failed, done, running]) == [failed]
+    job = queue.get(failed)
+    assert (job['status'], job['attempts']) == (PENDING, 0)
+    assert queue.get(done)['status'] == DONE
+    assert queue.get(running)['status'] == RUNNING
+    
+    queue.con.execute('UPDATE jobs SET status=? WHERE id=?', (FAILED, failed))
+    assert queue.replay() == [failed]
+    assert queue.replay() == []
+
+def test_recover(queue):
+    stale, fresh = queue.enqueue(['a', 'b'], CONTEXT)
+    queue.claim()
+    queue.claim()
+    queue.con.execute('UPDATE jobs SET updated=? WHERE id=?',
+                      (time.time() - 700, stale))
+    
+    # Jobs left running by a worker that died are run again
+    assert queue.recover(stale=600) == 1
+    assert queue.get(stale)['status'] == PENDING
+    assert queue.get(fresh)['status'] == RUNNING
+    assert queue.claim()['id'] == stale
+
+def test_worker(queue, monkeypatch):
+    results = {'ok': None, 'bad': RuntimeError('down')}
+    
+    def run_job(service, context):
+        result = results[service]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    monkeypatch.setattr(jobs, 'run_job', run_job)
+    ok, bad = queue.enqueue(['ok', 'bad'], CONTEXT)
+    stopping = threading.Event()
+    worker = jobs.Worker(queue, stopping, poll_interval=0.01)
+    worker.start()
+    deadline = time.time() + 5
+    while queue.counts().get(DONE) != 1 or not queue.get(bad)['error']:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    stopping.set()
+    worker.join(1)
+    
+    assert queue.get(ok)['status'] == DONE
+    job = queue.get(bad)
+    assert (job['status'], job['error']) == (PENDING, "RuntimeError('down')")
@@ -0,0 +1,129 @@
+"""Tests for rate and concurrency limits on calls to REDCap"""
+
+import multiprocessing
+import threading
+import time
+from datetime import timedelta
+from email.utils import formatdate
+from types import SimpleNamespace
+import pytest
+from redcap_booster.limit import (AdaptiveLimit, Limiter, SharedTokenBucket,
+                                  TokenBucket, parse_retry_after)
+
+def response(status=200, latency=0.1, headers=None):
+    return SimpleNamespace(status_code=status, headers=headers or {},
+                           elapsed=timedelta(seconds=latency),
+                           raw=SimpleNamespace(retries=None))
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after(formatdate(time.time() + 60)) == pytest.approx(
+        60, abs=2)
+    assert parse_retry_after(formatdate(time.time() - 60)) == 0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, burst=5)
+    start = time.monotonic()
+    waits = [bucket.acquire() for i in range(15)]
+    # The burst goes at once, then one call every 1/rate seconds
+    assert waits[:5] == [0.0] * 5
+    assert time.monotonic() - start == pytest.approx(10 / 50, abs=0.05)
+
+def take(db, n, waits):
+    limiter = Limiter('http://redcap', 10, rate=50, burst=5, db=db)
+    waits.put([limiter.bucket('token').acquire() for i in range(n)])
+
+def test_shared_token_bucket(tmp_path):
+    db = str(tmp_path / 'limits.db')
+    waits = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=take, args=(db, 10, waits))
+                 for i in range(2)]
+    start = time.monotonic()
+    for p in processes:
+        p.start()
+    waits = [waits.get() for p in processes]
+    for p in processes:
+        p.join()
+    # One burst and one rate for both processes, not one each
+    assert sum(1 for w in waits[0] + waits[1] if not w) == 5
+    assert time.monotonic() - start > 0.9 * 15 / 50
+    
+    # Other tokens have their own bucket; tokens aren't stored
+    bucket = SharedTokenBucket(db, 'other', rate=50, burst=5)
+    assert bucket.acquire() == 0.0
+    keys = [row[0] for row in bucket.con.execute('SELECT key FROM buckets')]
+    assert 'other' in keys and 'token' not in keys
+
+def test_limit_increases_and_decreases():
+    limit = AdaptiveLimit(20, tolerance=3.0)
+    limit.limit = 4.0
+    for i in range(4):
+        limit.acquire()
+        limit.release('kind', 0.1)
+    assert 4.9 < limit.limit < 5
+    
+    # A slow response halves the limit, once per round trip
+    limit.acquire()
+    limit.release('kind', 0.5)
+    assert limit.limit == pytest.approx(4.9 / 2, abs=0.05)
+    limit.acquire()
+    limit.release('kind', None, overload=True)
+    assert limit.limit == pytest.approx(4.9 / 2, abs=0.05)
+    
+    # Latency is compared within a kind of call
+    limit.acquire()
+    limit.release('other', 0.5)
+    assert limit.limit > 2.45
+    
+    # Never beyond the bounds
+    for i in range(20):
+        limit.decreased = 0.0
+        limit.adjust('kind', None, True)
+    assert limit.limit == 1
+
+def test_limit_follows_slower_server():
+    limit = AdaptiveLimit(10, tolerance=3.0)
+    for i in range(20):
+        limit.acquire()
+        limit.release('kind', 0.01)
+    
+    # Uniformly slower responses, without errors, lower the limit once, and
+    # it grows back as the baseline catches up
+    lowest = limit.limit
+    for i in range(100):
+        # A round trip for every round of calls
+        if i % 10 == 0:
+            limit.decreased = 0.0
+        limit.acquire()
+        limit.release('kind', 0.25)
+        lowest = min(lowest, limit.limit)
+    assert lowest == 5
+    assert limit.limit == 10
+
+def test_limit_fixed():
+    limit = AdaptiveLimit(3, adaptive=False)
+    for i in range(3):
+        limit.acquire()
+    blocked = threading.Thread(target=limit.acquire)
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+    
+    limit.release('kind', None, overload=True)
+    blocked.join(1)
+    assert not blocked.is_alive()
+    assert limit.limit == 3
+
+def test_limiter_retry_after():
+    limiter = Limiter('http://redcap', 10)
+    limiter.acquire('token')
+    limiter.release('kind', response(429, headers={'Retry-After': '1'}))
+    assert limiter.concurrency.limit == 5
+    
+    # Calls wait for Retry-After
+    start = time.monotonic()
+    limiter.acquire('token')
+    assert time.monotonic() - start == pytest.approx(1, abs=0.1)
+    limiter.release('kind', response())
@@ -0,0 +1,147 @@
+"""Tests for cached REDCap project metadata"""
+
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from redcap_booster import config, metadata
+from redcap_booster.metadata import MetadataCache, ProjectMetadata
+from redcap_booster.services import id_gen
+from redcap_booster.services.id_gen.db import DatabaseAccess
+
+PID = '77'
+URL = 'https://redcap.example.org'
+
+def field(name, form, type='text'):
+    return {'field_name': name, 'form_name': form, 'field_type': type}
+
+FIELDS = [field('study_id', 'enrollment'), field('cid', 'enrollment'),
+          field('race', 'enrollment', 'checkbox'), field('visit_date', 'visit'),
+          field('dose', 'meds')]
+
+def longitudinal():
+    project = {'project_id': PID, 'is_longitudinal': 1,
+               'has_repeating_instruments_or_events': 1}
+    form_events = [
+        {'arm_num': 1, 'unique_event_name': 'screen_arm_1',
+         'form': 'enrollment'},
+        {'arm_num': 1, 'unique_event_name': 'base_arm_1', 'form': 'enrollment'},
+        {'arm_num': 1, 'unique_event_name': 'base_arm_1', 'form': 'meds'},
+        {'arm_num': 1, 'unique_event_name': 'follow_arm_1', 'form': 'visit'}]
+    repeating = [{'event_name': 'base_arm_1', 'form_name': 'meds'},
+                 {'event_name': 'follow_arm_1', 'form_name': ''}]
+    return ProjectMetadata(project, FIELDS, [], form_events, repeating)
+
+def test_fields():
+    m = ProjectMetadata({'project_id': PID}, FIELDS)
+    assert m.record_id == 'study_id'
+    assert not m.longitudinal
+    m.check(['cid', 'visit_complete', 'race___2'])
+    with pytest.raises(ValueError, match='no field id, cid___1'):
+        m.check(['cid', 'id', 'cid___1'])
+    assert m.export_fields(['cid', 'study_id', 'dose']) == [
+        'study_id', 'cid', 'dose']
+    assert m.row('1', {'cid': 'C1'}) == {'study_id': '1', 'cid': 'C1'}
+
+def test_event_aware_rows():
+    m = longitudinal()
+    assert m.events_for('enrollment') == ['screen_arm_1', 'base_arm_1']
+    
+    # The triggering event if the form is designated for it, or the first
+    assert m.row('1', {'cid': 'C1'}, 'base_arm_1') == {
+        'study_id': '1', 'redcap_event_name': 'base_arm_1', 'cid': 'C1'}
+    assert m.row('1', {'cid': 'C1'}, 'follow_arm_1') == {
+        'study_id': '1', 'redcap_event_name': 'screen_arm_1', 'cid': 'C1'}
+    
+    # Repeating instruments and events
+    assert m.row('1', {'dose': 5}, instance='3') == {
+        'study_id': '1', 'redcap_event_name': 'base_arm_1',
+        'redcap_repeat_instrument': 'meds', 'redcap_repeat_instance': '3',
+        'dose': 5}
+    assert m.row('1', {'visit_date': 'x'}) == {
+        'study_id': '1', 'redcap_event_name': 'follow_arm_1',
+        'redcap_repeat_instrument': '', 'redcap_repeat_instance': 1,
+        'visit_date': 'x'}
+    with pytest.raises(ValueError):
+        m.row('1', {'cid': 'C1', 'visit_date': 'x'})
+
+def test_cache(tmp_path):
+    fetches = []
+    
+    def fetch(redcap_url, pid):
+        fetches.append((redcap_url, pid))
+        time.sleep(0.05)
+        return longitudinal()
+    
+    cache = MetadataCache(60, str(tmp_path), fetch)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.get(f'{URL}/', PID)))
+        for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    # Fetched once, for all callers
+    assert fetches == [(URL, PID)]
+    assert all(m is results[0] for m in results)
+    assert cache.get(URL, PID) is results[0]
+    
+    # Saved for other processes
+    other = MetadataCache(60, str(tmp_path), fetch)
+    assert other.get(URL, PID).event_forms == results[0].event_forms
+    assert len(fetches) == 1
+    
+    # Fetched again once expired, or when asked to
+    cache.ttl = 0.01
+    time.sleep(0.02)
+    assert cache.get(URL, PID) is not results[0]
+    cache.get(URL, PID, refresh=True)
+    assert len(fetches) == 3
+
+def test_cache_failure(tmp_path):
+    def fail(redcap_url, pid):
+        raise ConnectionError('down')
+    
+    cache = MetadataCache(60, '', fail)
+    with pytest.raises(ConnectionError):
+        cache.get(URL, PID)
+    
+    # Expired metadata is used while REDCap can't be reached
+    stale = longitudinal()
+    stale.fetched -= 120
+    cache.projects[(URL, PID)] = stale
+    assert cache.get(URL, PID) is stale
+    assert cache.retry_at[(URL, PID)] > time.time()
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.settings, 'id_gen',
+                        {'db': str(tmp_path / 'id_gen.db')})
+    monkeypatch.setattr(config.settings, f'id_gen_{PID}', {
+        'id_field': 'cid', 'metadata': True,
+        'generator': {'prefix': 'C', 'width': 4, 'key': 'test'}},
+        raising=False)
+    cache = MetadataCache(60, '', lambda redcap_url, pid: longitudinal())
+    monkeypatch.setattr(metadata, '_cache', cache)
+    return DatabaseAccess('id_gen')
+
+def test_id_gen(db, monkeypatch):
+    imported = []
+    monkeypatch.setattr(id_gen, 'redcap_import',
+                        lambda service, config, context, rows, record_id:
+                        imported.append((rows, record_id))
+                        or SimpleNamespace(ok=True))
+    context = {'project_id': PID, 'record': '1', 'redcap_url': URL,
+               'instrument': 'enrollment',
+               'redcap_event_name': 'base_arm_1'}
+    id_gen.run(config, context, db=db)
+    assert imported == [([{'study_id': '1', 'redcap_event_name': 'base_arm_1',
+                           'cid': db.get_id(PID, '1')}], 'study_id')]
+    
+    # A misconfigured ID field fails before an ID is claimed
+    getattr(config.settings, f'id_gen_{PID}')['id_field'] = 'wrong'
+    with pytest.raises(ValueError):
+        id_gen.run(config, dict(context, record='2'), db=db)
+    assert db.free_ids(PID) == 10**4 - 1
@@ -0,0 +1,45 @@
+"""Tests for the interface between the server and service plugins"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from redcap_booster.plugin import Plugin
+
+def module(**attrs):
+    state = {'active': 0, 'most': 0}
+    lock = threading.Lock()
+    
+    def run(config, context):
+        with lock:
+            state['active'] += 1
+            state['most'] = max(state['most'], state['active'])
+        time.sleep(0.02)
+        with lock:
+            state['active'] -= 1
+    
+    return SimpleNamespace(run=run, state=state, **attrs)
+
+@pytest.mark.parametrize('thread_safe', [False, True])
+def test_sync_runs(thread_safe):
+    plugin = Plugin('svc', module(thread_safe=thread_safe))
+    
+    async def triggers():
+        await asyncio.gather(*(plugin.run(None, {}) for i in range(4)))
+    
+    # Triggers handled by the server, and background jobs
+    jobs = [threading.Thread(target=plugin.run_sync, args=(None, {}))
+            for i in range(4)]
+    for job in jobs:
+        job.start()
+    asyncio.run(triggers())
+    for job in jobs:
+        job.join()
+    
+    state = plugin.module.state
+    assert state['active'] == 0
+    if thread_safe:
+        assert state['most'] > 1
+    else:
+        assert state['most'] == 1
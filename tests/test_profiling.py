@@ -0,0 +1,67 @@
+"""Tests for on-demand profiling"""
+
+import threading
+import time
+from redcap_booster.profiling import NULL, Profiler
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def test_next_requests():
+    profiler = Profiler()
+    assert profiler.begin() is None
+    assert profiler.span('x') is NULL
+    
+    session = profiler.start(requests=2, interval=0.001)
+    first, second = profiler.begin(), profiler.begin()
+    assert first is second is session
+    assert profiler.begin() is None
+    
+    # Stacks are sampled while profiled requests are in flight
+    worker = threading.Thread(target=busy, args=(0.2,), name='worker')
+    worker.start()
+    with profiler.span('work'):
+        busy(0.2)
+    worker.join()
+    
+    # Spans are only timed within profiled requests
+    def elsewhere():
+        with profiler.span('elsewhere'):
+            pass
+    other = threading.Thread(target=elsewhere)
+    other.start()
+    other.join()
+    
+    first.finish()
+    assert session.active
+    second.finish()
+    assert not session.active
+    assert profiler.span('x') is NULL
+    
+    stats = session.stats()
+    assert stats['requests'] == 2 and stats['samples'] > 0
+    assert list(stats['spans']) == ['work']
+    assert stats['spans']['work']['count'] == 1
+    assert 0.2 <= stats['spans']['work']['total'] < 0.5
+    
+    # Collapsed format: frames from the root, separated by ;, then a count
+    stacks = [line.rsplit(' ', 1) for line in session.stacks().splitlines()]
+    assert all(n.isdigit() for stack, n in stacks)
+    worker_stacks = [stack.split(';') for stack, n in stacks
+                     if stack.startswith('worker;')]
+    assert worker_stacks
+    assert all(stack[-1].startswith('busy (tests/test_profiling.py:')
+               for stack in worker_stacks)
+
+def test_rate():
+    profiler = Profiler()
+    session = profiler.start(rate=0.5, seconds=0.2)
+    selected = [profiler.begin() for i in range(1000)]
+    assert 350 < sum(1 for s in selected if s) < 650
+    time.sleep(0.3)
+    assert profiler.begin() is None
+    assert not session.active
+    session.thread.join(1)
+    assert not session.thread.is_alive()
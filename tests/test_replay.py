@@ -0,0 +1,108 @@
+"""Tests for replaying Data Entry Triggers"""
+
+import asyncio
+import pytest
+from redcap_booster import replay
+from redcap_booster.routing import Route
+
+URL = 'https://redcap.example.org/'
+
+def test_read():
+    assert list(replay.read_list(['r1\n', '\n', ' r2 \n'])) == [
+        {'record':'r1'}, {'record':'r2'}]
+    
+    rows = list(replay.read_csv(['study_id,redcap_event_name,name\n',
+                                 'r1,baseline_arm_1,a\n', ',,\n']))
+    assert [row['record'] for row in rows] == ['r1']
+    assert rows[0]['redcap_event_name'] == 'baseline_arm_1'
+    with pytest.raises(ValueError):
+        list(replay.read_csv(['a,b\n', '1,2\n'], 'record_id'))
+
+def test_contexts():
+    rows = replay.read_csv([
+        'record_id,redcap_event_name,redcap_repeat_instrument,'
+        'redcap_repeat_instance,visit_complete\n',
+        'r1,base_arm_1,,,2\n',
+        'r1,base_arm_1,visit,1,1\n',
+        'r1,base_arm_1,visit,1,1\n',
+        'r1,base_arm_1,other,1,\n',
+        'r1,follow_arm_1,,,\n'])
+    triggers = dict(replay.contexts('9', URL, rows, ['reg', 'visit'], '0'))
+    
+    # Repeating instruments only trigger themselves, and only if selected;
+    # duplicates are skipped
+    assert list(triggers) == [
+        ('r1', 'reg', 'base_arm_1', None),
+        ('r1', 'visit', 'base_arm_1', None),
+        ('r1', 'visit', 'base_arm_1', '1'),
+        ('r1', 'reg', 'follow_arm_1', None),
+        ('r1', 'visit', 'follow_arm_1', None)]
+    assert triggers[('r1', 'visit', 'base_arm_1', '1')] == {
+        'project_id':'9', 'instrument':'visit', 'record':'r1',
+        'redcap_url':URL, 'replay':'1', 'redcap_event_name':'base_arm_1',
+        'redcap_repeat_instance':'1', 'visit_complete':'1'}
+    assert triggers[('r1', 'reg', 'base_arm_1', None)]['reg_complete'] == '0'
+
+def test_checkpoint(tmp_path):
+    filename = str(tmp_path / 'checkpoint')
+    checkpoint = replay.Checkpoint(filename, '9')
+    assert checkpoint.done == set()
+    checkpoint.add(('r1', 'reg', None, None))
+    checkpoint.add(('r2', 'reg', 'e', '1'))
+    checkpoint.close()
+    
+    # A line cut short is taken as not done
+    with open(filename, 'a') as f:
+        f.write('["r3", "re')
+    checkpoint = replay.Checkpoint(filename, '9')
+    assert checkpoint.done == {('r1', 'reg', None, None),
+                               ('r2', 'reg', 'e', '1')}
+    checkpoint.add(('r3', 'reg', None, None))
+    checkpoint.close()
+    assert ('r3', 'reg', None, None) in replay.Checkpoint(filename, '9').done
+    
+    with pytest.raises(ValueError):
+        replay.Checkpoint(filename, '10')
+    checkpoint.remove()
+    assert replay.Checkpoint(filename, '10').done == set()
+
+class FakeRouter:
+    def __init__(self, routes):
+        self.routes = routes
+    
+    async def start(self):
+        pass
+    
+    async def stop(self):
+        pass
+    
+    def match(self, pid, instrument):
+        return self.routes
+
+def test_replay(tmp_path, monkeypatch):
+    seen, running = [], []
+    
+    async def run(config, context):
+        running.append(1)
+        seen.append((len(running), context['record']))
+        await asyncio.sleep(0.01)
+        running.pop()
+        if context['record'] == 'bad':
+            raise ValueError('bad record')
+    
+    routes = [Route('svc', run, True, None), Route('other', run, True, None)]
+    monkeypatch.setattr(replay, 'router', FakeRouter(routes))
+    rows = replay.read_list(['bad'] + [f'r{i}' for i in range(20)])
+    triggers = list(replay.contexts('9', URL, rows, ['reg']))
+    checkpoint = replay.Checkpoint(str(tmp_path / 'checkpoint'), '9')
+    
+    counts = asyncio.run(replay.replay(triggers, 4, {'svc'},
+                                       checkpoint=checkpoint))
+    assert counts == {'done':20, 'failed':1}
+    assert len(seen) == 21
+    assert max(n for n, record in seen) == 4
+    
+    # Only triggers whose services all succeeded are done
+    checkpoint.close()
+    assert replay.Checkpoint(checkpoint.filename, '9').done == {
+        key for key, context in triggers[1:]}
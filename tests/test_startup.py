@@ -0,0 +1,84 @@
+"""Startup cost with many projects, tracked with python -X importtime"""
+
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROJECTS = 500
+
+# Generous, so as only to catch startup growing with the number of projects
+BUDGET = 2.0
+
+@pytest.fixture(scope='module')
+def project_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('startup')
+    pids = [str(i) for i in range(1, PROJECTS + 1)]
+    lines = [f'pids={json.dumps(pids)}']
+    for pid in pids:
+        lines.append(f'key_{pid}=key{pid}')
+        lines.append(f'id_gen_{pid}={json.dumps({"form_triggers": ["reg"]})}')
+    (directory / '.env').write_text('\n'.join(lines) + '\n')
+    (directory / '.secrets').mkdir()
+    for pid in pids:
+        (directory / '.secrets' / f'token_{pid}').write_text(f'token{pid}\n')
+    return directory
+
+def run(directory, *args, env=None):
+    env = dict(os.environ, PYTHONPATH=root, **(env or {}))
+    return subprocess.run([sys.executable, '-X', 'importtime'] + list(args),
+                          cwd=directory, env=env, capture_output=True,
+                          text=True, check=True)
+
+def import_times(stderr):
+    """Return {module: cumulative seconds} from -X importtime output"""
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('package'):
+            _, cumulative, module = line[12:].split('|')
+            times[module.strip()] = int(cumulative) / 1e6
+    return times
+
+def report(times):
+    for module, seconds in sorted(times.items(), key=lambda t: -t[1])[:10]:
+        print(f'{seconds * 1000:8.1f} ms  {module}')
+
+@pytest.mark.parametrize('args', [
+    ('-c', 'import redcap_booster.cli'),
+    ('-m', 'redcap_booster.cli', 'list-services'),
+])
+def test_no_plugins_loaded(project_dir, args):
+    result = run(project_dir, *args)
+    times = import_times(result.stderr)
+    report(times)
+    loaded = [module for module in times
+              if module.startswith('pluginbase._internalspace.')]
+    assert loaded == []
+    if args[0] == '-m':
+        assert result.stdout.split() == ['id_gen']
+
+def test_import_budget(project_dir):
+    result = run(project_dir, '-c', 'from redcap_booster import config; '
+                 'print(config.settings.token_500)')
+    times = import_times(result.stderr)
+    report(times)
+    assert result.stdout.strip() == 'token500'
+    assert times['redcap_booster'] < BUDGET
+
+def test_service_command(project_dir):
+    result = run(project_dir, '-m', 'redcap_booster.cli', 'id-gen', '--help')
+    assert 'Utilities for ID generation service' in result.stdout
+
+def test_settings_precedence(project_dir):
+    # Environment, then .env, then secrets_dir, as with pydantic
+    script = ('from redcap_booster import config; s = config.settings; '
+              'print(s.key_1, s.key_2, s.token_1, '
+              'repr(getattr(s, "key_600", None)), s.id_gen_1, s.id_gen_2, hasattr(s, "id_gen_600"))')
+    result = run(project_dir, '-c', script,
+                 env={'KEY_2': 'fromenv', 'ID_GEN_2': '{"a": 1}'})
+    assert result.stdout.split(' ', 3)[:3] == ['key1', 'fromenv', 'token1']
+    assert result.stdout.rstrip().endswith(
+        "None {'form_triggers': ['reg']} {'a': 1} False")
@@ -0,0 +1,52 @@
+"""Tests for the project settings store"""
+
+import threading
+import pytest
+from redcap_booster import config
+from redcap_booster.config import LazySettings
+from redcap_booster.store import ConfigStore
+
+@pytest.fixture
+def store(tmp_path):
+    return ConfigStore(str(tmp_path / 'config.db'))
+
+@pytest.fixture
+def settings(store):
+    base = config.settings._base.copy(update={'pids': ['123']})
+    env = {'key_123': 'k123', 'key_456': 'from-env'}
+    return LazySettings(base, config.plugins, env, store)
+
+def test_snapshot(store, settings):
+    assert settings.pids == ['123']
+    
+    # Changes only show once the snapshot is replaced
+    store.set('456', 'key', 'k456')
+    store.set('456', 'id_gen', {'form_triggers': ['reg']})
+    assert not hasattr(settings, 'key_456')
+    assert store.refresh()
+    assert not store.refresh()
+    
+    assert settings.pids == ['123', '456']
+    assert settings.key_123 == 'k123'
+    assert settings.key_456 == 'k456'
+    assert settings.id_gen_456 == {'form_triggers': ['reg']}
+    assert settings.token_456 == ''
+    
+    with pytest.raises(ValueError):
+        store.set('456', 'id_gen', ['reg'])
+    
+    assert store.remove('456') == 2
+    store.refresh()
+    assert settings.pids == ['123']
+    assert not hasattr(settings, 'id_gen_456')
+
+def test_watch(store):
+    changed = threading.Event()
+    stop = store.watch(changed.set, interval=0.05)
+    try:
+        # Written through another connection, as by rbutils projects
+        ConfigStore(store.db).set('456', 'key', 'k456')
+        assert changed.wait(5)
+        assert store.snapshot.values == {'key_456': 'k456'}
+    finally:
+        stop()
@@ -110,11 +110,35 @@ def update_ids_transactional(db_path, corrections_csv_path, project_id):
         logging.info(f"  - Updated {cur.rowcount} records to their final IDs.")
         logging.info("--- Phase 2 Complete ---")
 
-        # --- 6. Clean up temporary table ---
+        # --- 6. Invalidate cached IDs of the project ---
+        # The corrected IDs are no longer known to be in REDCap
+        logging.info("--- Invalidating cached IDs of the project ---")
+        cur.execute(f"PRAGMA table_info({table_name})")
+        if "written" in [row[1] for row in cur.fetchall()]:
+            cur.execute(f"""
+                UPDATE {table_name}
+                SET written = NULL
+                WHERE id IN (SELECT corrected_id FROM {temp_table_name})
+            """
+            )
+
+        # Running servers compare this counter with the one their caches were
+        # filled at, and drop cached IDs when it changes
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS generations "
+            "(pid TEXT PRIMARY KEY, n INTEGER NOT NULL)"
+        )
+        cur.execute(
+            "INSERT INTO generations (pid, n) VALUES (?, 1) "
+            "ON CONFLICT (pid) DO UPDATE SET n = n + 1",
+            (str(project_id),),
+        )
+
+        # --- 7. Clean up temporary table ---
         logging.info(f"--- Dropping temporary table '{temp_table_name}' ---")
         cur.execute(f"DROP TABLE {temp_table_name}")
 
-        # --- 7. Commit the transaction ---
+        # --- 8. Commit the transaction ---
         cur.execute("COMMIT")
         logging.info("--- Database transaction committed successfully ---")
 